@@ -5,7 +5,6 @@ import os
 from celery import Celery
 from celery.signals import setup_logging
 from django.conf import settings
-from celery.schedules import crontab
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EduConnect.settings')
@@ -20,13 +19,7 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Auto-discover task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
-# Define the periodic task schedule using Celery Beat
-app.conf.beat_schedule = {
-    'delete-expired-rooms-every-minute': {
-        'task': 'chat.tasks.delete_expired_rooms',
-        'schedule': crontab(minute='*/1'),  # Schedule to run every minute
-    },
-}
+# The periodic task schedule is defined once, in CELERY_BEAT_SCHEDULE in settings.py
 
 # Configure logging to use Django's logging settings
 @setup_logging.connect
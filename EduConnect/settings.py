@@ -74,6 +74,93 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Chat message persistence: messages are buffered per room and written in batches
+CHAT_MESSAGE_BATCH_SIZE = 50  # Write a room's buffer once this many messages are pending
+CHAT_MESSAGE_FLUSH_INTERVAL = 0.25  # ...or once the oldest pending message is this many seconds old
+CHAT_MESSAGE_FLUSH_RETRIES = 5  # Attempts to write a failed batch again before its messages are given up
+CHAT_MESSAGE_RETRY_DELAY = 0.5  # Seconds before the first retry; doubled after each failure
+CHAT_HISTORY_PAGE_SIZE = 50  # Messages sent on connect and per "load older" request
+
+# Outbound queue of every chat WebSocket connection
+CHAT_SEND_QUEUE_SIZE = 100  # Frames a connection may have waiting before the overflow policy applies
+CHAT_SEND_QUEUE_OVERFLOW = 'drop_oldest'  # 'drop_oldest', or 'disconnect' to close the socket with a resync hint
+CHAT_SEND_QUEUE_TICK = 0.01  # Seconds during which queued frames are coalesced into one array frame
+CHAT_EPHEMERAL_INTERVAL = 1.0  # Minimum seconds between typing or read events relayed for one connection
+CHAT_FANOUT_SHARDS = {'students': 16, 'teacher_student': 16}  # Rooms whose members are spread over several channel layer groups, by name
+
+# Token buckets limiting what clients can send: tokens refilled per second, and the largest burst allowed
+CHAT_RATE_LIMITS = {
+    'user': {'rate': 5, 'burst': 20},  # Frames of any type from one user, over all their connections
+    'room': {'rate': 50, 'burst': 100},  # Chat messages posted to one room by all its members
+}
+CHAT_RATE_LIMIT_BACKEND = {
+    'BACKEND': 'chat.ratelimit.InMemoryRateLimitBackend',  # Use chat.ratelimit.RedisRateLimitBackend to share limits between ASGI servers
+}
+
+# Redis database for chat services that must be shared by every ASGI server process
+CHAT_REDIS_URL = 'redis://127.0.0.1:6379/1'
+
+# Chat access lists and the moderation term list are invalidated through the default cache. A per-process
+# cache only invalidates the process making the change; the others reload after CHAT_ACL_MAX_AGE or
+# CHAT_MODERATION_MAX_AGE seconds
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',  # Use django.core.cache.backends.redis.RedisCache with 'LOCATION': CHAT_REDIS_URL when running several ASGI servers
+    },
+}
+CHAT_ACL_MAX_AGE = 30  # Seconds a process keeps a room's allowed users or a group's members before reloading them
+
+# Chat access attempts are buffered in memory and rolled up hourly
+CHAT_AUDIT_BATCH_SIZE = 100  # Write buffered access attempts once this many are pending
+CHAT_AUDIT_FLUSH_INTERVAL = 5  # ...or once the oldest pending attempt is this many seconds old
+CHAT_AUDIT_RETENTION_DAYS = 30  # Raw access attempts older than this are pruned after being rolled up
+
+# Deletion of expired chat rooms
+CHAT_EXPIRY_ROOM_BATCH_SIZE = 50  # Expired rooms fetched per batch
+CHAT_EXPIRY_MESSAGE_BATCH_SIZE = 1000  # Messages deleted (and archived) per chunk
+CHAT_EXPIRY_ARCHIVE = False  # Archive each room's messages to MEDIA_ROOT/chat_archives/ as gzipped NDJSON before deleting
+CHAT_EXPIRY_SCHEDULER = 'celery'  # 'celery' for one ETA task per room, or 'timer' for an in-process timer wheel on single-node setups
+
+# Tiered storage for rooms that never expire. Off by default: tiered messages are served by
+# history and export, but not yet by the REST message list or full-text search
+CHAT_TIERING_ENABLED = False
+CHAT_TIERING_AGE_DAYS = 90  # Messages older than this move from the database to MEDIA_ROOT/chat_segments/
+CHAT_TIERING_SEGMENT_SIZE = 50000  # Largest number of messages in one segment file; busy months get several
+
+# Moderation of banned terms, managed as Moderated Terms in the admin panel
+CHAT_MODERATION_REFRESH_INTERVAL = 5  # Seconds between checks for term list changes; the automaton is only rebuilt on a change
+CHAT_MODERATION_MAX_AGE = 60  # Seconds after which the automaton is rebuilt even if no change was seen through the cache
+
+# Maximum number of results returned by the chat message search API
+CHAT_SEARCH_RESULTS_LIMIT = 50
+
+# Users per page of the user search API behind the room creation form
+CHAT_USER_SEARCH_PAGE_SIZE = 20
+
+# Chat lobby
+CHAT_LOBBY_PAGE_SIZE = 20  # Rooms listed per lobby page
+
+# Room transcript export
+CHAT_EXPORT_CHUNK_SIZE = 2000  # Messages fetched per database round trip while streaming an export
+
+# Tracks which users are connected to which chat rooms
+CHAT_PRESENCE_BACKEND = {
+    'BACKEND': 'chat.presence.InMemoryPresenceBackend',  # Use chat.presence.RedisPresenceBackend when running several ASGI servers
+}
+
+# Per-room message sequence numbers, which let reconnecting clients fetch only what they missed
+CHAT_SEQUENCE_BACKEND = {
+    'BACKEND': 'chat.sequence.InMemorySequenceBackend',  # Use chat.sequence.RedisSequenceBackend when running several ASGI servers
+}
+CHAT_RESUME_LIMIT = 500  # Largest gap sent to a resuming client; larger gaps make it reload
+CHAT_RESUME_GAP_TIMEOUT = 30  # Seconds after which a missing sequence number is taken as lost and skipped by resumes; longer than a batch's retries
+
+# Ring buffer of the latest messages of each room, serving joins and resumes without a database query
+CHAT_RECENT_MESSAGES_BACKEND = {
+    'BACKEND': 'chat.recent.InMemoryRecentBackend',  # Use chat.recent.RedisRecentBackend when running several ASGI servers
+}
+CHAT_RECENT_MESSAGES_SIZE = 100  # Messages kept per room; clients paging further back read the database
+
 # authentication settings
 AUTH_USER_MODEL = 'accounts.User' 
 
@@ -220,8 +307,16 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 CELERY_BEAT_SCHEDULE = {
-    'delete-expired-rooms-every-minute': {
+    'delete-expired-rooms-safety-net': {
         'task': 'chat.tasks.delete_expired_rooms',
-        'schedule': crontab(minute='*'),  # This runs the task every minute
+        'schedule': crontab(minute='*'),  # Rooms expire at their exact time; this scan catches missed expiries within a minute
+    },
+    'rollup-access-attempts-every-hour': {
+        'task': 'chat.tasks.rollup_access_attempts',
+        'schedule': crontab(minute=5),  # Runs a few minutes past every hour, once the previous hour is complete
+    },
+    'tier-old-messages-daily': {
+        'task': 'chat.tasks.tier_old_messages',
+        'schedule': crontab(hour=3, minute=30),  # Moves old messages of never-expiring rooms to segment files, if CHAT_TIERING_ENABLED
     },
 }
\ No newline at end of file
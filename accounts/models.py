@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
 
 
 class User(AbstractUser):
@@ -14,3 +15,13 @@ class User(AbstractUser):
         blank=True
     )
     is_teacher = models.BooleanField(default=False)  # True for teachers, False for students
+
+    class Meta(AbstractUser.Meta):
+        """
+        Meta options for the User model.
+        Indexes the lowercased username and email for prefix searches (see the chat user search API).
+        """
+        indexes = [
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
@@ -0,0 +1,109 @@
+import time
+import uuid
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from .models import ChatSession
+
+# Predefined rooms restricted to the members of a user group
+GROUP_ROOMS = {
+    'students': 'Students',
+    'teachers': 'Teachers',
+}
+
+# Messages shown to users who are denied access
+DENIED_MESSAGES = {
+    'students': "You do not have permission to enter the Students Only Room.",
+    'teachers': "You do not have permission to enter the Teachers Only Room.",
+}
+PRIVATE_ROOM_DENIED_MESSAGE = "You do not have permission to enter this private chat room."
+
+# Member id sets loaded by this process, keyed by cache key: key -> (version, frozenset of user ids, monotonic load time)
+_member_sets = {}
+
+
+def _version(key):
+    """
+    Return the current version token of a member set.
+    The token lives in the default cache; when that cache is shared, invalidating
+    it in one process makes every other process reload the set on its next check.
+    """
+    version_key = f'{key}:version'
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+    return version
+
+
+def _members(key, load):
+    """
+    Return the frozenset of user ids stored under `key`, calling `load` to
+    fetch it from the database when this process has no current copy.
+    Copies older than CHAT_ACL_MAX_AGE seconds are loaded again, so that changes
+    reach every process even when the cache is not shared between them.
+    """
+    version = _version(key)
+    now = time.monotonic()
+    cached = _member_sets.get(key)
+    if cached is not None and cached[0] == version and now - cached[2] < getattr(settings, 'CHAT_ACL_MAX_AGE', 30):
+        return cached[1]
+
+    members = frozenset(load())
+    _member_sets[key] = (version, members, now)
+    return members
+
+
+def invalidate(key):
+    """
+    Mark a member set as stale in every process sharing the cache.
+    """
+    cache.set(f'{key}:version', uuid.uuid4().hex, None)
+    _member_sets.pop(key, None)
+
+
+def allowed_users_key(chat_session_id):
+    return f'chat:acl:allowed:{chat_session_id}'
+
+
+def group_key(group_name):
+    return f'chat:acl:group:{group_name}'
+
+
+def allowed_user_ids(chat_session_id):
+    """
+    Return the ids of the users allowed in a private chat session.
+    """
+    return _members(
+        allowed_users_key(chat_session_id),
+        lambda: ChatSession.allowed_users.through.objects.filter(
+            chatsession_id=chat_session_id
+        ).values_list('user_id', flat=True),
+    )
+
+
+def group_member_ids(group_name):
+    """
+    Return the ids of the users in the named group.
+    """
+    return _members(
+        group_key(group_name),
+        lambda: get_user_model().objects.filter(groups__name=group_name).values_list('id', flat=True),
+    )
+
+
+def check_room_access(user, chat_session):
+    """
+    Decide whether a user may enter a chat room.
+    Returns an (allowed, message) pair, where message explains a denial.
+    Used by both the room view and the chat consumer so that HTTP and WebSocket
+    access follow the same rules.
+    """
+    group_name = GROUP_ROOMS.get(chat_session.name)
+    if group_name is not None and user.id not in group_member_ids(group_name):
+        return False, DENIED_MESSAGES[chat_session.name]
+
+    if chat_session.is_private and user.id not in allowed_user_ids(chat_session.id):
+        return False, PRIVATE_ROOM_DENIED_MESSAGE
+
+    return True, None
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import ChatSession, Message, ChatAccessAttempt
+from .models import ChatSession, Message, ChatAccessAttempt, ChatAccessRollup, FlaggedMessage, MessageSegment, ModeratedTerm
+from .search import filter_messages
 
 
 @admin.register(ChatSession)
@@ -25,6 +26,17 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ('chat_session', 'timestamp')
     search_fields = ('user__username', 'message')
     ordering = ('-timestamp',)
+    list_select_related = ('chat_session', 'user')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search message text through the full-text index instead of a LIKE scan,
+        and usernames case-insensitively by prefix.
+        """
+        if not search_term:
+            return queryset, False
+        matches = filter_messages(queryset, search_term) | queryset.filter(user__username__istartswith=search_term)
+        return matches, False
 
     def message_excerpt(self, obj):
         """
@@ -45,3 +57,61 @@ class ChatAccessAttemptAdmin(admin.ModelAdmin):
     list_filter = ('success', 'timestamp')
     search_fields = ('user__username', 'room_name')
     ordering = ('-timestamp',)
+
+
+@admin.register(ChatAccessRollup)
+class ChatAccessRollupAdmin(admin.ModelAdmin):
+    """
+    Admin interface options for the ChatAccessRollup model.
+    Shows hourly access counts per room and user, which outlive the raw access attempts.
+    """
+    list_display = ('hour', 'room_name', 'user', 'success_count', 'denied_count')
+    list_filter = ('hour',)
+    search_fields = ('user__username', 'room_name')
+    ordering = ('-hour',)
+    list_select_related = ('user',)
+
+
+@admin.register(MessageSegment)
+class MessageSegmentAdmin(admin.ModelAdmin):
+    """
+    Admin interface options for the MessageSegment model.
+    Lists the segment files holding the old messages of rooms that never expire.
+    """
+    list_display = ('chat_session', 'month', 'message_count', 'path', 'created_at')
+    list_filter = ('month',)
+    ordering = ('chat_session', 'first_timestamp')
+    list_select_related = ('chat_session',)
+
+
+@admin.register(ModeratedTerm)
+class ModeratedTermAdmin(admin.ModelAdmin):
+    """
+    Admin interface options for the ModeratedTerm model.
+    Manages the terms masked in, flagged in or rejecting chat messages.
+    """
+    list_display = ('term', 'action', 'created_at')
+    list_filter = ('action',)
+    list_editable = ('action',)
+    search_fields = ('term',)
+    ordering = ('term',)
+
+
+@admin.register(FlaggedMessage)
+class FlaggedMessageAdmin(admin.ModelAdmin):
+    """
+    Admin interface options for the FlaggedMessage model.
+    Lists delivered messages containing flagged terms for moderators to review.
+    """
+    list_display = ('chat_session', 'user', 'terms', 'created_at', 'message_excerpt')
+    list_filter = ('created_at',)
+    search_fields = ('user__username', 'terms', 'message')
+    ordering = ('-created_at',)
+    list_select_related = ('chat_session', 'user')
+
+    def message_excerpt(self, obj):
+        """
+        Returns the first 50 characters of the flagged message for display purposes.
+        """
+        return obj.message[:50]
+    message_excerpt.short_description = 'Message Excerpt'
@@ -1,6 +1,24 @@
-from rest_framework import generics, permissions
+import hashlib
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from . import moderation, recent, sequence
+from .acl import check_room_access
+from .history import serialize_message
 from .models import ChatSession, Message
-from .serializers import ChatSessionSerializer, MessageSerializer
+from accounts.models import User
+from .pagination import MessageCursorPagination, UserCursorPagination
+from .presence import get_presence_backend
+from .search import search_messages
+from .serializers import ChatSessionSerializer, MessageSerializer, MessageSearchResultSerializer, UserSearchResultSerializer
 
 class ChatSessionListAPIView(generics.ListAPIView):
     """
@@ -20,28 +38,160 @@ class MessageListCreateAPIView(generics.ListCreateAPIView):
     """
     API view to list messages in a chat session and allow sending messages.
     Only participants of the chat session can access this view.
+    Messages are cursor-paginated, newest first; `since_id` returns only the messages
+    posted after a given id, oldest first, and unchanged pages are answered with 304.
     """
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
-    def get_queryset(self):
+    def check_participant(self):
         """
-        Return messages for a specific chat session.
+        Ensure the logged-in user participates in the chat session, without loading its participants.
         """
         chat_session_id = self.kwargs['chat_session_id']
-        chat_session = ChatSession.objects.get(id=chat_session_id)
-        if self.request.user in chat_session.participants.all():
-            return chat_session.messages.all()
+        if ChatSession.objects.filter(id=chat_session_id, participants=self.request.user).exists():
+            return chat_session_id
+        get_object_or_404(ChatSession, id=chat_session_id)
+        raise PermissionDenied("You are not a participant of this chat session.")
+
+    def get_queryset(self):
+        """
+        Return messages for a specific chat session, after `since_id` if given.
+        """
+        messages = Message.objects.filter(chat_session_id=self.check_participant()).select_related('user')
+        since_id = self.request.query_params.get('since_id')
+        if since_id is not None:
+            try:
+                messages = messages.filter(id__gt=int(since_id))
+            except ValueError:
+                raise ValidationError({'since_id': "Must be an integer."})
+        return messages
+
+    def list(self, request, *args, **kwargs):
+        """
+        Return one page of messages, or 304 if it matches the client's If-None-Match.
+        The ETag is derived from the ids on the page and the page's cursors, so it changes
+        whenever a message is added to or removed from the page.
+        """
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        paginator = self.paginator
+        fingerprint = ','.join(str(message.id) for message in page)
+        etag = quote_etag(hashlib.md5(
+            f"{fingerprint}|{paginator.get_next_link()}|{paginator.get_previous_link()}".encode()
+        ).hexdigest())
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
         else:
-            raise permissions.PermissionDenied("You are not a participant of this chat session.")
+            response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response['ETag'] = etag
+        return response
 
     def perform_create(self, serializer):
         """
-        Assign the message to the logged-in user and chat session.
+        Assign the message to the logged-in user and chat session, moderate it like messages
+        sent over the WebSocket, number it in the room, and add it to the room's recent messages.
         """
-        chat_session_id = self.kwargs['chat_session_id']
-        chat_session = ChatSession.objects.get(id=chat_session_id)
-        if self.request.user in chat_session.participants.all():
-            serializer.save(user=self.request.user, chat_session=chat_session)
-        else:
-            raise permissions.PermissionDenied("You are not a participant of this chat session.")
+        chat_session_id = self.check_participant()
+        text = serializer.validated_data['message']
+        verdict = async_to_sync(moderation.moderate)(text)
+        if verdict.action == moderation.REJECT:
+            raise ValidationError({'message': ["This message contains a term that is not allowed in chat."]})
+
+        try:
+            with transaction.atomic():
+                message = serializer.save(
+                    user=self.request.user,
+                    chat_session_id=chat_session_id,
+                    message=verdict.message,
+                    seq=async_to_sync(sequence.next_seq)(chat_session_id)
+                )
+        except IntegrityError:
+            # The room's counter handed out a number already stored; move it past the stored ones
+            async_to_sync(sequence.advance_past_stored)(chat_session_id)
+            message = serializer.save(
+                user=self.request.user,
+                chat_session_id=chat_session_id,
+                message=verdict.message,
+                seq=async_to_sync(sequence.next_seq)(chat_session_id)
+            )
+        if verdict.action == moderation.FLAG:
+            moderation.flag(chat_session_id, self.request.user, message.seq, text, verdict.terms)
+        async_to_sync(recent.get_recent_backend().append)(chat_session_id, serialize_message(message))
+
+class ChatSessionPresenceAPIView(APIView):
+    """
+    API view returning how many users are currently connected to a chat session.
+    Only users who may enter the room can see its presence.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, chat_session_id):
+        """
+        Return the number of distinct users with an open WebSocket to the chat session.
+        """
+        chat_session = get_object_or_404(ChatSession, id=chat_session_id)
+        allowed, denied_message = check_room_access(request.user, chat_session)
+        if not allowed:
+            raise PermissionDenied(denied_message)
+
+        online_count = async_to_sync(get_presence_backend().online_count)(chat_session.id)
+        return Response({'chat_session': chat_session.id, 'online_count': online_count})
+
+class MessageSearchAPIView(APIView):
+    """
+    API view for ranked full-text search over chat messages.
+    Only messages from rooms the logged-in user participates in are returned.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        """
+        Return the messages matching the `q` query parameter, best match first.
+        An optional `limit` parameter lowers the number of results below CHAT_SEARCH_RESULTS_LIMIT.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response([])
+
+        max_results = getattr(settings, 'CHAT_SEARCH_RESULTS_LIMIT', 50)
+        try:
+            limit = min(max(int(request.query_params.get('limit', max_results)), 1), max_results)
+        except ValueError:
+            limit = max_results
+
+        messages = search_messages(request.user, query, limit=limit)
+        return Response(MessageSearchResultSerializer(messages, many=True).data)
+
+class UserSearchAPIView(generics.ListAPIView):
+    """
+    API view for prefix search over users, used to pick the allowed users of a new room.
+    Matches the start of the username or email, case-insensitively, and is cursor-paginated.
+    """
+    serializer_class = UserSearchResultSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = UserCursorPagination
+
+    def get_queryset(self):
+        """
+        Return the active users, other than the logged-in user, whose username or email starts with `q`.
+        The prefix is matched as a range on the lowercased columns rather than with LIKE,
+        so that both lookups are range scans of the user_username_lower_idx and
+        user_email_lower_idx expression indexes.
+        """
+        users = User.objects.annotate(username_lower=Lower('username'), email_lower=Lower('email'))
+        prefix = self.request.query_params.get('q', '').strip().lower()
+        if not prefix:
+            return users.none()
+
+        upper_bound = prefix + chr(0x10FFFF)  # Sorts after every string starting with the prefix
+        return (
+            users.filter(
+                Q(username_lower__gte=prefix, username_lower__lt=upper_bound)
+                | Q(email_lower__gte=prefix, email_lower__lt=upper_bound),
+                is_active=True
+            )
+            .exclude(id=self.request.user.id)
+            .only('id', 'username')
+        )
@@ -8,3 +8,16 @@ class ChatConfig(AppConfig):
     """
     default_auto_field = 'django.db.models.BigAutoField'  # Default auto field type for primary keys
     name = 'chat'  # Name of the app
+
+    def ready(self):
+        """
+        Import signal handlers so that they are connected when the app is ready, and start
+        the expiry timer wheel when rooms expire in process, so that rooms saved before a
+        restart are expired on time too.
+        """
+        import chat.signals  # Connects the cache invalidation handlers
+        from django.conf import settings
+        from .expiry import TIMER, start_timer_wheel
+
+        if getattr(settings, 'CHAT_EXPIRY_SCHEDULER', None) == TIMER:
+            start_timer_wheel()
@@ -0,0 +1,50 @@
+import gzip
+import json
+import os
+from django.conf import settings
+from django.utils import timezone
+from django.utils.text import slugify
+from .models import Message
+
+# Directory under MEDIA_ROOT where archived room transcripts are written
+ARCHIVE_DIR = 'chat_archives'
+
+
+def message_record(message):
+    """
+    Return the archived representation of a message as a JSON-serializable dict.
+    """
+    return {
+        'id': message.id,
+        'chat_session': message.chat_session_id,
+        'seq': message.seq,
+        'user': message.user_id,
+        'username': message.user.username,
+        'message': message.message,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def archive_room(chat_session, chunk_size=None):
+    """
+    Write every message of a chat session to a gzip-compressed NDJSON file under MEDIA_ROOT.
+    Messages are streamed from the database in chunks, so memory use does not depend on
+    the size of the room. Returns the path of the archive file.
+    """
+    chunk_size = chunk_size or getattr(settings, 'CHAT_EXPIRY_MESSAGE_BATCH_SIZE', 1000)
+    directory = os.path.join(settings.MEDIA_ROOT, ARCHIVE_DIR)
+    os.makedirs(directory, exist_ok=True)
+
+    filename = f"{chat_session.id}_{slugify(chat_session.name or '')}_{timezone.now():%Y%m%dT%H%M%S}.ndjson.gz"
+    path = os.path.join(directory, filename)
+
+    messages = (
+        Message.objects.filter(chat_session_id=chat_session.id)
+        .select_related('user')
+        .order_by('timestamp', 'id')
+        .iterator(chunk_size=chunk_size)
+    )
+    with gzip.open(path, 'wt', encoding='utf-8') as archive:
+        for message in messages:
+            archive.write(json.dumps(message_record(message)) + '\n')
+    return path
@@ -0,0 +1,115 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.utils import timezone
+from . import metrics
+from .models import ChatAccessAttempt
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+
+class AccessAttemptBuffer:
+    """
+    In-memory buffer of chat access attempts, written with a single bulk_create
+    once `batch_size` attempts are pending or the oldest one is `flush_interval`
+    seconds old. Recording an attempt is a list append under a lock, and batches are
+    written by a background thread, so room views never pay for an INSERT and a quiet
+    process still writes its attempts within `flush_interval` seconds.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or getattr(settings, 'CHAT_AUDIT_BATCH_SIZE', 100)
+        self.flush_interval = (
+            flush_interval if flush_interval is not None
+            else getattr(settings, 'CHAT_AUDIT_FLUSH_INTERVAL', 5)
+        )
+        self.pending = []  # (user id, room name, success, timestamp), oldest first
+        self._oldest = None  # Monotonic time at which the oldest pending attempt was recorded
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flusher = None  # Background thread writing batches, started on the first attempt
+
+    def record(self, user_id, room_name, success):
+        """
+        Queue an access attempt. The background thread is woken up once the batch is full.
+        """
+        with self._lock:
+            if not self.pending:
+                self._oldest = time.monotonic()
+            self.pending.append((user_id, room_name, success, timezone.now()))
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='chat-audit-flusher', daemon=True)
+                self._flusher.start()
+            if len(self.pending) >= self.batch_size:
+                self._wakeup.notify()
+
+    def _run(self):
+        """
+        Write a batch whenever one is full or its oldest attempt is `flush_interval` seconds old.
+        """
+        while True:
+            with self._lock:
+                while not self.pending:
+                    self._wakeup.wait()
+                age = time.monotonic() - self._oldest
+                if len(self.pending) < self.batch_size and age < self.flush_interval:
+                    self._wakeup.wait(self.flush_interval - age)
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing chat access attempts: {str(e)}")
+            finally:
+                connection.close()  # This thread's connection would otherwise stay open while idle
+
+    def flush(self):
+        """
+        Write every pending attempt to the database. Returns the number of rows written.
+        """
+        with self._lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+
+        # Attempts of users deleted in the meantime cannot be stored
+        user_ids = {user_id for user_id, _, _, _ in batch}
+        existing_ids = set(get_user_model().objects.filter(id__in=user_ids).values_list('id', flat=True))
+        attempts = [
+            ChatAccessAttempt(user_id=user_id, room_name=room_name, success=success, timestamp=timestamp)
+            for user_id, room_name, success, timestamp in batch
+            if user_id in existing_ids
+        ]
+        try:
+            ChatAccessAttempt.objects.bulk_create(attempts)
+        except Exception as e:
+            logger.error(f"Error writing {len(attempts)} chat access attempts: {str(e)}")
+            return 0
+
+        metrics.observe('chat.audit.batch_size', len(attempts))
+        return len(attempts)
+
+
+# Buffer shared by every request handled by this process
+access_attempts = AccessAttemptBuffer()
+
+
+def record_access_attempt(user, room_name, success):
+    """
+    Record an attempt by a user to enter a chat room.
+    """
+    access_attempts.record(user.id, room_name, success)
+
+
+def _flush_on_exit():
+    try:
+        access_attempts.flush()
+    except Exception as e:
+        logger.error(f"Error writing chat access attempts on shutdown: {str(e)}")
+
+
+atexit.register(_flush_on_exit)
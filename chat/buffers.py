@@ -0,0 +1,217 @@
+import asyncio
+import atexit
+import logging
+import time
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import history, metrics, recent, sequence, stats, unread
+from .models import Message
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# Write-behind buffers of the rooms with open connections in this process, keyed by chat session id
+_buffers = {}
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for the messages of a single chat room.
+    Messages are collected in memory and written with a single bulk_create once
+    `max_batch_size` messages are pending or `flush_interval` seconds have passed
+    since the oldest pending message, whichever comes first. Messages are broadcast
+    before they are written, so a batch that fails to write is kept and retried
+    with an exponential backoff, up to `max_retries` times.
+    """
+
+    def __init__(self, chat_session_id, max_batch_size=None, flush_interval=None):
+        self.chat_session_id = chat_session_id
+        self.max_batch_size = max_batch_size or getattr(settings, 'CHAT_MESSAGE_BATCH_SIZE', 50)
+        self.flush_interval = (
+            flush_interval if flush_interval is not None
+            else getattr(settings, 'CHAT_MESSAGE_FLUSH_INTERVAL', 0.25)
+        )
+        self.max_retries = getattr(settings, 'CHAT_MESSAGE_FLUSH_RETRIES', 5)
+        self.retry_delay = getattr(settings, 'CHAT_MESSAGE_RETRY_DELAY', 0.5)  # Doubled after each failed attempt
+        self.pending = []  # Unsaved Message instances, oldest first
+        self.failures = 0  # Consecutive failed attempts to write the oldest pending messages
+        self.connections = 0  # Number of open WebSocket connections using this buffer
+        self._timer = None  # Handle of the scheduled time-based flush, if any
+        self._flush_task = None
+        self._lock = asyncio.Lock()  # Keeps batches of the same room written in order
+
+    async def add(self, user, message):
+        """
+        Queue a message from `user` for writing and flush if the batch is full.
+        The timestamp and the room's next sequence number are taken now, so that they
+        reflect when the message was sent, not when the batch happens to be written.
+        The message is added to the room's recent messages before any flush, so that
+        the flush can fill in its id there. Returns the unsaved Message, which can be
+        broadcast right away.
+        """
+        seq = await sequence.next_seq(self.chat_session_id, floor=max((message.seq or 0 for message in self.pending), default=0))
+        pending = Message(
+            chat_session_id=self.chat_session_id,
+            user=user,
+            message=message,
+            timestamp=timezone.now(),
+            seq=seq,
+        )
+        self.pending.append(pending)
+
+        # Keep it in the room's recent messages, from which new connections get their first page
+        await recent.get_recent_backend().append(self.chat_session_id, history.serialize_message(pending))
+
+        # While writes are failing, the retry timer decides when to try again
+        if len(self.pending) >= self.max_batch_size and not self.failures:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._on_timer)
+        return pending
+
+    def _on_timer(self):
+        """
+        Start a flush once the time window of the oldest pending message has elapsed.
+        """
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Write every pending message to the database in one batch.
+        Returns the number of messages written.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, []
+
+            started = time.perf_counter()
+            try:
+                await database_sync_to_async(self.write)(batch)
+            except IntegrityError as e:
+                # A constraint rejected the batch, e.g. a sequence number that was handed out twice;
+                # number the batch again past every stored message before retrying it
+                metrics.incr('chat.buffer.integrity_errors')
+                logger.error(f"Integrity error writing {len(batch)} messages for chat session {self.chat_session_id}: {str(e)}")
+                await self._renumber(batch)
+                self._retry(batch)
+                return 0
+            except Exception as e:
+                metrics.incr('chat.buffer.flush_errors')
+                logger.error(f"Error writing {len(batch)} messages for chat session {self.chat_session_id}: {str(e)}")
+                self._retry(batch)
+                return 0
+            self.failures = 0
+
+            # Entries of the batch in the room's recent messages can now give history cursors
+            await recent.get_recent_backend().assign_ids(
+                self.chat_session_id, {message.seq: message.id for message in batch if message.seq is not None}
+            )
+
+            metrics.observe('chat.buffer.flush_latency_ms', (time.perf_counter() - started) * 1000)
+            metrics.observe('chat.buffer.batch_size', len(batch))
+            metrics.incr('chat.buffer.messages_written', len(batch))
+
+            # A buffer kept for a retry after its last connection closed is no longer needed
+            if self.connections <= 0 and not self.pending and _buffers.get(self.chat_session_id) is self:
+                del _buffers[self.chat_session_id]
+            return len(batch)
+
+    async def _renumber(self, batch):
+        """
+        Give the messages of a batch rejected for a duplicate sequence number new numbers,
+        above the stored ones. Clients that saw the old numbers notice the jump as a gap
+        and resume from the database, where the messages are found under their new numbers.
+        """
+        try:
+            await sequence.advance_past_stored(self.chat_session_id)
+            for message in batch:
+                message.seq = await sequence.next_seq(self.chat_session_id)
+        except Exception as e:
+            logger.error(f"Error renumbering {len(batch)} messages for chat session {self.chat_session_id}: {str(e)}")
+
+    def _retry(self, batch):
+        """
+        Put a batch that failed to write back in front of the pending messages and schedule
+        another attempt, waiting twice as long after each failure. After `max_retries` failed
+        attempts the batch is given up, so that one bad batch cannot block the room forever.
+        """
+        self.failures += 1
+        if self.failures > self.max_retries:
+            metrics.incr('chat.buffer.messages_lost', len(batch))
+            logger.critical(
+                f"Giving up on {len(batch)} messages for chat session {self.chat_session_id} "
+                f"after {self.max_retries} retries; they were broadcast but are not stored"
+            )
+            self.failures = 0
+        else:
+            self.pending = batch + self.pending
+        if self.pending and self._timer is None:
+            delay = self.retry_delay * 2 ** (self.failures - 1) if self.failures else self.flush_interval
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def write(self, batch):
+        """
+        Insert a batch of messages with a single query, then move the room's last
+        message time and sequence number forward and add the batch to its readers'
+        unread counts with one query each. Runs synchronously.
+        """
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            stats.record_messages(
+                self.chat_session_id,
+                max(message.timestamp for message in batch),
+                last_seq=max(message.seq or 0 for message in batch)
+            )
+            unread.record_messages(self.chat_session_id, Counter(message.user_id for message in batch))
+
+
+def acquire_buffer(chat_session_id):
+    """
+    Return the write-behind buffer of a room, creating it if needed,
+    and register one more connection as using it.
+    """
+    buffer = _buffers.get(chat_session_id)
+    if buffer is None:
+        buffer = _buffers[chat_session_id] = MessageBuffer(chat_session_id)
+    buffer.connections += 1
+    return buffer
+
+
+async def release_buffer(buffer):
+    """
+    Flush a buffer when one of its connections closes.
+    The buffer is discarded once its last connection is gone, unless messages
+    that failed to write are still waiting for a retry.
+    """
+    buffer.connections -= 1
+    await buffer.flush()
+    if buffer.connections <= 0 and not buffer.pending and _buffers.get(buffer.chat_session_id) is buffer:
+        del _buffers[buffer.chat_session_id]
+
+
+def flush_all_sync():
+    """
+    Synchronously write whatever is still pending in every buffer.
+    Registered with atexit so that shutting the server down does not lose messages.
+    """
+    for buffer in list(_buffers.values()):
+        batch, buffer.pending = buffer.pending, []
+        if batch:
+            try:
+                buffer.write(batch)
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} messages for chat session {buffer.chat_session_id} on shutdown: {str(e)}")
+
+
+atexit.register(flush_all_sync)
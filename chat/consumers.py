@@ -1,8 +1,24 @@
 import json
+import logging
+import time
+import msgpack
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from accounts.models import User
-from .models import ChatSession, Message
+from django.conf import settings
+from . import acl, buffers, fanout, history, lobby, metrics, moderation, ratelimit, recent, sequence, stats, unread
+from .models import ChatSession
+from .presence import get_presence_backend
+from .queues import SendQueue, RESUME_RESYNC_FRAME
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# WebSocket close code sent when the room of a connection expires
+ROOM_EXPIRED_CLOSE_CODE = 4004
+
+# Subprotocol under which frames are exchanged as binary MessagePack instead of JSON text
+MSGPACK_SUBPROTOCOL = 'msgpack'
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -15,87 +31,455 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         """
         Handle new WebSocket connections.
-        Join the WebSocket connection to the appropriate chat room group.
+        Resolve the authenticated user and the chat room once for the whole connection,
+        then join the WebSocket connection to the appropriate chat room group.
         """
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f"chat_{self.room_name}"
+        self.message_buffer = None
+        self.use_msgpack = False
+        self.ephemeral_sent_at = {}  # Event type -> monotonic time this connection last relayed it
+
+        # Only authenticated users can join; the sender of every message is this user
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # Resolve the room once instead of on every message
+        chat_session = await self.get_chat_session(self.room_name)
+        if chat_session is None:
+            await self.close()
+            return
+        self.chat_session_id = chat_session.id
+        self.is_private = chat_session.is_private
+
+        # Apply the same access rules as the room view
+        allowed, _ = await database_sync_to_async(acl.check_room_access)(self.user, chat_session)
+        if not allowed:
+            await self.close()
+            return
+
+        # Messages are persisted through the room's write-behind buffer
+        self.message_buffer = buffers.acquire_buffer(self.chat_session_id)
 
-        # Add the channel to the chat group
+        # Events fanned out to the room reach this client through a bounded send queue
+        self.send_queue = SendQueue(self.send_frames, self.close, name=self.channel_name)
+
+        # Events for the room are sent to all of its groups; large rooms are sharded over several
+        self.room_groups = fanout.room_groups(self.chat_session_id, chat_session.name)
+        self.room_group_name = fanout.member_group(self.chat_session_id, chat_session.name, self.channel_name)
+
+        # Add the channel to its shard of the chat group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
-        await self.accept()  # Accept the WebSocket connection
+        # Clients offering the msgpack subprotocol get binary MessagePack frames; JSON text is the default
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)  # Accept the WebSocket connection
+
+        # Reconnecting clients pass the last sequence number they saw and only get what they missed;
+        # everyone else starts off with the most recent page of the room's history
+        after_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('after_seq', [None])[-1]
+        if after_seq is not None:
+            await self.resume(after_seq)
+        else:
+            await self.send_history()
+
+        # Announce the user to the room when this is their first open connection to it
+        if await get_presence_backend().join(self.chat_session_id, self.user.id):
+            await self.add_participant()
+            await self.broadcast_presence('join')
 
     async def disconnect(self, close_code):
         """
         Handle WebSocket disconnection.
-        Remove the WebSocket connection from the chat room group.
+        Remove the WebSocket connection from the chat room group
+        and flush any messages still waiting in the room's buffer.
         """
+        if self.message_buffer is None:
+            return  # The connection was rejected in connect()
+
+        self.send_queue.stop()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await buffers.release_buffer(self.message_buffer)
+
+        # Tell the room the user has left once their last connection to it closes
+        if await get_presence_backend().leave(self.chat_session_id, self.user.id):
+            await self.broadcast_presence('leave')
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
-        Receive a message from the WebSocket.
-        Broadcast the message to the chat group and save it to the database.
+        Receive a message from the WebSocket, as JSON text or, on msgpack connections, binary MessagePack.
+        Every frame is an envelope whose `type` selects how it is handled; frames without
+        a type are chat messages. History and resume requests are answered directly, acks
+        move the user's read cursor, typing events are relayed to the room without being stored,
+        and chat messages are moderated, then broadcast to the chat group and queued for saving to the database.
         """
         try:
-            data = json.loads(text_data)
+            data = msgpack.unpackb(bytes_data) if bytes_data is not None else json.loads(text_data)
+        except json.JSONDecodeError as e:
+            # Handle invalid JSON structure
+            logger.warning(f"Invalid JSON received from {self.user.username}: {e}")
+            return
+        except (msgpack.UnpackException, ValueError) as e:
+            # Handle invalid MessagePack frames
+            logger.warning(f"Invalid MessagePack received from {self.user.username}: {e}")
+            return
+
+        try:
+            if not isinstance(data, dict):
+                await self.send_error('invalid_frame', "Frames must be objects.")
+                return
+            event_type = data.get('type', 'message')
+            if event_type == 'message' and not isinstance(data.get('message', ''), str):
+                await self.send_error('invalid_frame', "Messages must be strings.")
+                return
+
+            # A single noisy client must not be able to flood the database and the room
+            if not await ratelimit.allow('user', self.user.id):
+                await self.reject_throttled('user')
+                return
+
+            # "Load older" requests page back through the room's history
+            if event_type == 'history':
+                await self.send_history(before=data.get('before'))
+                return
+
+            # Clients that noticed a gap in the sequence numbers ask for the messages they missed
+            if event_type == 'resume':
+                await self.resume(data.get('after_seq'))
+                return
+
+            # Acks mark everything in the room as read by this user, and tell the room so
+            if event_type == 'ack':
+                await self.mark_read()
+                await self.broadcast_ephemeral('read')
+                return
+
+            if event_type == 'typing':
+                await self.broadcast_ephemeral('typing')
+                return
+
+            if event_type != 'message':
+                await self.send_error('unknown_type', f"Unsupported frame type '{event_type}'.")
+                return
+
             message = data['message']
-            username = data['username']
-            room = data['room']
 
-            # Save the received message to the database
-            await self.save_message(username, room, message)
+            # Frames are bound to the room of this connection
+            if data.get('room', self.room_name) != self.room_name:
+                await self.send_error('room_mismatch', f"This connection belongs to room '{self.room_name}'.")
+                return
+
+            if not await ratelimit.allow('room', self.chat_session_id):
+                await self.reject_throttled('room')
+                return
+
+            # Banned terms are matched in one pass; they are masked, or reject or flag the message
+            verdict = await moderation.moderate(message)
+            if verdict.action == moderation.REJECT:
+                await self.send_error('message_rejected', "Your message contains a term that is not allowed in chat.")
+                return
+            message = verdict.message
+
+            # Queue the received message; it is numbered now and written to the database in batches
+            pending = await self.message_buffer.add(self.user, message)
+            if verdict.action == moderation.FLAG:
+                await database_sync_to_async(moderation.flag)(
+                    self.chat_session_id, self.user, pending.seq, data['message'], verdict.terms
+                )
 
             # Broadcast the message to the chat group
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await fanout.group_send(
+                self.channel_layer,
+                self.room_groups,
                 {
                     'type': 'chat_message',
                     'message': message,
-                    'username': username,
+                    'username': self.user.username,
+                    'seq': pending.seq,
                 }
             )
 
         except KeyError as e:
             # Handle missing fields in the incoming message data
-            print(f"Missing key in message data: {e}")
-        except json.JSONDecodeError as e:
-            # Handle invalid JSON structure
-            print(f"Invalid JSON received: {e}")
+            logger.warning(f"Missing key in message data from {self.user.username}: {e}")
 
     async def chat_message(self, event):
         """
-        Receive a message event from the chat group and send it to WebSocket.
+        Receive a message event from the chat group and queue it for the WebSocket.
         """
         message = event['message']
         username = event['username']
 
-        # Send the message to the WebSocket
-        await self.send(text_data=json.dumps({
+        self.send_queue.put({
             'message': message,
             'username': username,
-        }))
+            'seq': event.get('seq'),
+        })
+
+    async def ephemeral_event(self, event):
+        """
+        Receive a typing or read event from the chat group and queue it for the WebSocket.
+        Pending events of the same type from the same user are coalesced into the latest one.
+        """
+        if event['sender_channel'] == self.channel_name:
+            return  # Clients do not need their own typing indicator or read receipt
+        self.send_queue.put_ephemeral(
+            {'type': event['event'], 'username': event['username']},
+            key=(event['event'], event['username'])
+        )
+
+    async def presence_event(self, event):
+        """
+        Receive a join or leave event from the chat group and queue it for the WebSocket.
+        """
+        self.send_queue.put({
+            'type': 'presence',
+            'event': event['event'],
+            'username': event['username'],
+            'online_count': event['online_count'],
+        })
+
+    async def room_expired(self, event):
+        """
+        Receive the expiry of the room from the chat group and close the WebSocket.
+        Anything still queued for the client is dropped, since the room no longer exists.
+        """
+        self.send_queue.stop()
+        await self.send_payload({'type': 'room_expired'})
+        await self.close(code=ROOM_EXPIRED_CLOSE_CODE)
+
+    async def send_frames(self, frames):
+        """
+        Send frames taken from the send queue; several frames are sent as one array.
+        """
+        await self.send_payload(frames[0] if len(frames) == 1 else frames)
+
+    async def send_payload(self, payload):
+        """
+        Send a payload in the encoding negotiated on connect: a binary MessagePack
+        frame, or a JSON text frame by default.
+        """
+        if self.use_msgpack:
+            await self.send(bytes_data=msgpack.packb(payload))
+        else:
+            await self.send(text_data=json.dumps(payload))
 
-    @sync_to_async
-    def save_message(self, username, room, message):
+    async def broadcast_ephemeral(self, event):
+        """
+        Relay an ephemeral event from this connection's user to the chat group, at most
+        once per CHAT_EPHEMERAL_INTERVAL seconds per event type. Nothing is stored.
         """
-        Save a message to the database.
-        This function is run asynchronously to avoid blocking the event loop.
+        now = time.monotonic()
+        last_sent = self.ephemeral_sent_at.get(event)
+        if last_sent is not None and now - last_sent < getattr(settings, 'CHAT_EPHEMERAL_INTERVAL', 1.0):
+            metrics.incr('chat.ephemeral.throttled')
+            return
+        self.ephemeral_sent_at[event] = now
+
+        await fanout.group_send(
+            self.channel_layer,
+            self.room_groups,
+            {
+                'type': 'ephemeral_event',
+                'event': event,
+                'username': self.user.username,
+                'sender_channel': self.channel_name,
+            }
+        )
+
+    async def broadcast_presence(self, event):
+        """
+        Send a join or leave event for this connection's user to the chat group,
+        and store the new online count for the chat lobby. Open lobby pages are sent
+        the new count of public rooms right away.
+        """
+        online_count = await get_presence_backend().online_count(self.chat_session_id)
+        await database_sync_to_async(stats.set_online_count)(self.chat_session_id, online_count)
+        if not self.is_private:
+            await lobby.room_updated(self.chat_session_id, online_count=online_count)
+        await fanout.group_send(
+            self.channel_layer,
+            self.room_groups,
+            {
+                'type': 'presence_event',
+                'event': event,
+                'username': self.user.username,
+                'online_count': online_count,
+            }
+        )
+
+    async def send_history(self, before=None):
+        """
+        Send one page of the room's history, ending just before the `before` cursor.
+        The latest page is served from the room's recent messages when they can answer it;
+        otherwise, and for older pages, pending messages of this room are flushed first
+        so that the page read from the database includes them. A latest page read from
+        the database primes the recent messages, so that later joins skip the database.
+        """
+        page = await recent.latest_page(self.chat_session_id) if before is None else None
+        if page is not None:
+            metrics.incr('chat.history.recent')
+            messages, next_cursor = page
+        else:
+            metrics.incr('chat.history.database')
+            await self.message_buffer.flush()
+            try:
+                messages, next_cursor = await database_sync_to_async(history.fetch_page)(
+                    self.chat_session_id, before=before
+                )
+            except ValueError:
+                await self.send_error('invalid_cursor', "The history cursor is not valid.")
+                return
+            if before is None:
+                await recent.get_recent_backend().prime(self.chat_session_id, messages, complete=next_cursor is None)
+
+        await self.send_payload({
+            'type': 'history',
+            'messages': messages,
+            'next_cursor': next_cursor,
+        })
+
+    async def resume(self, after_seq):
+        """
+        Send the messages of the room numbered above `after_seq`, oldest first.
+        They are taken from the room's recent messages when those cover the whole
+        gap, and from the database otherwise. A gap larger than CHAT_RESUME_LIMIT messages
+        is answered with a resync frame, telling the client to reload instead.
         """
         try:
-            # Get user and chat session instances
-            user = User.objects.get(username=username)
-            chat_session = ChatSession.objects.get(name=room)
-
-            # Create a new message record
-            Message.objects.create(chat_session=chat_session, user=user, message=message)
-        except User.DoesNotExist:
-            print(f"User with username {username} does not exist.")
-        except ChatSession.DoesNotExist:
-            print(f"Chat session with room name {room} does not exist.")
+            after_seq = int(after_seq)
+            if after_seq < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            await self.send_error('invalid_seq', "after_seq must be a non-negative integer.")
+            return
+
+        limit = getattr(settings, 'CHAT_RESUME_LIMIT', 500)
+        last_seq = await sequence.current_seq(self.chat_session_id)
+        messages = await recent.messages_after(self.chat_session_id, after_seq, last_seq) if last_seq is not None else None
+        if messages is not None:
+            metrics.incr('chat.resume.recent')
+        else:
+            # Pending messages of this room are flushed first so that the database has them
+            metrics.incr('chat.resume.database')
+            await self.message_buffer.flush()
+            messages = await database_sync_to_async(history.fetch_after)(
+                self.chat_session_id, after_seq, limit=limit + 1
+            )
+
+        if len(messages) > limit:
+            metrics.incr('chat.resume.resync')
+            await self.send_payload(RESUME_RESYNC_FRAME)
+            return
+
+        metrics.observe('chat.resume.gap', len(messages))
+        await self.send_payload({
+            'type': 'resume',
+            'messages': messages,
+            'last_seq': messages[-1]['seq'] if messages else after_seq,
+        })
+
+    async def mark_read(self):
+        """
+        Move the user's read cursor to the newest message of the room and reset their unread count.
+        Pending messages of this room are flushed first so that the ack covers them.
+        """
+        await self.message_buffer.flush()
+        await database_sync_to_async(unread.mark_read)(self.user.id, self.chat_session_id)
+
+    async def reject_throttled(self, scope):
+        """
+        Answer a frame dropped by the `scope` rate limit with an error frame, and count it.
+        """
+        metrics.incr('chat.ratelimit.throttled')
+        metrics.incr(f'chat.ratelimit.throttled.{scope}')
+        await self.send_error('rate_limited', f"Too many frames for this {scope}; slow down and try again.")
+
+    async def send_error(self, code, detail):
+        """
+        Send a structured error frame to this WebSocket only.
+        """
+        await self.send_payload({
+            'type': 'error',
+            'error': code,
+            'detail': detail,
+        })
+
+    @database_sync_to_async
+    def get_chat_session(self, room_name):
+        """
+        Return the chat session with the given name, or None.
+        Only the fields needed for access control are loaded.
+        """
+        return ChatSession.objects.filter(name=room_name).only('id', 'name', 'is_private').first()
+
+    @database_sync_to_async
+    def add_participant(self):
+        """
+        Record the user as a participant of the room the first time they join it.
+        """
+        chat_session = ChatSession(id=self.chat_session_id)
+        if not chat_session.participants.filter(id=self.user.id).exists():
+            chat_session.participants.add(self.user.id)
+
+
+class LobbyConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer pushing changes to the list of rooms to open chat lobby pages:
+    rooms created, deleted or expired, and new statistics of listed rooms. Pages apply
+    these as diffs instead of being reloaded. The lobby is push-only; frames sent by
+    clients are ignored.
+    """
+
+    async def connect(self):
+        """
+        Join authenticated users to the lobby group.
+        """
+        self.send_queue = None
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # Lobby events reach the client through a bounded send queue, like room events
+        self.send_queue = SendQueue(self.send_frames, self.close, name=self.channel_name)
+        await self.channel_layer.group_add(lobby.LOBBY_GROUP, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        """
+        Leave the lobby group.
+        """
+        if self.send_queue is None:
+            return  # The connection was rejected in connect()
+        self.send_queue.stop()
+        await self.channel_layer.group_discard(lobby.LOBBY_GROUP, self.channel_name)
+
+    async def lobby_event(self, event):
+        """
+        Receive a lobby event and queue it for the WebSocket, unless it concerns a private
+        room this user is not allowed in. Pending updates of the same room are coalesced
+        into the latest one, and shed first under load.
+        """
+        allowed_user_ids = event.get('allowed_user_ids')
+        if allowed_user_ids is not None and self.user.id not in allowed_user_ids:
+            return
+
+        frame = {'type': event['event'], 'room': event['room']}
+        if event['event'] == lobby.ROOM_UPDATED:
+            self.send_queue.put_ephemeral(frame, key=event['room']['id'])
+        else:
+            self.send_queue.put(frame)
+
+    async def send_frames(self, frames):
+        """
+        Send frames taken from the send queue; several frames are sent as one array.
+        """
+        await self.send(text_data=json.dumps(frames[0] if len(frames) == 1 else frames))
@@ -0,0 +1,166 @@
+import logging
+import math
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# Expiry schedulers
+CELERY = 'celery'  # One Celery task per room with an ETA at its expiry time
+TIMER = 'timer'  # In-process timer wheel, for single-node deployments without a Celery worker
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel holding one timer per key.
+    Time is divided into ticks; each slot of the wheel holds the timers due at that
+    position, together with the number of full turns left before they fire. Scheduling,
+    rescheduling and cancelling are O(1), and each tick only looks at one slot.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick  # Seconds per tick
+        self.slots = [{} for _ in range(slots)]  # Per slot: key -> [remaining turns, callback]
+        self.positions = {}  # key -> index of the slot holding its timer
+        self.current = 0  # Index of the slot handled by the last tick
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, key, when, callback):
+        """
+        Call `callback` once the datetime `when` has passed, replacing any timer already set for `key`.
+        """
+        delay = (when - timezone.now()).total_seconds()
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self._lock:
+            self._remove(key)
+            position = (self.current + ticks) % len(self.slots)
+            self.slots[position][key] = [(ticks - 1) // len(self.slots), callback]
+            self.positions[key] = position
+
+    def cancel(self, key):
+        """
+        Cancel the timer set for `key`, if any.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is not None:
+            self.slots[position].pop(key, None)
+
+    def advance(self):
+        """
+        Move the wheel forward by one tick and run the callbacks that became due.
+        """
+        due = []
+        with self._lock:
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            for key, timer in list(slot.items()):
+                if timer[0] > 0:
+                    timer[0] -= 1
+                    continue
+                del slot[key]
+                del self.positions[key]
+                due.append(timer[1])
+
+        for callback in due:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error running expiry timer: {str(e)}")
+
+    def has(self, key):
+        """
+        Return whether a timer is set for `key`.
+        """
+        with self._lock:
+            return key in self.positions
+
+    def start(self, on_start=None):
+        """
+        Start ticking in a daemon thread, unless already started.
+        `on_start` is called from that thread before the first tick.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(on_start,), name='chat-expiry-wheel', daemon=True)
+                self._thread.start()
+
+    def _run(self, on_start):
+        if on_start is not None:
+            try:
+                on_start()
+            except Exception as e:
+                logger.error(f"Error starting expiry timer wheel: {str(e)}")
+            finally:
+                close_old_connections()
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            self.advance()
+            close_old_connections()  # Callbacks use the ORM from this thread
+
+
+# Timer wheel used by the TIMER scheduler, started on first use
+timer_wheel = TimerWheel()
+
+
+def schedule_room_expiry(chat_session_id, expiry_time):
+    """
+    Schedule the expiry of a chat session at exactly `expiry_time`.
+    Rescheduling a room simply schedules it again: the timer wheel replaces the previous
+    timer, and a Celery task finding that the room's expiry time has changed does nothing.
+    """
+    from .tasks import expire_room
+
+    expiry = expiry_time.isoformat()
+    scheduler = getattr(settings, 'CHAT_EXPIRY_SCHEDULER', CELERY)
+    if scheduler == TIMER:
+        timer_wheel.schedule(chat_session_id, expiry_time, lambda: expire_room(chat_session_id, expiry))
+        start_timer_wheel()
+        return
+
+    try:
+        expire_room.apply_async(args=[chat_session_id, expiry], eta=expiry_time)
+    except Exception as e:
+        # The periodic delete_expired_rooms scan still removes the room
+        logger.error(f"Error scheduling expiry of chat session {chat_session_id}: {str(e)}")
+
+
+def schedule_pending_expiries(wheel=None):
+    """
+    Set a timer for every chat session with an expiry time, on a wheel that has just started.
+    Timers only live in memory, so after a restart rooms would otherwise wait for the
+    delete_expired_rooms scan, which may not run at all without a Celery worker. Rooms
+    that expired while the process was down are removed on the next tick.
+    Returns the number of timers set.
+    """
+    from .models import ChatSession
+    from .tasks import expire_room
+
+    wheel = wheel or timer_wheel
+    scheduled = 0
+    rooms = ChatSession.objects.filter(expiry_time__isnull=False).values_list('id', 'expiry_time')
+    for chat_session_id, expiry_time in rooms.iterator():
+        if wheel.has(chat_session_id):
+            continue  # Scheduled by a save since the wheel started; that timer is newer
+        expiry = expiry_time.isoformat()
+        wheel.schedule(chat_session_id, expiry_time, lambda id=chat_session_id, expiry=expiry: expire_room(id, expiry))
+        scheduled += 1
+    logger.info(f"Scheduled the expiry of {scheduled} chat sessions on the timer wheel.")
+    return scheduled
+
+
+def start_timer_wheel():
+    """
+    Start the timer wheel of this process, scheduling the pending expiries first.
+    """
+    timer_wheel.start(on_start=schedule_pending_expiries)
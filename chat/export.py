@@ -0,0 +1,71 @@
+import csv
+import json
+from django.conf import settings
+from . import segments
+from .archive import message_record
+from .models import Message
+
+# Export formats: format name -> (content type, file extension)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+# Columns of a CSV export, in order
+CSV_FIELDS = ['id', 'chat_session', 'seq', 'user', 'username', 'message', 'timestamp']
+
+
+class Echo:
+    """
+    File-like object whose write() returns the value written, so that csv.writer
+    produces one line at a time instead of accumulating them in a buffer.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_records(chat_session, start=None, end=None, chunk_size=None):
+    """
+    Yield the records of a chat session's messages, oldest first, optionally limited
+    to those sent at or after `start` and before `end`.
+    Messages moved to segments come first, read one file at a time; the rest are fetched
+    from a server-side cursor in chunks, so memory use does not depend on the size of the room.
+    """
+    yield from segments.iter_records(chat_session.id, start=start, end=end)
+
+    chunk_size = chunk_size or getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+    messages = Message.objects.filter(chat_session_id=chat_session.id)
+    if start is not None:
+        messages = messages.filter(timestamp__gte=start)
+    if end is not None:
+        messages = messages.filter(timestamp__lt=end)
+    for message in messages.select_related('user').order_by('timestamp', 'id').iterator(chunk_size=chunk_size):
+        yield message_record(message)
+
+
+def ndjson_lines(records):
+    """
+    Yield one JSON document per message record, each on its own line.
+    """
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(records):
+    """
+    Yield a CSV header followed by one row per message record.
+    """
+    writer = csv.DictWriter(Echo(), fieldnames=CSV_FIELDS)
+    yield writer.writeheader()
+    for record in records:
+        yield writer.writerow(record)
+
+
+def export_lines(export_format, records):
+    """
+    Yield the lines of an export in the given format.
+    """
+    if export_format == 'csv':
+        return csv_lines(records)
+    return ndjson_lines(records)
@@ -0,0 +1,49 @@
+import asyncio
+import zlib
+from django.conf import settings
+
+
+def room_group_name(chat_session_id):
+    """
+    Return the channel layer group of a chat room.
+    Group names are derived from the primary key, since room names may contain
+    characters (such as spaces) that channel layer group names do not allow.
+    """
+    return f"chat_{chat_session_id}"
+
+
+def shard_count(room_name):
+    """
+    Return the number of groups the members of a room are spread over,
+    as configured by CHAT_FANOUT_SHARDS; rooms not listed use a single group.
+    """
+    return max(1, getattr(settings, 'CHAT_FANOUT_SHARDS', {}).get(room_name, 1))
+
+
+def room_groups(chat_session_id, room_name):
+    """
+    Return every channel layer group of a room; an event for the room is sent to each of them.
+    """
+    shards = shard_count(room_name)
+    if shards == 1:
+        return [room_group_name(chat_session_id)]
+    return [f"{room_group_name(chat_session_id)}.{shard}" for shard in range(shards)]
+
+
+def member_group(chat_session_id, room_name, channel_name):
+    """
+    Return the group a connection joins: one of the room's groups, chosen by a stable
+    hash of its channel name so that members spread evenly over the shards.
+    """
+    groups = room_groups(chat_session_id, room_name)
+    return groups[zlib.crc32(channel_name.encode()) % len(groups)]
+
+
+async def group_send(channel_layer, groups, event):
+    """
+    Send an event to each group of a room concurrently.
+    With channels_redis, each group is a separate key placed on one of the layer's hosts
+    by hashing its name, so a large room's fanout is split into smaller sends that are
+    spread over every configured Redis host instead of all landing on one key.
+    """
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
@@ -1,8 +1,37 @@
 from django import forms
+from django.urls import reverse
 from .models import ChatSession
 from accounts.models import User
 
 
+class UserAutocompleteWidget(forms.SelectMultiple):
+    """
+    Widget for picking users by searching for them instead of listing every user.
+    Only the selected users are rendered, as the selected options of a hidden select;
+    the search box asks the user search API for matches and adds the picked ones,
+    so the form only ever submits the selected ids.
+    """
+    template_name = 'chat/widgets/user_autocomplete.html'
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['search_url'] = reverse('chat:user_search')
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        """
+        Return one option per selected user, loading only those users.
+        """
+        selected_ids = [user_id for user_id in value if str(user_id).isdigit()]
+        if not selected_ids:
+            return []
+        users = self.choices.queryset.filter(pk__in=selected_ids).only('id', 'username').order_by('username')
+        return [
+            (None, [self.create_option(name, user.pk, self.choices.field.label_from_instance(user), True, index, attrs=attrs)], index)
+            for index, user in enumerate(users)
+        ]
+
+
 class CreateRoomForm(forms.ModelForm):
     """
     Form for creating a new chat room.
@@ -10,9 +39,9 @@ class CreateRoomForm(forms.ModelForm):
     """
 
     allowed_users = forms.ModelMultipleChoiceField(
-        queryset=User.objects.all(),  # Queryset for selecting users
+        queryset=User.objects.all(),  # Queryset for selecting users; only the submitted ids are ever loaded
         required=False,  # Field is optional
-        widget=forms.CheckboxSelectMultiple  # Use checkboxes for selection
+        widget=UserAutocompleteWidget  # Search for users instead of listing them all
     )
 
     class Meta:
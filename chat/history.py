@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from . import segments
+from .models import Message
+
+
+def encode_cursor(entry):
+    """
+    Encode the keyset position of a serialized history entry as an opaque cursor string.
+    The position is the (timestamp, id) pair the history is ordered by.
+    """
+    return f"{entry['timestamp']}_{entry['id']}"
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor into a (timestamp, id) pair.
+    Raises ValueError if the cursor is malformed.
+    """
+    timestamp, _, message_id = str(cursor).rpartition('_')
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+
+def serialize_message(message):
+    """
+    Return the representation of a stored message sent to WebSocket clients.
+    """
+    return {
+        'id': message.id,
+        'username': message.user.username,
+        'message': message.message,
+        'timestamp': message.timestamp.isoformat(),
+        'seq': message.seq,
+    }
+
+
+def fetch_page(chat_session_id, before=None, limit=None):
+    """
+    Return one page of a room's history, ending just before the `before` cursor
+    (or at the newest message when no cursor is given).
+    The page is returned oldest first, together with the cursor of the next older page,
+    which is None once the beginning of the room is reached.
+
+    Pages are selected with a keyset condition on (timestamp, id) rather than an offset,
+    so every page is a bounded range scan of the (chat_session, timestamp, id) index.
+    Once the messages left in the database run out, the page continues into the room's
+    segments, where older messages are moved by the tiering job.
+    """
+    limit = limit or getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    messages = Message.objects.filter(chat_session_id=chat_session_id)
+
+    position = decode_cursor(before) if before is not None else None
+    if position is not None:
+        timestamp, message_id = position
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+    page = list(messages.select_related('user').order_by('-timestamp', '-id')[:limit + 1])
+    has_more = len(page) > limit
+    page = [serialize_message(message) for message in page[:limit]]  # Newest first
+
+    if not has_more:
+        # Continue from the oldest message found into the segments, which only hold older messages
+        if page:
+            position = (datetime.fromisoformat(page[-1]['timestamp']), page[-1]['id'])
+        wanted = limit - len(page)
+        older = segments.fetch_older(chat_session_id, before=position, limit=wanted + 1)
+        has_more = len(older) > wanted
+        page.extend({key: record.get(key) for key in ('id', 'username', 'message', 'timestamp', 'seq')} for record in older[:wanted])
+
+    page.reverse()
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
+
+
+def fetch_after(chat_session_id, after_seq, limit=None):
+    """
+    Return up to `limit` messages of a room numbered above `after_seq`, oldest first.
+    The result stops at a missing number that may still be waiting in the buffer of
+    another server process, so that a client resuming from the last number returned
+    does not skip it. Numbers are handed out in sending order, so once the message
+    after a gap was sent more than CHAT_RESUME_GAP_TIMEOUT seconds ago, the missing ones
+    are taken as lost for good, e.g. given up after their retries or deleted, and skipped.
+    """
+    limit = limit or getattr(settings, 'CHAT_RESUME_LIMIT', 500)
+    lost_before = timezone.now() - timedelta(seconds=getattr(settings, 'CHAT_RESUME_GAP_TIMEOUT', 30))
+    messages = (
+        Message.objects.filter(chat_session_id=chat_session_id, seq__gt=after_seq)
+        .select_related('user')
+        .order_by('seq')[:limit]
+    )
+
+    entries, next_seq = [], after_seq + 1
+    for message in messages:
+        if message.seq != next_seq and message.timestamp > lost_before:
+            break
+        entries.append(serialize_message(message))
+        next_seq = message.seq + 1
+    return entries
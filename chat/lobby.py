@@ -0,0 +1,79 @@
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.urls import reverse
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# Channel layer group joined by every open chat lobby page
+LOBBY_GROUP = 'chat_lobby'
+
+# Lobby events
+ROOM_CREATED = 'room_created'
+ROOM_DELETED = 'room_deleted'
+ROOM_EXPIRED = 'room_expired'
+ROOM_UPDATED = 'room_updated'
+
+
+def room_entry(chat_session):
+    """
+    Return the representation of a new room sent to lobby pages, with what a lobby row shows.
+    """
+    return {
+        'id': chat_session.id,
+        'name': chat_session.name,
+        'url': reverse('chat:room', args=[chat_session.name]),
+        'is_private': chat_session.is_private,
+        'participant_count': chat_session.participants.count(),
+        'online_count': 0,  # Nobody has joined a new room yet
+    }
+
+
+def publish(event, room, allowed_user_ids=None):
+    """
+    Send a lobby event to every open lobby page. Events about private rooms carry the ids
+    of the users allowed in, and only reach their lobbies. Failures are logged, so a
+    missing channel layer never breaks the view or task publishing the event.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(LOBBY_GROUP, {
+            'type': 'lobby_event',
+            'event': event,
+            'room': room,
+            'allowed_user_ids': allowed_user_ids,
+        })
+    except Exception as e:
+        logger.error(f"Error publishing {event} for chat session {room.get('id')} to the lobby: {str(e)}")
+
+
+def room_created(chat_session):
+    """
+    Announce a new room, with the users allowed in if it is private.
+    """
+    allowed_user_ids = list(chat_session.allowed_users.values_list('id', flat=True)) if chat_session.is_private else None
+    publish(ROOM_CREATED, room_entry(chat_session), allowed_user_ids)
+
+
+def room_removed(chat_session_id, event):
+    """
+    Announce that a room was deleted by its creator (ROOM_DELETED) or expired (ROOM_EXPIRED).
+    Only the id is sent, which lobbies that do not list the room simply ignore.
+    """
+    publish(event, {'id': chat_session_id})
+
+
+async def room_updated(chat_session_id, **counts):
+    """
+    Send the new statistics of a public room, e.g. its online count, to the lobby.
+    Called from the chat consumer, so the event is sent without leaving the event loop.
+    """
+    try:
+        await get_channel_layer().group_send(LOBBY_GROUP, {
+            'type': 'lobby_event',
+            'event': ROOM_UPDATED,
+            'room': {'id': chat_session_id, **counts},
+            'allowed_user_ids': None,
+        })
+    except Exception as e:
+        logger.error(f"Error publishing {ROOM_UPDATED} for chat session {chat_session_id} to the lobby: {str(e)}")
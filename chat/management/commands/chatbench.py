@@ -0,0 +1,241 @@
+import asyncio
+import json
+import time
+import uuid
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from chat import metrics
+from chat.consumers import MSGPACK_SUBPROTOCOL
+from chat.expiry import TIMER
+from chat.models import ChatSession, Message
+from chat.routing import websocket_urlpatterns
+
+User = get_user_model()
+
+# Prefix of the users and rooms created for a benchmark run; they are deleted afterwards
+BENCH_PREFIX = 'chatbench'
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Rate limits used unless --rate-limit is given, so that throughput is not capped by the buckets
+NO_RATE_LIMITS = {'user': None, 'room': None}
+
+
+class Command(BaseCommand):
+    help = (
+        'Drives simulated WebSocket clients through ChatConsumer and reports message throughput, '
+        'end-to-end fanout latency, database write rate, bytes on the wire and CPU per message as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=20, help='Number of simulated clients.')
+        parser.add_argument('--rooms', type=int, default=2, help='Number of rooms the clients are spread over.')
+        parser.add_argument('--messages', type=int, default=10, help='Messages sent by each client.')
+        parser.add_argument(
+            '--layer', choices=['memory', 'redis'], default='memory',
+            help="Channel layer to run against: an in-memory layer, or the Redis layer from CHANNEL_LAYERS."
+        )
+        parser.add_argument(
+            '--encoding', choices=['json', 'msgpack'], default='json',
+            help='Frame encoding: JSON text frames, or binary MessagePack frames through the msgpack subprotocol.'
+        )
+        parser.add_argument(
+            '--rate-limit', action='store_true',
+            help='Apply CHAT_RATE_LIMITS to the simulated clients; by default they are not limited.'
+        )
+        parser.add_argument(
+            '--shards', type=int, default=1,
+            help='Number of channel layer groups each benchmark room is sharded over (see CHAT_FANOUT_SHARDS).'
+        )
+        parser.add_argument(
+            '--sweep', help=(
+                'Comma-separated room sizes. Runs one single-room benchmark per size, unsharded and '
+                'with --shards groups, and reports fanout latency for each instead of a single report.'
+            )
+        )
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for every delivery.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        if options['sweep']:
+            report = []
+            for size in [int(size) for size in options['sweep'].split(',')]:
+                for shards in sorted({1, options['shards']}):
+                    run = self._benchmark({**options, 'clients': size, 'rooms': 1, 'shards': shards})
+                    report.append({
+                        'clients': size,
+                        'shards': shards,
+                        'deliveries': run['deliveries'],
+                        'deliveries_per_sec': run['deliveries_per_sec'],
+                        'fanout_latency_ms': run['fanout_latency_ms'],
+                    })
+        else:
+            report = self._benchmark(options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+    def _benchmark(self, options):
+        """
+        Run one benchmark with its own users and rooms, and return its report.
+        """
+        run_id = uuid.uuid4().hex[:8]
+        users, rooms = self._create_fixtures(run_id, options['clients'], options['rooms'])
+        overrides = {'CHAT_FANOUT_SHARDS': {room.name: options['shards'] for room in rooms}}
+        if options['layer'] == 'memory':
+            overrides['CHANNEL_LAYERS'] = IN_MEMORY_CHANNEL_LAYERS
+        if not options['rate_limit']:
+            overrides['CHAT_RATE_LIMITS'] = NO_RATE_LIMITS
+        try:
+            with override_settings(**overrides):
+                report = async_to_sync(self._run)(users, rooms, options)
+            report['db_rows'] = Message.objects.filter(chat_session__in=rooms).count()
+        finally:
+            self._delete_fixtures(run_id)
+        return report
+
+    def _create_fixtures(self, run_id, client_count, room_count):
+        """
+        Create the users and rooms of a run. Client i joins room i % room_count.
+        """
+        User.objects.bulk_create([
+            User(username=f'{BENCH_PREFIX}_{run_id}_{index}', password='!')
+            for index in range(client_count)
+        ])
+        users = list(User.objects.filter(username__startswith=f'{BENCH_PREFIX}_{run_id}_').order_by('id'))
+        # Benchmark rooms are deleted long before they expire; keep their expiry in process
+        # rather than scheduling Celery tasks, which would need a reachable broker
+        with override_settings(CHAT_EXPIRY_SCHEDULER=TIMER):
+            rooms = [
+                ChatSession.objects.create(name=f'{BENCH_PREFIX}_{run_id}_room{index}', created_by=users[0])
+                for index in range(room_count)
+            ]
+        return users, rooms
+
+    def _delete_fixtures(self, run_id):
+        ChatSession.objects.filter(name__startswith=f'{BENCH_PREFIX}_{run_id}_').delete()
+        User.objects.filter(username__startswith=f'{BENCH_PREFIX}_{run_id}_').delete()
+
+    async def _run(self, users, rooms, options):
+        """
+        Connect every client, have each send its messages, and wait until every
+        member of each room has received every message sent to it.
+        """
+        metrics.reset()
+        application = URLRouter(websocket_urlpatterns)
+        clients = []
+        for index, user in enumerate(users):
+            room = rooms[index % len(rooms)]
+            subprotocols = [MSGPACK_SUBPROTOCOL] if options['encoding'] == 'msgpack' else None
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room.name}/', subprotocols=subprotocols)
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f"Client {user.username} could not connect to {room.name}.")
+            clients.append({'communicator': communicator, 'room': room.name, 'encoding': options['encoding']})
+
+        # Every client expects every message sent to its room, including its own
+        members = {room.name: 0 for room in rooms}
+        for client in clients:
+            members[client['room']] += 1
+        sent_at = {}
+        latencies = []
+        wire = {'sent': 0, 'received': 0}  # Bytes of frame payloads in each direction
+
+        receivers = [
+            asyncio.ensure_future(self._receive(
+                client, members[client['room']] * options['messages'], sent_at, latencies, wire
+            ))
+            for client in clients
+        ]
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        for sequence in range(options['messages']):
+            for index, client in enumerate(clients):
+                token = f'{BENCH_PREFIX}:{index}:{sequence}'
+                sent_at[token] = time.perf_counter()
+                await self._send(client, {'message': token}, wire)
+            await asyncio.sleep(0)  # Let deliveries interleave with sending
+
+        done, pending = await asyncio.wait(receivers, timeout=options['timeout'])
+        for receiver in pending:
+            receiver.cancel()
+        elapsed = time.perf_counter() - started
+        cpu_elapsed = time.process_time() - cpu_started
+
+        # Disconnecting flushes the write-behind buffers, so the write rate covers every message
+        for client in clients:
+            await client['communicator'].disconnect()
+        write_elapsed = time.perf_counter() - started
+
+        snapshot = metrics.snapshot()
+        messages_sent = len(clients) * options['messages']
+        messages_written = snapshot['counters'].get('chat.buffer.messages_written', 0)
+        return {
+            'layer': options['layer'],
+            'clients': len(clients),
+            'rooms': len(rooms),
+            'shards': options['shards'],
+            'messages_sent': messages_sent,
+            'deliveries': len(latencies),
+            'timed_out_clients': len(pending),
+            'duration_s': round(elapsed, 4),
+            'msgs_per_sec': round(messages_sent / elapsed, 2),
+            'deliveries_per_sec': round(len(latencies) / elapsed, 2),
+            'fanout_latency_ms': metrics.summarize(latencies),
+            'db_writes_per_sec': round(messages_written / write_elapsed, 2),
+            'db_batch_size': snapshot['observations'].get('chat.buffer.batch_size', {'count': 0}),
+            'db_flush_latency_ms': snapshot['observations'].get('chat.buffer.flush_latency_ms', {'count': 0}),
+            'throttled_frames': snapshot['counters'].get('chat.ratelimit.throttled', 0),
+            'encoding': options['encoding'],
+            'bytes_sent': wire['sent'],
+            'bytes_received': wire['received'],
+            'bytes_per_delivery': round(wire['received'] / len(latencies), 2) if latencies else None,
+            # Clients and server share this process, so this covers encoding and decoding on both sides
+            'cpu_per_message_us': round(cpu_elapsed / messages_sent * 1e6, 2),
+        }
+
+    async def _send(self, client, payload, wire):
+        """
+        Send a frame from one client in its encoding, counting its size.
+        """
+        if client['encoding'] == 'msgpack':
+            frame = msgpack.packb(payload)
+            await client['communicator'].send_to(bytes_data=frame)
+        else:
+            frame = json.dumps(payload)
+            await client['communicator'].send_to(text_data=frame)
+        wire['sent'] += len(frame)
+
+    async def _receive(self, client, expected, sent_at, latencies, wire):
+        """
+        Read frames for one client until it has seen `expected` benchmark messages,
+        recording the latency of each from the moment it was sent.
+        """
+        received = 0
+        while received < expected:
+            output = await client['communicator'].receive_output(timeout=None)
+            if output['type'] != 'websocket.send':
+                raise RuntimeError(f"Client was disconnected: {output}")
+            if output.get('bytes') is not None:
+                wire['received'] += len(output['bytes'])
+                payload = msgpack.unpackb(output['bytes'])
+            else:
+                wire['received'] += len(output['text'].encode())
+                payload = json.loads(output['text'])
+            for frame in payload if isinstance(payload, list) else [payload]:
+                token = frame.get('message')
+                if isinstance(token, str) and token in sent_at:
+                    latencies.append((time.perf_counter() - sent_at[token]) * 1000)
+                    received += 1
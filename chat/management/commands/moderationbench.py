@@ -0,0 +1,102 @@
+import json
+import random
+import re
+import string
+import time
+from django.core.management.base import BaseCommand
+from chat import metrics
+from chat.moderation import MASK, TermAutomaton
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the moderation automaton against a generated term list and reports build time '
+        'and per-message matching cost as JSON, optionally next to one regular expression per term.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--terms', type=int, default=10000, help='Number of generated banned terms.')
+        parser.add_argument('--messages', type=int, default=2000, help='Number of generated messages to moderate.')
+        parser.add_argument('--words', type=int, default=30, help='Words per generated message.')
+        parser.add_argument(
+            '--hit-rate', type=float, default=0.1,
+            help='Fraction of messages containing a banned term.'
+        )
+        parser.add_argument(
+            '--regex-messages', type=int, default=0,
+            help='Also time one compiled regular expression per term over this many of the messages.'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated terms and messages.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        terms = self._words(rng, options['terms'], prefix='x')
+        vocabulary = self._words(rng, 5000, prefix='')
+        messages = []
+        for _ in range(options['messages']):
+            words = [rng.choice(vocabulary) for _ in range(options['words'])]
+            if rng.random() < options['hit_rate']:
+                words[rng.randrange(len(words))] = rng.choice(terms)
+            messages.append(' '.join(words))
+
+        started = time.perf_counter()
+        automaton = TermAutomaton({term: MASK for term in terms})
+        build_ms = (time.perf_counter() - started) * 1000
+
+        timings, matched = [], 0
+        started = time.perf_counter()
+        for message in messages:
+            message_started = time.perf_counter()
+            verdict = automaton.moderate(message)
+            timings.append((time.perf_counter() - message_started) * 1e6)
+            matched += verdict.action is not None
+        elapsed = time.perf_counter() - started
+
+        report = {
+            'terms': len(terms),
+            'automaton_states': len(automaton.goto),
+            'build_ms': round(build_ms, 2),
+            'messages': len(messages),
+            'message_chars': metrics.summarize([len(message) for message in messages]),
+            'matched_messages': matched,
+            'msgs_per_sec': round(len(messages) / elapsed, 2),
+            'per_message_us': metrics.summarize(timings),
+        }
+        if options['regex_messages']:
+            report['regex_per_term'] = self._regex_baseline(terms, messages[:options['regex_messages']])
+            report['speedup_p50'] = round(report['regex_per_term']['per_message_us']['p50'] / report['per_message_us']['p50'], 1)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+    def _words(self, rng, count, prefix):
+        """
+        Generate `count` distinct lowercase words of 4 to 10 letters.
+        """
+        words = set()
+        while len(words) < count:
+            words.add(prefix + ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))))
+        return sorted(words)
+
+    def _regex_baseline(self, terms, messages):
+        """
+        Time the approach the automaton replaces: one whole-word, case-insensitive
+        regular expression per term, each searched over every message.
+        """
+        started = time.perf_counter()
+        patterns = [re.compile(rf'\b{re.escape(term)}\b', re.IGNORECASE) for term in terms]
+        build_ms = (time.perf_counter() - started) * 1000
+
+        timings = []
+        for message in messages:
+            message_started = time.perf_counter()
+            for pattern in patterns:
+                pattern.search(message)
+            timings.append((time.perf_counter() - message_started) * 1e6)
+        return {'build_ms': round(build_ms, 2), 'messages': len(messages), 'per_message_us': metrics.summarize(timings)}
@@ -0,0 +1,93 @@
+import threading
+from collections import defaultdict, deque
+
+# Number of recent observations kept per metric when computing percentiles
+SAMPLE_WINDOW = 1024
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_samples = defaultdict(lambda: deque(maxlen=SAMPLE_WINDOW))
+
+
+def incr(name, amount=1):
+    """
+    Increment the counter called `name` by `amount`.
+    """
+    with _lock:
+        _counters[name] += amount
+
+
+def gauge(name, value):
+    """
+    Record the current value of the gauge called `name`.
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def remove_gauge(name):
+    """
+    Stop reporting the gauge called `name`, e.g. once what it measures is gone.
+    """
+    with _lock:
+        _gauges.pop(name, None)
+
+
+def observe(name, value):
+    """
+    Record one observation (e.g. a latency or a batch size) for `name`.
+    Only the most recent SAMPLE_WINDOW observations are kept.
+    """
+    with _lock:
+        _samples[name].append(value)
+
+
+def _percentile(ordered, fraction):
+    """
+    Return the value at the given fraction of an already sorted list.
+    """
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    """
+    Summarize a list of observations into count, mean, p50, p95, p99 and max.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': _percentile(ordered, 0.50),
+        'p95': _percentile(ordered, 0.95),
+        'p99': _percentile(ordered, 0.99),
+        'max': ordered[-1],
+    }
+
+
+def snapshot():
+    """
+    Return a point-in-time copy of every counter, gauge and observation summary.
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        samples = {name: list(values) for name, values in _samples.items()}
+    return {
+        'counters': counters,
+        'gauges': gauges,
+        'observations': {name: summarize(values) for name, values in samples.items()},
+    }
+
+
+def reset():
+    """
+    Clear all recorded metrics. Mainly useful for tests and benchmarks.
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _samples.clear()
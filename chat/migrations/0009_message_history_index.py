@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-18 18:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_msg_session_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1 on 2026-10-18 18:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatAccessRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('room_name', models.CharField(max_length=255)),
+                ('success_count', models.PositiveIntegerField(default=0)),
+                ('denied_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Chat Access Rollup',
+                'verbose_name_plural': 'Chat Access Rollups',
+                'ordering': ['-hour'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='chataccessattempt',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chataccessattempt',
+            index=models.Index(fields=['timestamp'], name='chat_access_ts_idx'),
+        ),
+        migrations.AddField(
+            model_name='chataccessrollup',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chataccessrollup',
+            index=models.Index(fields=['room_name', 'hour'], name='chat_chatac_room_na_a41413_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='chataccessrollup',
+            constraint=models.UniqueConstraint(fields=('hour', 'room_name', 'user'), name='chat_access_rollup_unique'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 18:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_access_attempt_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatsession',
+            name='expiry_time',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
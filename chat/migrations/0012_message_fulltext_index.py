@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# SQLite: an external-content FTS5 table over chat_message.message, kept in sync by triggers.
+# Triggers fire for every insert, including bulk_create, and for deletes done by cascades.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5(message, content='chat_message', content_rowid='id')",
+    """CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF message ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+# PostgreSQL: a GIN expression index, which the database keeps in sync by itself
+POSTGRES_FORWARD = [
+    "CREATE INDEX chat_message_fts_idx ON chat_message USING GIN (to_tsvector('english', message))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS chat_message_fts_idx",
+]
+
+
+def create_fulltext_index(apps, schema_editor):
+    statements = {'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_fulltext_index(apps, schema_editor):
+    statements = {'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_chatsession_expiry_time_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
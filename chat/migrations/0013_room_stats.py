@@ -0,0 +1,46 @@
+# Generated by Django 5.1 on 2026-10-18 18:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def create_room_stats(apps, schema_editor):
+    """
+    Create the statistics row of every existing chat session.
+    Nobody is connected while migrating, so online counts start at zero.
+    """
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    RoomStats = apps.get_model('chat', 'RoomStats')
+    sessions = ChatSession.objects.annotate(
+        participant_count=Count('participants', distinct=True),
+        last_message_at=Max('messages__timestamp'),
+    ).values_list('id', 'participant_count', 'last_message_at')
+    RoomStats.objects.bulk_create(
+        RoomStats(chat_session_id=chat_session_id, participant_count=participant_count, last_message_at=last_message_at)
+        for chat_session_id, participant_count, last_message_at in sessions.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_fulltext_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomStats',
+            fields=[
+                ('chat_session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='chat.chatsession')),
+                ('participant_count', models.PositiveIntegerField(default=0)),
+                ('online_count', models.PositiveIntegerField(default=0)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Room Stats',
+                'verbose_name_plural': 'Room Stats',
+            },
+        ),
+        migrations.RunPython(create_room_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1 on 2026-10-18 18:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def create_read_cursors(apps, schema_editor):
+    """
+    Give every existing participant a read cursor at the newest message of their room,
+    so that upgrading does not flag whole room histories as unread.
+    """
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+    Participant = ChatSession.participants.through
+    last_message_ids = dict(ChatSession.objects.annotate(last=Max('messages__id')).values_list('id', 'last'))
+    ReadCursor.objects.bulk_create(
+        ReadCursor(user_id=user_id, chat_session_id=chat_session_id,
+                   last_read_message_id=last_message_ids.get(chat_session_id))
+        for chat_session_id, user_id in Participant.objects.values_list('chatsession_id', 'user_id').iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_room_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.chatsession')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Read Cursor',
+                'verbose_name_plural': 'Read Cursors',
+                'constraints': [models.UniqueConstraint(fields=('user', 'chat_session'), name='chat_read_cursor_unique')],
+            },
+        ),
+        migrations.RunPython(create_read_cursors, migrations.RunPython.noop),
+    ]
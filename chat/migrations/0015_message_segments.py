@@ -0,0 +1,35 @@
+# Generated by Django 5.1 on 2026-10-18 19:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_read_cursors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='chat.chatsession')),
+            ],
+            options={
+                'verbose_name': 'Message Segment',
+                'verbose_name_plural': 'Message Segments',
+                'ordering': ['chat_session', 'first_timestamp'],
+                'indexes': [models.Index(fields=['chat_session', 'last_timestamp', 'last_message_id'], name='chat_segment_session_ts_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1 on 2026-10-18 19:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """
+    Give the messages of every existing chat session consecutive sequence numbers
+    in the order of their history, and remember the last one on the room's statistics.
+    """
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    Message = apps.get_model('chat', 'Message')
+    RoomStats = apps.get_model('chat', 'RoomStats')
+    for chat_session_id in ChatSession.objects.values_list('id', flat=True).iterator():
+        batch = []
+        seq = 0
+        for message_id in Message.objects.filter(chat_session_id=chat_session_id).order_by('timestamp', 'id').values_list('id', flat=True).iterator():
+            seq += 1
+            batch.append(Message(id=message_id, seq=seq))
+            if len(batch) >= 1000:
+                Message.objects.bulk_update(batch, ['seq'])
+                batch = []
+        Message.objects.bulk_update(batch, ['seq'])
+        RoomStats.objects.filter(chat_session_id=chat_session_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_message_segments'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='roomstats',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('seq__isnull', False)), fields=('chat_session', 'seq'), name='chat_message_room_seq_unique'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1 on 2026-10-18 19:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_message_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModeratedTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100, unique=True)),
+                ('action', models.CharField(choices=[('mask', 'Mask the term'), ('flag', 'Deliver and flag for review'), ('reject', 'Reject the message')], default='mask', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Moderated Term',
+                'verbose_name_plural': 'Moderated Terms',
+                'ordering': ['term'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FlaggedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('message', models.TextField()),
+                ('terms', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flagged_messages', to='chat.chatsession')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Flagged Message',
+                'verbose_name_plural': 'Flagged Messages',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -38,7 +38,7 @@ class ChatSession(models.Model):
         blank=True
     )  # Users allowed in a private chat
     created_at = models.DateTimeField(auto_now_add=True)  # Timestamp of chat creation
-    expiry_time = models.DateTimeField(null=True, blank=True)  # Expiry time for public/private rooms; can be None for predefined rooms
+    expiry_time = models.DateTimeField(null=True, blank=True, db_index=True)  # Expiry time for public/private rooms; can be None for predefined rooms
 
     def __str__(self):
         """
@@ -90,7 +90,8 @@ class Message(models.Model):
         on_delete=models.CASCADE
     )  # User who sent the message
     message = models.TextField()  # The message content
-    timestamp = models.DateTimeField(auto_now_add=True)  # Timestamp of when the message was sent
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)  # Timestamp of when the message was sent; set by the sender, not at insert time
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)  # Position of the message in its room, assigned when it is sent (see chat.sequence)
 
     def __str__(self):
         """
@@ -107,6 +108,18 @@ class Message(models.Model):
         ordering = ['timestamp']
         verbose_name = "Message"
         verbose_name_plural = "Messages"
+        indexes = [
+            # Keyset pagination of a room's history walks (timestamp, id) within one chat session
+            models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_msg_session_ts_idx'),
+        ]
+        constraints = [
+            # Resuming clients fetch the messages of a room after a sequence number
+            models.UniqueConstraint(
+                fields=['chat_session', 'seq'],
+                condition=models.Q(seq__isnull=False),
+                name='chat_message_room_seq_unique'
+            ),
+        ]
 
 
 class ChatAccessAttempt(models.Model):
@@ -119,7 +132,7 @@ class ChatAccessAttempt(models.Model):
         on_delete=models.CASCADE
     )  # User attempting to access the chat room
     room_name = models.CharField(max_length=255)  # Name of the chat room being accessed
-    timestamp = models.DateTimeField(auto_now_add=True)  # Timestamp of the access attempt
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)  # Timestamp of the access attempt; attempts are written in batches
     success = models.BooleanField()  # Whether the access attempt was successful
 
     def __str__(self):
@@ -143,4 +156,239 @@ class ChatAccessAttempt(models.Model):
         verbose_name_plural = "Chat Access Attempts"
         indexes = [
             models.Index(fields=['user', 'room_name', 'timestamp']),
+            models.Index(fields=['timestamp'], name='chat_access_ts_idx'),  # Hourly rollups and pruning scan by time
+        ]
+
+
+class ChatAccessRollup(models.Model):
+    """
+    Model holding the number of successful and denied chat access attempts
+    per hour, room and user. Raw ChatAccessAttempt rows are rolled up into
+    these rows and pruned once they are older than the retention window.
+    """
+    hour = models.DateTimeField()  # Start of the hour the attempts were made in
+    room_name = models.CharField(max_length=255)  # Name of the chat room being accessed
+    user = models.ForeignKey(
+        'accounts.User',
+        on_delete=models.CASCADE
+    )  # User attempting to access the chat room
+    success_count = models.PositiveIntegerField(default=0)  # Number of successful attempts in the hour
+    denied_count = models.PositiveIntegerField(default=0)  # Number of denied attempts in the hour
+
+    def __str__(self):
+        """
+        String representation of the ChatAccessRollup model.
+        Returns the hour, user, room and attempt counts.
+        """
+        return (
+            f"{self.hour.strftime('%Y-%m-%d %H:00')} {self.user.username} in '{self.room_name}': "
+            f"{self.success_count} successful, {self.denied_count} denied"
+        )
+
+    class Meta:
+        """
+        Meta options for the ChatAccessRollup model.
+        Defines ordering, verbose name settings, and uniqueness per hour, room and user.
+        """
+        ordering = ['-hour']
+        verbose_name = "Chat Access Rollup"
+        verbose_name_plural = "Chat Access Rollups"
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'room_name', 'user'], name='chat_access_rollup_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['room_name', 'hour']),
+        ]
+
+
+class RoomStats(models.Model):
+    """
+    Model holding denormalized statistics of a chat session, so that the chat lobby
+    can show them for a whole page of rooms without aggregating over messages,
+    participants or connections. Kept up to date by the message write path,
+    participant changes and presence joins and leaves (see chat.stats).
+    """
+    chat_session = models.OneToOneField(
+        ChatSession,
+        related_name='stats',
+        on_delete=models.CASCADE,
+        primary_key=True
+    )  # Chat session these statistics describe
+    participant_count = models.PositiveIntegerField(default=0)  # Number of users who have joined the room
+    online_count = models.PositiveIntegerField(default=0)  # Number of users with an open WebSocket to the room
+    last_message_at = models.DateTimeField(null=True, blank=True)  # Timestamp of the most recent message, if any
+    last_seq = models.PositiveBigIntegerField(default=0)  # Highest sequence number written to the room, where numbering resumes
+
+    def __str__(self):
+        """
+        String representation of the RoomStats model.
+        Returns the room with its participant and online counts.
+        """
+        return f"Stats of chat {self.chat_session_id}: {self.participant_count} participants, {self.online_count} online"
+
+    class Meta:
+        """
+        Meta options for the RoomStats model.
+        Defines verbose name settings.
+        """
+        verbose_name = "Room Stats"
+        verbose_name_plural = "Room Stats"
+
+
+class ReadCursor(models.Model):
+    """
+    Model holding how far a user has read in a chat session, together with a
+    denormalized count of the messages from other users posted since. The count
+    is incremented in bulk as messages are written and reset when the user acks,
+    so unread badges never require counting messages.
+    """
+    user = models.ForeignKey(
+        'accounts.User',
+        related_name='read_cursors',
+        on_delete=models.CASCADE
+    )  # User whose reading position this is
+    chat_session = models.ForeignKey(
+        ChatSession,
+        related_name='read_cursors',
+        on_delete=models.CASCADE
+    )  # Chat session being read
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)  # Id of the newest message the user has acked
+    unread_count = models.PositiveIntegerField(default=0)  # Messages from other users since the last ack
+
+    def __str__(self):
+        """
+        String representation of the ReadCursor model.
+        Returns the user, the chat session and the unread count.
+        """
+        return f"{self.user.username} in chat {self.chat_session_id}: {self.unread_count} unread"
+
+    class Meta:
+        """
+        Meta options for the ReadCursor model.
+        Defines verbose name settings and uniqueness per user and chat session.
+        """
+        verbose_name = "Read Cursor"
+        verbose_name_plural = "Read Cursors"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat_session'], name='chat_read_cursor_unique'),
         ]
+
+
+class MessageSegment(models.Model):
+    """
+    Model indexing a segment file: a gzip-compressed NDJSON file under MEDIA_ROOT holding
+    the messages of one chat session from one calendar month, moved out of the Message
+    table once they are older than the tiering threshold. History and export read
+    segments when a client pages back past the messages still in the database.
+    """
+    chat_session = models.ForeignKey(
+        ChatSession,
+        related_name='segments',
+        on_delete=models.CASCADE
+    )  # Chat session the messages belong to
+    month = models.DateField()  # First day of the month the messages were sent in
+    path = models.CharField(max_length=255)  # Location of the segment file, relative to MEDIA_ROOT
+    first_timestamp = models.DateTimeField()  # Timestamp of the oldest message in the segment
+    first_message_id = models.BigIntegerField()  # Id of the oldest message in the segment
+    last_timestamp = models.DateTimeField()  # Timestamp of the newest message in the segment
+    last_message_id = models.BigIntegerField()  # Id of the newest message in the segment
+    message_count = models.PositiveIntegerField()  # Number of messages in the segment
+    created_at = models.DateTimeField(auto_now_add=True)  # When the messages were moved to the segment
+
+    def __str__(self):
+        """
+        String representation of the MessageSegment model.
+        Returns the chat session, month and number of messages.
+        """
+        return f"Chat {self.chat_session_id} {self.month.strftime('%Y-%m')}: {self.message_count} messages"
+
+    class Meta:
+        """
+        Meta options for the MessageSegment model.
+        Defines ordering, verbose name settings, and the index used to page back through segments.
+        """
+        ordering = ['chat_session', 'first_timestamp']
+        verbose_name = "Message Segment"
+        verbose_name_plural = "Message Segments"
+        indexes = [
+            models.Index(fields=['chat_session', 'last_timestamp', 'last_message_id'], name='chat_segment_session_ts_idx'),
+        ]
+
+
+class ModeratedTerm(models.Model):
+    """
+    Model holding a term banned from chat messages, managed from the admin panel,
+    and what happens to messages containing it. The whole list is compiled into
+    one automaton (see chat.moderation), which is rebuilt whenever a term changes.
+    """
+    MASK = 'mask'
+    FLAG = 'flag'
+    REJECT = 'reject'
+    ACTION_CHOICES = [
+        (MASK, 'Mask the term'),
+        (FLAG, 'Deliver and flag for review'),
+        (REJECT, 'Reject the message'),
+    ]
+
+    term = models.CharField(max_length=100, unique=True)  # Matched case-insensitively, as a whole word or phrase
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, default=MASK)  # What happens to messages containing the term
+    created_at = models.DateTimeField(auto_now_add=True)  # When the term was added
+
+    def save(self, *args, **kwargs):
+        """
+        Store terms lowercased, the form messages are matched in.
+        """
+        self.term = self.term.strip().lower()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        """
+        String representation of the ModeratedTerm model.
+        Returns the term and its action.
+        """
+        return f"{self.term} ({self.action})"
+
+    class Meta:
+        """
+        Meta options for the ModeratedTerm model.
+        Defines ordering and verbose name settings.
+        """
+        ordering = ['term']
+        verbose_name = "Moderated Term"
+        verbose_name_plural = "Moderated Terms"
+
+
+class FlaggedMessage(models.Model):
+    """
+    Model recording a message that contained a flagged term. The message was delivered,
+    and is kept here as sent for moderators to review in the admin panel.
+    """
+    chat_session = models.ForeignKey(
+        ChatSession,
+        related_name='flagged_messages',
+        on_delete=models.CASCADE
+    )  # Chat session the message was sent to
+    user = models.ForeignKey(
+        'accounts.User',
+        on_delete=models.CASCADE
+    )  # User who sent the message
+    seq = models.PositiveBigIntegerField(null=True, blank=True)  # Sequence number of the message in its room
+    message = models.TextField()  # Text of the message as sent, before masking
+    terms = models.CharField(max_length=255)  # Comma-separated moderated terms found in the message
+    created_at = models.DateTimeField(auto_now_add=True)  # When the message was flagged
+
+    def __str__(self):
+        """
+        String representation of the FlaggedMessage model.
+        Returns the user, the chat session and the terms found.
+        """
+        return f"{self.user.username} in chat {self.chat_session_id}: {self.terms}"
+
+    class Meta:
+        """
+        Meta options for the FlaggedMessage model.
+        Defines ordering and verbose name settings.
+        """
+        ordering = ['-created_at']
+        verbose_name = "Flagged Message"
+        verbose_name_plural = "Flagged Messages"
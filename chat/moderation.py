@@ -0,0 +1,201 @@
+import logging
+import time
+import uuid
+from collections import deque
+from typing import NamedTuple
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+from .models import FlaggedMessage, ModeratedTerm
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# Cache key of the version token of the term list; changing it makes every process sharing the cache rebuild its automaton
+VERSION_KEY = 'chat:moderation:version'
+
+# Actions, from the weakest to the strongest; a message gets the strongest action of the terms it contains
+MASK, FLAG, REJECT = ModeratedTerm.MASK, ModeratedTerm.FLAG, ModeratedTerm.REJECT
+SEVERITY = {MASK: 1, FLAG: 2, REJECT: 3}
+
+# Character masked terms are replaced with
+MASK_CHAR = '*'
+
+# Automaton built by this process, the version token it was built for, when it was built and when the token was last checked
+_automaton = None
+_version = None
+_built_at = 0.0
+_checked_at = 0.0
+
+
+class Verdict(NamedTuple):
+    """
+    Result of moderating a message: the strongest action of the terms found, or None,
+    the text to deliver, with masked terms replaced, and the terms found.
+    """
+    action: str
+    message: str
+    terms: list
+
+
+def _normalize(text):
+    """
+    Lowercase text for matching while keeping every character at its position,
+    so that match positions can be used to mask the original text.
+    """
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # A few characters lowercase to several (e.g. 'İ'); leave those as they are
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class TermAutomaton:
+    """
+    Aho-Corasick automaton over a list of terms. Building it costs time proportional to
+    the total length of the terms; matching a message then takes a single pass over its
+    characters, whatever the number of terms, instead of one regular expression per term.
+    """
+
+    def __init__(self, terms):
+        """
+        Build the automaton from a mapping of lowercased term to action.
+        """
+        self.size = len(terms)
+        self.goto = [{}]  # state -> {character: next state}; state 0 is the root
+        self.output = [()]  # state -> ((term length, action), ...) of the terms ending there
+        for term, action in terms.items():
+            if not term:
+                continue
+            state = 0
+            for char in term:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.output.append(())
+                state = next_state
+            self.output[state] = ((len(term), action),)
+
+        # Failure links, breadth first: each state falls back to the longest suffix of its
+        # path that is also a path from the root, and inherits the terms ending there
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """
+        Yield (start, end, action) for every occurrence of a term in already normalized text.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, action in output[state]:
+                yield index + 1 - length, index + 1, action
+
+    def moderate(self, text):
+        """
+        Return the Verdict for a message. Terms only match as whole words, so that
+        banning a word does not mask the longer words it is part of.
+        """
+        if not self.size:
+            return Verdict(None, text, [])
+
+        normalized = _normalize(text)
+        action, terms, masked = None, [], []
+        for start, end, term_action in self.find(normalized):
+            if (start > 0 and _is_word_char(normalized[start - 1])) or (end < len(normalized) and _is_word_char(normalized[end])):
+                continue
+            terms.append(normalized[start:end])
+            if action is None or SEVERITY[term_action] > SEVERITY[action]:
+                action = term_action
+            if term_action == MASK:
+                masked.append((start, end))
+
+        if masked:
+            chars = list(text)
+            for start, end in masked:
+                chars[start:end] = MASK_CHAR * (end - start)
+            text = ''.join(chars)
+        return Verdict(action, text, list(dict.fromkeys(terms)))
+
+
+def build_automaton():
+    """
+    Compile the current term list into an automaton.
+    """
+    return TermAutomaton(dict(ModeratedTerm.objects.values_list('term', 'action')))
+
+
+def invalidate():
+    """
+    Mark the term list as changed, so that every process sharing the cache rebuilds its automaton.
+    """
+    global _automaton
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    _automaton = None
+
+
+async def get_automaton():
+    """
+    Return the automaton of the current term list. The shared version token is checked
+    at most once per CHAT_MODERATION_REFRESH_INTERVAL seconds, and the automaton is only
+    rebuilt when the token changed, so the term list is not read per message. An automaton
+    older than CHAT_MODERATION_MAX_AGE seconds is rebuilt anyway, so that term changes reach
+    every process even when the cache is not shared between them.
+    """
+    global _automaton, _version, _built_at, _checked_at
+    now = time.monotonic()
+    if _automaton is not None and now - _checked_at < getattr(settings, 'CHAT_MODERATION_REFRESH_INTERVAL', 5):
+        return _automaton
+
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, uuid.uuid4().hex, None)
+        version = await cache.aget(VERSION_KEY)
+    if _automaton is None or version != _version or now - _built_at >= getattr(settings, 'CHAT_MODERATION_MAX_AGE', 60):
+        started = time.perf_counter()
+        automaton = await database_sync_to_async(build_automaton)()
+        metrics.observe('chat.moderation.build_ms', (time.perf_counter() - started) * 1000)
+        _automaton, _version, _built_at = automaton, version, now
+    _checked_at = now
+    return _automaton
+
+
+async def moderate(message):
+    """
+    Match a chat message against the term list in one pass and return its Verdict.
+    Only text can be matched, so anything else is refused rather than passed through.
+    """
+    if not isinstance(message, str):
+        raise TypeError(f"Chat messages must be strings, not {type(message).__name__}.")
+    verdict = (await get_automaton()).moderate(message)
+    if verdict.action is not None:
+        metrics.incr(f'chat.moderation.{verdict.action}')
+    return verdict
+
+
+def flag(chat_session_id, user, seq, message, terms):
+    """
+    Record a delivered message containing flagged terms for review.
+    """
+    logger.info(f"Flagged message {seq} of {user.username} in chat session {chat_session_id}: {', '.join(terms)}")
+    return FlaggedMessage.objects.create(
+        chat_session_id=chat_session_id, user=user, seq=seq, message=message, terms=', '.join(terms)[:255]
+    )
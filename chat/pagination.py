@@ -0,0 +1,38 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class MessageCursorPagination(CursorPagination):
+    """
+    Cursor pagination for the messages of a chat session.
+    Pages walk back from the newest message by default. When the client passes
+    `since_id` for an incremental sync, pages walk forward by id instead, so each
+    poll only returns messages the client has not seen yet.
+    """
+    ordering = ('-timestamp', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+        return super().get_page_size(request)
+
+    def get_ordering(self, request, queryset, view):
+        if 'since_id' in request.query_params:
+            return ('id',)
+        return self.ordering
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Cursor pagination for user search results, in lowercased username order.
+    Each page continues the index range scan where the previous one stopped,
+    so deep pages cost the same as the first.
+    """
+    ordering = ('username_lower', 'id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, 'CHAT_USER_SEARCH_PAGE_SIZE', 20)
+        return super().get_page_size(request)
@@ -0,0 +1,122 @@
+import asyncio
+import weakref
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Presence backend shared by every consumer and view of this process, created on first use
+_backend = None
+
+
+class InMemoryPresenceBackend:
+    """
+    Presence backend that keeps track of connected users in process memory.
+    Suitable for single-node deployments, where every WebSocket of a room
+    is handled by the same server process.
+    """
+
+    def __init__(self, **options):
+        self.rooms = {}  # chat session id -> {user id: number of open connections}
+
+    async def join(self, chat_session_id, user_id):
+        """
+        Register one more connection of a user to a room.
+        Returns True if this is the user's first open connection to the room.
+        """
+        connections = self.rooms.setdefault(chat_session_id, {})
+        connections[user_id] = connections.get(user_id, 0) + 1
+        return connections[user_id] == 1
+
+    async def leave(self, chat_session_id, user_id):
+        """
+        Unregister one connection of a user from a room.
+        Returns True if this was the user's last open connection to the room.
+        """
+        connections = self.rooms.get(chat_session_id, {})
+        remaining = connections.get(user_id, 0) - 1
+        if remaining > 0:
+            connections[user_id] = remaining
+            return False
+
+        connections.pop(user_id, None)
+        if not connections:
+            self.rooms.pop(chat_session_id, None)
+        return True
+
+    async def online_user_ids(self, chat_session_id):
+        """
+        Return the ids of the users with at least one open connection to a room.
+        """
+        return set(self.rooms.get(chat_session_id, {}))
+
+    async def online_count(self, chat_session_id):
+        """
+        Return the number of distinct users connected to a room.
+        """
+        return len(self.rooms.get(chat_session_id, {}))
+
+
+class RedisPresenceBackend:
+    """
+    Presence backend that keeps track of connected users in Redis, so that
+    every server process sharing the channel layer sees the same presence.
+    Each room is a Redis hash mapping user ids to their number of open connections.
+    """
+
+    key_prefix = 'chat:presence'
+
+    def __init__(self, url=None, expiry=None, **options):
+        self.url = url or getattr(settings, 'CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+        # Keys expire if no connection joins for this long, which clears counts left behind by crashed servers
+        self.expiry = expiry or 24 * 60 * 60
+        self._clients = weakref.WeakKeyDictionary()  # One client per event loop
+
+    def _client(self):
+        """
+        Return the Redis client for the running event loop.
+        """
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = redis.from_url(self.url)
+        return client
+
+    def _key(self, chat_session_id):
+        return f"{self.key_prefix}:{chat_session_id}"
+
+    async def join(self, chat_session_id, user_id):
+        key = self._key(chat_session_id)
+        async with self._client().pipeline(transaction=True) as pipe:
+            pipe.hincrby(key, user_id, 1)
+            pipe.expire(key, self.expiry)
+            count, _ = await pipe.execute()
+        return count == 1
+
+    async def leave(self, chat_session_id, user_id):
+        key = self._key(chat_session_id)
+        client = self._client()
+        remaining = await client.hincrby(key, user_id, -1)
+        if remaining > 0:
+            return False
+        await client.hdel(key, user_id)
+        return True
+
+    async def online_user_ids(self, chat_session_id):
+        user_ids = await self._client().hkeys(self._key(chat_session_id))
+        return {int(user_id) for user_id in user_ids}
+
+    async def online_count(self, chat_session_id):
+        return await self._client().hlen(self._key(chat_session_id))
+
+
+def get_presence_backend():
+    """
+    Return the presence backend configured by the CHAT_PRESENCE_BACKEND setting.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'CHAT_PRESENCE_BACKEND', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.presence.InMemoryPresenceBackend'))
+        _backend = backend_class(**config.get('OPTIONS', {}))
+    return _backend
@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+from django.conf import settings
+from . import metrics
+
+# Overflow policies for a full send queue
+DROP_OLDEST = 'drop_oldest'  # Discard the oldest queued frame to make room for the new one
+DISCONNECT = 'disconnect'  # Tell the client to resync and close the connection
+
+# Frame sent before closing a connection whose send queue overflowed
+RESYNC_FRAME = {'type': 'resync', 'reason': 'send_queue_overflow'}
+
+# Frame sent instead of the missed messages when a client asks to resume after too large a gap
+RESUME_RESYNC_FRAME = {'type': 'resync', 'reason': 'resume_gap_too_large'}
+
+# WebSocket close code used after a send queue overflow
+OVERFLOW_CLOSE_CODE = 4008
+
+
+class SendQueue:
+    """
+    Bounded queue of outbound frames for a single WebSocket connection.
+    Frames queued within the same tick are coalesced and handed to `send_batch`
+    together, so a busy room costs one WebSocket frame per tick instead of one per event.
+    A client that cannot keep up fills the queue, at which point the overflow policy
+    decides whether old frames are dropped or the connection is closed. Frames of a batch
+    still being sent count against `max_size` too, so a socket stuck in `send` overflows
+    instead of growing an unbounded backlog across ticks.
+
+    Ephemeral frames (typing indicators, read receipts) are held apart from the others:
+    a newer frame with the same key replaces a pending one, and they are dropped once
+    the queue is half full, so they are shed under load before any chat message is.
+
+    A queue given a `name`, e.g. its connection's channel name, reports the frames it
+    holds as the gauge chat.send_queue.depth.<name> until it is stopped, so that the
+    connections backing up, including ones that never drain, can be told apart.
+    """
+
+    def __init__(self, send_batch, close, max_size=None, overflow_policy=None, tick=None, name=None):
+        self.send_batch = send_batch  # Coroutine function sending a list of frames to the client
+        self.close = close  # Coroutine function closing the connection
+        self.gauge_name = f'chat.send_queue.depth.{name}' if name is not None else None
+        self.max_size = max_size or getattr(settings, 'CHAT_SEND_QUEUE_SIZE', 100)
+        self.overflow_policy = overflow_policy or getattr(settings, 'CHAT_SEND_QUEUE_OVERFLOW', DROP_OLDEST)
+        self.tick = tick if tick is not None else getattr(settings, 'CHAT_SEND_QUEUE_TICK', 0.01)
+        self.frames = deque()
+        self.ephemeral = {}  # key -> latest pending ephemeral frame, in insertion order
+        self.in_flight = 0  # Frames of the batch being sent
+        self.closed = False
+        self._task = None
+
+    @property
+    def depth(self):
+        """
+        Number of frames waiting to be sent.
+        """
+        return len(self.frames) + len(self.ephemeral)
+
+    @property
+    def backlog(self):
+        """
+        Number of non-ephemeral frames queued or being sent, which `max_size` bounds.
+        """
+        return len(self.frames) + self.in_flight
+
+    def put(self, frame):
+        """
+        Queue a frame for sending, applying the overflow policy if the queue is full.
+        """
+        if self.closed:
+            return
+
+        if self.backlog >= self.max_size:
+            metrics.incr('chat.send_queue.overflows')
+            if self.overflow_policy == DISCONNECT:
+                self._overflow_disconnect()
+                return
+            metrics.incr('chat.send_queue.dropped')
+            if not self.frames:
+                return  # Every older frame is already being sent; drop this one instead
+            self.frames.popleft()
+
+        self.frames.append(frame)
+        self._record_depth()
+        self._start_draining()
+
+    def put_ephemeral(self, frame, key):
+        """
+        Queue an ephemeral frame, replacing any pending one with the same key.
+        The frame is dropped instead if the queue is at least half full.
+        """
+        if self.closed:
+            return
+
+        if self.backlog >= self.max_size // 2:
+            metrics.incr('chat.send_queue.ephemeral_dropped')
+            return
+
+        self.ephemeral.pop(key, None)  # Re-insert so that frames keep the order of their latest update
+        self.ephemeral[key] = frame
+        self._record_depth()
+        self._start_draining()
+
+    def _record_depth(self):
+        if self.gauge_name is not None:
+            metrics.gauge(self.gauge_name, self.depth + self.in_flight)
+
+    def _start_draining(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        """
+        Send queued frames, one coalesced batch per tick, until the queue is empty.
+        """
+        try:
+            while self.frames or self.ephemeral:
+                await asyncio.sleep(self.tick)
+                metrics.observe('chat.send_queue.depth', self.depth)
+                batch = list(self.frames) + list(self.ephemeral.values())
+                self.in_flight = len(self.frames)
+                self.frames.clear()
+                self.ephemeral.clear()
+                try:
+                    await self.send_batch(batch)
+                finally:
+                    self.in_flight = 0
+                self._record_depth()
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def _overflow_disconnect(self):
+        """
+        Drop everything queued, send the client a resync hint and close the connection.
+        """
+        metrics.incr('chat.send_queue.overflow_disconnects')
+        self.stop()
+        self._task = asyncio.ensure_future(self._send_resync_and_close())
+
+    async def _send_resync_and_close(self):
+        await self.send_batch([RESYNC_FRAME])
+        await self.close(code=OVERFLOW_CLOSE_CODE)
+
+    def stop(self):
+        """
+        Stop sending and discard any queued frames, e.g. when the connection closes.
+        """
+        self.closed = True
+        self.frames.clear()
+        self.ephemeral.clear()
+        if self.gauge_name is not None:
+            metrics.remove_gauge(self.gauge_name)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
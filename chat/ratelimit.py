@@ -0,0 +1,115 @@
+import asyncio
+import time
+import weakref
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Rate limit backend shared by every consumer of this process, created on first use
+_backend = None
+
+# Default limits: tokens refilled per second and bucket capacity (the largest burst allowed)
+DEFAULT_RATE_LIMITS = {
+    'user': {'rate': 5, 'burst': 20},  # Frames a user may send, over all their connections and rooms
+    'room': {'rate': 50, 'burst': 100},  # Chat messages a room may receive, over all its members
+}
+
+
+class InMemoryRateLimitBackend:
+    """
+    Rate limit backend keeping token buckets in process memory.
+    Suitable for single-node deployments; each process limits on its own.
+    """
+
+    def __init__(self, **options):
+        self.buckets = {}  # key -> [tokens left, monotonic time of the last refill]
+
+    async def consume(self, key, rate, burst, cost=1):
+        """
+        Take `cost` tokens from the bucket stored under `key`, refilling it at `rate`
+        tokens per second up to `burst` tokens. Returns True if there were enough tokens.
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+
+class RedisRateLimitBackend:
+    """
+    Rate limit backend keeping token buckets in Redis, so that limits hold across
+    every server process. Each bucket is a hash refilled and consumed atomically by
+    a Lua script using the Redis server clock.
+    """
+
+    key_prefix = 'chat:ratelimit'
+
+    script = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local cost = tonumber(ARGV[3])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or burst
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        local allowed = 0
+        if tokens >= cost then
+            tokens = tokens - cost
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return allowed
+    """
+
+    def __init__(self, url=None, **options):
+        self.url = url or getattr(settings, 'CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+        self._scripts = weakref.WeakKeyDictionary()  # One client and registered script per event loop
+
+    def _script(self):
+        """
+        Return the registered token bucket script for the running event loop.
+        """
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        script = self._scripts.get(loop)
+        if script is None:
+            script = self._scripts[loop] = redis.from_url(self.url).register_script(self.script)
+        return script
+
+    async def consume(self, key, rate, burst, cost=1):
+        allowed = await self._script()(keys=[f"{self.key_prefix}:{key}"], args=[rate, burst, cost])
+        return allowed == 1
+
+
+def get_rate_limit_backend():
+    """
+    Return the rate limit backend configured by the CHAT_RATE_LIMIT_BACKEND setting.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'CHAT_RATE_LIMIT_BACKEND', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.ratelimit.InMemoryRateLimitBackend'))
+        _backend = backend_class(**config.get('OPTIONS', {}))
+    return _backend
+
+
+async def allow(scope, key):
+    """
+    Consume one token from the bucket of `key` under the limits of `scope` ('user' or 'room').
+    Returns True if the frame may be processed. A scope whose limits are None is not limited.
+    """
+    limits = getattr(settings, 'CHAT_RATE_LIMITS', DEFAULT_RATE_LIMITS).get(scope, DEFAULT_RATE_LIMITS[scope])
+    if limits is None:
+        return True
+    return await get_rate_limit_backend().consume(f"{scope}:{key}", limits['rate'], limits['burst'])
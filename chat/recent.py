@@ -0,0 +1,244 @@
+import asyncio
+import json
+import weakref
+from collections import OrderedDict, deque
+from datetime import datetime
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .history import encode_cursor
+
+# Recent message backend shared by every consumer and view of this process, created on first use
+_backend = None
+
+
+class InMemoryRecentBackend:
+    """
+    Recent message backend keeping a ring buffer per room in process memory.
+    Suitable for single-node deployments, where every message of a room is broadcast
+    by the same server process. Only the `max_rooms` most recently used rooms are kept.
+    """
+
+    def __init__(self, size=None, max_rooms=1000, **options):
+        self.size = size or getattr(settings, 'CHAT_RECENT_MESSAGES_SIZE', 100)
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()  # chat session id -> {'entries': deque, 'primed': bool, 'complete': bool}
+
+    def _room(self, chat_session_id):
+        room = self.rooms.get(chat_session_id)
+        if room is None:
+            room = self.rooms[chat_session_id] = {'entries': deque(maxlen=self.size), 'primed': False, 'complete': False}
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        self.rooms.move_to_end(chat_session_id)
+        return room
+
+    async def append(self, chat_session_id, entry):
+        """
+        Add a message entry to the ring of a room, evicting the oldest once it is full.
+        """
+        room = self._room(chat_session_id)
+        if len(room['entries']) == self.size:
+            room['complete'] = False  # The oldest message of the room is about to leave the ring
+        room['entries'].append(entry)
+
+    async def prime(self, chat_session_id, entries, complete):
+        """
+        Fill the ring of a room with a page of entries read from the database, oldest first,
+        unless it is already primed. Entries appended meanwhile are kept after the page.
+        `complete` tells whether the page starts at the first message of the room.
+        """
+        room = self._room(chat_session_id)
+        if room['primed']:
+            return
+        last_seq = max((entry['seq'] or 0 for entry in entries), default=0)
+        newer = [entry for entry in room['entries'] if (entry['seq'] or 0) > last_seq]
+        room['entries'] = deque(entries[-self.size:] + newer, maxlen=self.size)
+        room['primed'] = True
+        room['complete'] = complete and len(entries) + len(newer) <= self.size
+
+    async def assign_ids(self, chat_session_id, ids):
+        """
+        Fill in the database ids of entries appended before their messages were written,
+        given as a mapping of sequence number to id.
+        """
+        room = self.rooms.get(chat_session_id)
+        if room is None:
+            return
+        for entry in room['entries']:
+            if entry['id'] is None and entry['seq'] in ids:
+                entry['id'] = ids[entry['seq']]
+
+    async def get(self, chat_session_id):
+        """
+        Return the entries of a room's ring, oldest first, whether it was primed,
+        and whether it still holds the first message of the room.
+        """
+        room = self.rooms.get(chat_session_id)
+        if room is None:
+            return [], False, False
+        return [dict(entry) for entry in room['entries']], room['primed'], room['complete']
+
+
+class RedisRecentBackend:
+    """
+    Recent message backend keeping the ring buffer of each room in a capped Redis list,
+    so that every server process appends to and serves joins from the same ring.
+    A hash next to the list records whether it was primed and still holds the first message.
+    """
+
+    key_prefix = 'chat:recent'
+
+    append_script = """
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+        if redis.call('LLEN', KEYS[1]) > tonumber(ARGV[2]) then
+            redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+            redis.call('HDEL', KEYS[2], 'complete')
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+    """
+
+    prime_script = """
+        if redis.call('HEXISTS', KEYS[2], 'primed') == 1 then
+            return 0
+        end
+        local size = tonumber(ARGV[1])
+        local last_seq = tonumber(ARGV[2])
+        local newer = {}
+        for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            local seq = cjson.decode(raw).seq
+            if type(seq) == 'number' and seq > last_seq then
+                table.insert(newer, raw)
+            end
+        end
+        redis.call('DEL', KEYS[1])
+        for i = 5, #ARGV do
+            redis.call('RPUSH', KEYS[1], ARGV[i])
+        end
+        for _, raw in ipairs(newer) do
+            redis.call('RPUSH', KEYS[1], raw)
+        end
+        local length = redis.call('LLEN', KEYS[1])
+        if length > size then
+            redis.call('LTRIM', KEYS[1], -size, -1)
+        end
+        redis.call('HSET', KEYS[2], 'primed', 1)
+        if ARGV[3] == '1' and length <= size then
+            redis.call('HSET', KEYS[2], 'complete', 1)
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+        return 1
+    """
+
+    assign_ids_script = """
+        local ids = cjson.decode(ARGV[1])
+        for index, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            local entry = cjson.decode(raw)
+            local id = ids[tostring(entry.seq)]
+            if id and entry.id == cjson.null then
+                entry.id = id
+                redis.call('LSET', KEYS[1], index - 1, cjson.encode(entry))
+            end
+        end
+    """
+
+    def __init__(self, url=None, size=None, expiry=None, **options):
+        self.url = url or getattr(settings, 'CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+        self.size = size or getattr(settings, 'CHAT_RECENT_MESSAGES_SIZE', 100)
+        # Rings of rooms without messages for this long are dropped and primed again on the next join
+        self.expiry = expiry or 24 * 60 * 60
+        self._clients = weakref.WeakKeyDictionary()  # One client and registered scripts per event loop
+
+    def _client(self):
+        """
+        Return the Redis client and the registered scripts for the running event loop.
+        """
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            connection = redis.from_url(self.url)
+            client = self._clients[loop] = (
+                connection,
+                connection.register_script(self.append_script),
+                connection.register_script(self.prime_script),
+                connection.register_script(self.assign_ids_script),
+            )
+        return client
+
+    def _keys(self, chat_session_id):
+        return [f"{self.key_prefix}:{chat_session_id}", f"{self.key_prefix}:{chat_session_id}:meta"]
+
+    async def append(self, chat_session_id, entry):
+        _, append, _, _ = self._client()
+        await append(keys=self._keys(chat_session_id), args=[json.dumps(entry), self.size, self.expiry])
+
+    async def prime(self, chat_session_id, entries, complete):
+        _, _, prime, _ = self._client()
+        last_seq = max((entry['seq'] or 0 for entry in entries), default=0)
+        await prime(
+            keys=self._keys(chat_session_id),
+            args=[self.size, last_seq, int(complete), self.expiry] + [json.dumps(entry) for entry in entries]
+        )
+
+    async def assign_ids(self, chat_session_id, ids):
+        _, _, _, assign_ids = self._client()
+        await assign_ids(keys=self._keys(chat_session_id)[:1], args=[json.dumps({str(seq): id for seq, id in ids.items()})])
+
+    async def get(self, chat_session_id):
+        connection, _, _, _ = self._client()
+        list_key, meta_key = self._keys(chat_session_id)
+        async with connection.pipeline(transaction=True) as pipe:
+            pipe.lrange(list_key, 0, -1)
+            pipe.hgetall(meta_key)
+            entries, meta = await pipe.execute()
+        return [json.loads(entry) for entry in entries], b'primed' in meta, b'complete' in meta
+
+
+def get_recent_backend():
+    """
+    Return the recent message backend configured by the CHAT_RECENT_MESSAGES_BACKEND setting.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'CHAT_RECENT_MESSAGES_BACKEND', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.recent.InMemoryRecentBackend'))
+        _backend = backend_class(**config.get('OPTIONS', {}))
+    return _backend
+
+
+async def latest_page(chat_session_id, limit=None):
+    """
+    Return the latest page of a room's history from its ring, in the same form as
+    history.fetch_page, or None if the ring cannot answer without the database:
+    it was never primed, or the oldest message of the page is not written yet, so
+    that no cursor can be given for the next older page.
+    """
+    limit = limit or getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    entries, primed, complete = await get_recent_backend().get(chat_session_id)
+    if not primed:
+        return None
+
+    # Several server processes may append to a shared ring slightly out of order
+    entries.sort(key=lambda entry: (datetime.fromisoformat(entry['timestamp']), entry['seq'] or 0))
+    page = entries[-limit:]
+    if complete and len(entries) <= limit:
+        return page, None
+    if not page or page[0]['id'] is None:
+        return None
+    return page, encode_cursor(page[0])
+
+
+async def messages_after(chat_session_id, after_seq, last_seq):
+    """
+    Return the entries of a room's ring numbered above `after_seq`, oldest first, if they
+    run without a gap up to `last_seq`, the room's last number. Returns None if the ring
+    does not hold every message since `after_seq`, e.g. because older ones were evicted.
+    """
+    entries, _, _ = await get_recent_backend().get(chat_session_id)
+    entries = sorted((entry for entry in entries if (entry['seq'] or 0) > after_seq), key=lambda entry: entry['seq'])
+    if [entry['seq'] for entry in entries] != list(range(after_seq + 1, last_seq + 1)):
+        return None
+    return entries
@@ -3,5 +3,6 @@ from . import consumers
 
 # Define WebSocket URL patterns for the chat app
 websocket_urlpatterns = [
+    path('ws/lobby/', consumers.LobbyConsumer.as_asgi()),  # Live updates of the chat lobby's list of rooms
     path('ws/chat/<str:room_name>/', consumers.ChatConsumer.as_asgi()),
 ]
@@ -0,0 +1,108 @@
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from .models import ChatSession, Message
+
+# Name of the SQLite FTS5 table indexing Message.message (see migration 0012_message_fulltext_index)
+SQLITE_FTS_TABLE = 'chat_message_fts'
+
+# Text search configuration of the PostgreSQL expression index
+POSTGRES_CONFIG = 'english'
+
+# Words are sequences of letters and digits; everything else only separates them
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts5_query(query):
+    """
+    Turn free text typed by a user into an FTS5 query matching messages that contain
+    every word, with the last word matched as a prefix so that results update while typing.
+    Each word is quoted, so FTS5 operators in the input are treated as plain text.
+    """
+    words = WORD_RE.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _participant_rooms_sql():
+    """
+    Return a subquery selecting the ids of the rooms a user (the single parameter) participates in.
+    """
+    table = ChatSession.participants.through._meta.db_table
+    return f'SELECT chatsession_id FROM {table} WHERE user_id = %s'
+
+
+def search_messages(user, query, limit=None):
+    """
+    Return the messages matching a full-text query, best match first, limited to
+    the rooms the user participates in. Each message has a `rank` attribute, where
+    a higher value is a better match.
+    """
+    limit = limit or getattr(settings, 'CHAT_SEARCH_RESULTS_LIMIT', 50)
+    message_table = Message._meta.db_table
+
+    if connection.vendor == 'sqlite':
+        match = fts5_query(query)
+        if match is None:
+            return []
+        sql = (
+            f'SELECT m.id, -bm25({SQLITE_FTS_TABLE}) AS rank '
+            f'FROM {SQLITE_FTS_TABLE} JOIN {message_table} m ON m.id = {SQLITE_FTS_TABLE}.rowid '
+            f'WHERE {SQLITE_FTS_TABLE} MATCH %s AND m.chat_session_id IN ({_participant_rooms_sql()}) '
+            f'ORDER BY rank DESC LIMIT %s'
+        )
+        params = [match, user.id, limit]
+    elif connection.vendor == 'postgresql':
+        if not WORD_RE.search(query):
+            return []
+        sql = (
+            f"SELECT m.id, ts_rank(to_tsvector('{POSTGRES_CONFIG}', m.message), q) AS rank "
+            f"FROM {message_table} m, plainto_tsquery('{POSTGRES_CONFIG}', %s) q "
+            f"WHERE to_tsvector('{POSTGRES_CONFIG}', m.message) @@ q "
+            f"AND m.chat_session_id IN ({_participant_rooms_sql()}) "
+            f"ORDER BY rank DESC LIMIT %s"
+        )
+        params = [query, user.id, limit]
+    else:
+        # No full-text index on this database; fall back to an unranked substring scan
+        messages = Message.objects.filter(
+            message__icontains=query, chat_session__participants=user
+        ).select_related('user', 'chat_session').order_by('-timestamp')[:limit]
+        for message in messages:
+            message.rank = 0.0
+        return list(messages)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ranks = dict(cursor.fetchall())
+
+    messages = Message.objects.filter(id__in=ranks).select_related('user', 'chat_session')
+    for message in messages:
+        message.rank = ranks[message.id]
+    return sorted(messages, key=lambda message: message.rank, reverse=True)
+
+
+def filter_messages(queryset, query):
+    """
+    Restrict a Message queryset to the messages matching a full-text query.
+    The match is a subquery on the full-text index, so it does not scan the Message table.
+    """
+    message_table = Message._meta.db_table
+    if connection.vendor == 'sqlite':
+        match = fts5_query(query)
+        if match is None:
+            return queryset.none()
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s', [match]
+        ))
+    if connection.vendor == 'postgresql':
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT id FROM {message_table} "
+            f"WHERE to_tsvector('{POSTGRES_CONFIG}', message) @@ plainto_tsquery('{POSTGRES_CONFIG}', %s)",
+            [query]
+        ))
+    return queryset.filter(message__icontains=query)
@@ -0,0 +1,146 @@
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from .archive import message_record
+from .models import Message, MessageSegment
+
+# Set up logging for this module
+logger = logging.getLogger(__name__)
+
+# Directory under MEDIA_ROOT where segment files are written, one subdirectory per chat session
+SEGMENT_DIR = 'chat_segments'
+
+
+def record_key(record):
+    """
+    Return the (timestamp, id) position of a segment record, the order history is kept in.
+    """
+    return datetime.fromisoformat(record['timestamp']), record['id']
+
+
+def read_segment(segment):
+    """
+    Yield the records of a segment file, oldest first.
+    """
+    with gzip.open(os.path.join(settings.MEDIA_ROOT, segment.path), 'rt', encoding='utf-8') as segment_file:
+        for line in segment_file:
+            yield json.loads(line)
+
+
+def fetch_older(chat_session_id, before=None, limit=50):
+    """
+    Return up to `limit` records from a room's segments that come before the `before`
+    (timestamp, id) position, newest first. The index selects the segments to read,
+    so only the files overlapping the requested page are opened.
+    """
+    segments = MessageSegment.objects.filter(chat_session_id=chat_session_id)
+    if before is not None:
+        timestamp, message_id = before
+        segments = segments.filter(Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_message_id__lt=message_id))
+
+    records = []
+    for segment in segments.order_by('-last_timestamp', '-last_message_id').iterator():
+        older = [record for record in read_segment(segment) if before is None or record_key(record) < before]
+        records.extend(reversed(older[-(limit - len(records)):]))
+        if len(records) >= limit:
+            break
+    return records
+
+
+def iter_records(chat_session_id, start=None, end=None):
+    """
+    Yield the records of a room's segments sent at or after `start` and before `end`, oldest first.
+    """
+    segments = MessageSegment.objects.filter(chat_session_id=chat_session_id)
+    if start is not None:
+        segments = segments.filter(last_timestamp__gte=start)
+    if end is not None:
+        segments = segments.filter(first_timestamp__lt=end)
+
+    for segment in segments.order_by('first_timestamp', 'first_message_id').iterator():
+        for record in read_segment(segment):
+            timestamp = datetime.fromisoformat(record['timestamp'])
+            if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                yield record
+
+
+def _write_segment(chat_session, month, records, chunk_size):
+    """
+    Write the records of (part of) one month to a new segment file, then index it and delete
+    the segment's messages from the database in one transaction. If writing fails,
+    nothing is deleted.
+    """
+    first, last = records[0], records[-1]
+    relative_path = os.path.join(
+        SEGMENT_DIR, str(chat_session.id), f"{month:%Y-%m}_{first['id']}_{last['id']}.ndjson.gz"
+    )
+    path = os.path.join(settings.MEDIA_ROOT, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt', encoding='utf-8') as segment_file:
+        for record in records:
+            segment_file.write(json.dumps(record) + '\n')
+
+    with transaction.atomic():
+        MessageSegment.objects.create(
+            chat_session=chat_session,
+            month=month,
+            path=relative_path,
+            first_timestamp=datetime.fromisoformat(first['timestamp']),
+            first_message_id=first['id'],
+            last_timestamp=datetime.fromisoformat(last['timestamp']),
+            last_message_id=last['id'],
+            message_count=len(records),
+        )
+        ids = [record['id'] for record in records]
+        for offset in range(0, len(ids), chunk_size):
+            Message.objects.filter(id__in=ids[offset:offset + chunk_size]).delete()
+
+
+def tier_room(chat_session, cutoff, chunk_size=None, segment_size=None):
+    """
+    Move the messages of a chat session sent before `cutoff` into segments, one per
+    calendar month, or several for months with more than `segment_size` messages.
+    Messages are streamed from the database in chunks, so at most one segment of
+    records is held in memory. Returns the number of messages moved.
+    """
+    chunk_size = chunk_size or getattr(settings, 'CHAT_EXPIRY_MESSAGE_BATCH_SIZE', 1000)
+    segment_size = segment_size or getattr(settings, 'CHAT_TIERING_SEGMENT_SIZE', 50000)
+    messages = (
+        Message.objects.filter(chat_session_id=chat_session.id, timestamp__lt=cutoff)
+        .select_related('user')
+        .order_by('timestamp', 'id')
+        .iterator(chunk_size=chunk_size)
+    )
+
+    moved = 0
+    month, records = None, []
+    for message in messages:
+        message_month = date(message.timestamp.year, message.timestamp.month, 1)
+        if records and (message_month != month or len(records) >= segment_size):
+            _write_segment(chat_session, month, records, chunk_size)
+            moved += len(records)
+            records = []
+        month = message_month
+        records.append(message_record(message))
+
+    if records:
+        _write_segment(chat_session, month, records, chunk_size)
+        moved += len(records)
+    return moved
+
+
+def delete_segment_file(segment):
+    """
+    Remove the file of a segment whose index row was deleted.
+    """
+    try:
+        os.remove(os.path.join(settings.MEDIA_ROOT, segment.path))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Error deleting message segment {segment.path}: {str(e)}")
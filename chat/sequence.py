@@ -0,0 +1,178 @@
+import asyncio
+import weakref
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from django.utils.module_loading import import_string
+from .models import Message, RoomStats
+
+# Sequence backend shared by every consumer and view of this process, created on first use
+_backend = None
+
+
+class InMemorySequenceBackend:
+    """
+    Sequence backend keeping the counter of each room in process memory.
+    Suitable for single-node deployments, where every message of a room
+    is sent through the same server process.
+    """
+
+    def __init__(self, **options):
+        self.counters = {}  # chat session id -> last sequence number handed out
+
+    async def next_seq(self, chat_session_id, seed):
+        """
+        Return the next sequence number of a room. `seed` is a coroutine function returning
+        the last number stored in the database; it is only awaited for rooms without a counter.
+        """
+        if chat_session_id not in self.counters:
+            stored = await seed()
+            self.counters.setdefault(chat_session_id, stored)  # Another connection may have seeded it meanwhile
+        self.counters[chat_session_id] += 1
+        return self.counters[chat_session_id]
+
+    async def current_seq(self, chat_session_id):
+        """
+        Return the last sequence number handed out for a room, or None if it has no counter.
+        """
+        return self.counters.get(chat_session_id)
+
+    async def advance(self, chat_session_id, floor):
+        """
+        Move the counter of a room up to `floor` if it is below, so that the next
+        number handed out is above every number already in use.
+        """
+        self.counters[chat_session_id] = max(self.counters.get(chat_session_id, 0), floor)
+
+
+class RedisSequenceBackend:
+    """
+    Sequence backend keeping the counter of each room in Redis, so that every server
+    process numbers the messages of a room from the same counter. A missing counter,
+    e.g. after Redis was flushed, is seeded from the database and incremented in one script.
+    """
+
+    key_prefix = 'chat:seq'
+
+    # The expiry is refreshed by every increment, so the counter of a room only expires
+    # once nothing was sent to it for `expiry` seconds, long after its messages were written
+    script = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            if ARGV[1] == '' then
+                return false
+            end
+            redis.call('SET', KEYS[1], ARGV[1])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return redis.call('INCR', KEYS[1])
+    """
+
+    advance_script = """
+        local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if current < tonumber(ARGV[1]) then
+            redis.call('SET', KEYS[1], ARGV[1])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    """
+
+    def __init__(self, url=None, expiry=None, **options):
+        self.url = url or getattr(settings, 'CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+        # Counters of rooms without messages for this long are dropped and seeded again on the next message
+        self.expiry = expiry or 7 * 24 * 60 * 60
+        self._clients = weakref.WeakKeyDictionary()  # One client and registered script per event loop
+
+    def _client(self):
+        """
+        Return the Redis client and the registered scripts for the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            connection = self._connect()
+            client = self._clients[loop] = (
+                connection,
+                connection.register_script(self.script),
+                connection.register_script(self.advance_script),
+            )
+        return client
+
+    def _connect(self):
+        """
+        Open a Redis client for the running event loop.
+        """
+        import redis.asyncio as redis
+
+        return redis.from_url(self.url)
+
+    def _key(self, chat_session_id):
+        return f"{self.key_prefix}:{chat_session_id}"
+
+    async def next_seq(self, chat_session_id, seed):
+        _, script, _ = self._client()
+        key = self._key(chat_session_id)
+        seq = await script(keys=[key], args=['', self.expiry])
+        if seq is None:
+            seq = await script(keys=[key], args=[await seed(), self.expiry])
+        return seq
+
+    async def current_seq(self, chat_session_id):
+        connection, _, _ = self._client()
+        seq = await connection.get(self._key(chat_session_id))
+        return int(seq) if seq is not None else None
+
+    async def advance(self, chat_session_id, floor):
+        _, _, advance = self._client()
+        await advance(keys=[self._key(chat_session_id)], args=[floor, self.expiry])
+
+
+def get_sequence_backend():
+    """
+    Return the sequence backend configured by the CHAT_SEQUENCE_BACKEND setting.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'CHAT_SEQUENCE_BACKEND', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.sequence.InMemorySequenceBackend'))
+        _backend = backend_class(**config.get('OPTIONS', {}))
+    return _backend
+
+
+def stored_seq(chat_session_id):
+    """
+    Return the highest sequence number written to a room's messages, or 0.
+    RoomStats.last_seq is only a hint, moved forward after each write; the room's
+    highest numbered message is read through the (chat_session, seq) unique index too.
+    """
+    last_seq = RoomStats.objects.filter(chat_session_id=chat_session_id).values_list('last_seq', flat=True).first() or 0
+    max_seq = Message.objects.filter(chat_session_id=chat_session_id).aggregate(max_seq=Max('seq'))['max_seq'] or 0
+    return max(last_seq, max_seq)
+
+
+async def next_seq(chat_session_id, floor=0):
+    """
+    Assign the next sequence number of a room to a message being sent.
+    Numbers of a room increase by one per message, so a client that missed
+    messages can tell from the gap and ask for exactly those (see ChatConsumer.resume).
+    A counter that has to be seeded starts above both the stored numbers and `floor`,
+    the highest number of the messages still waiting to be written by the caller.
+    """
+    async def seed():
+        return max(await database_sync_to_async(stored_seq)(chat_session_id), floor)
+
+    return await get_sequence_backend().next_seq(chat_session_id, seed)
+
+
+async def advance_past_stored(chat_session_id):
+    """
+    Move the counter of a room past every number written to the database, after a write
+    was rejected because a number had been handed out twice, e.g. by a counter seeded
+    from another process's view of the room.
+    """
+    await get_sequence_backend().advance(chat_session_id, await database_sync_to_async(stored_seq)(chat_session_id))
+
+
+async def current_seq(chat_session_id):
+    """
+    Return the last sequence number assigned in a room, or None if the backend holds no counter for it yet.
+    """
+    return await get_sequence_backend().current_seq(chat_session_id)
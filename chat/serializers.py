@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from accounts.models import User
 from .models import ChatSession, Message
 
 class ChatSessionSerializer(serializers.ModelSerializer):
@@ -20,4 +21,25 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ['id', 'chat_session', 'user', 'user_username', 'message', 'timestamp']
+        fields = ['id', 'chat_session', 'seq', 'user', 'user_username', 'message', 'timestamp']
+        read_only_fields = ['chat_session', 'user']  # Taken from the URL and the logged-in user
+
+class MessageSearchResultSerializer(MessageSerializer):
+    """
+    Serializer for full-text search results. Adds the room name and the match rank.
+    """
+    room_name = serializers.ReadOnlyField(source='chat_session.name')
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['room_name', 'rank']
+
+class UserSearchResultSerializer(serializers.ModelSerializer):
+    """
+    Serializer for user search results. Only exposes what is needed to pick a user;
+    email addresses can be searched by prefix but are never returned.
+    """
+
+    class Meta:
+        model = User
+        fields = ['id', 'username']
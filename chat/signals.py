@@ -0,0 +1,211 @@
+from collections import Counter
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from . import acl, moderation, segments, stats, unread
+from .expiry import schedule_room_expiry
+from .models import ChatSession, Message, MessageSegment, ModeratedTerm
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=ChatSession.allowed_users.through)
+def invalidate_allowed_users(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidate the cached allowed-user sets of the chat sessions whose allowed users changed.
+    Handles changes made from either side of the relation.
+    """
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            acl.invalidate(acl.allowed_users_key(instance.pk))
+        return
+
+    # The relation was changed from the user's side; pk_set holds chat session ids
+    if action == 'pre_clear':
+        pk_set = set(instance.allowed_chat_sessions.values_list('id', flat=True))
+    elif action not in ('post_add', 'post_remove'):
+        return
+    for chat_session_id in pk_set or ():
+        acl.invalidate(acl.allowed_users_key(chat_session_id))
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidate the cached member sets of the groups whose members changed.
+    """
+    if reverse:
+        # The relation was changed from the group's side
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            acl.invalidate(acl.group_key(instance.name))
+        return
+
+    if action == 'pre_clear':
+        group_names = instance.groups.values_list('name', flat=True)
+    elif action in ('post_add', 'post_remove'):
+        group_names = Group.objects.filter(id__in=pk_set).values_list('name', flat=True)
+    else:
+        return
+    for group_name in group_names:
+        acl.invalidate(acl.group_key(group_name))
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group(sender, instance, **kwargs):
+    """
+    Invalidate the cached member set of a group that was created, renamed or deleted.
+    """
+    acl.invalidate(acl.group_key(instance.name))
+
+
+@receiver(post_save, sender=ChatSession)
+def invalidate_new_chat_session(sender, instance, created, **kwargs):
+    """
+    Make sure a new chat session never sees a set cached under a reused primary key.
+    """
+    if created:
+        acl.invalidate(acl.allowed_users_key(instance.pk))
+
+
+@receiver(post_delete, sender=ChatSession)
+def invalidate_deleted_chat_session(sender, instance, **kwargs):
+    """
+    Drop the cached allowed-user set of a deleted chat session.
+    """
+    acl.invalidate(acl.allowed_users_key(instance.pk))
+
+
+@receiver(pre_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    """
+    Invalidate every set a user is part of before the user is deleted,
+    since deleting the user does not send m2m_changed.
+    """
+    for group_name in instance.groups.values_list('name', flat=True):
+        acl.invalidate(acl.group_key(group_name))
+    for chat_session_id in instance.allowed_chat_sessions.values_list('id', flat=True):
+        acl.invalidate(acl.allowed_users_key(chat_session_id))
+
+
+@receiver(post_init, sender=ChatSession)
+def remember_expiry_time(sender, instance, **kwargs):
+    """
+    Remember the expiry time a chat session was built or loaded with, to detect changes on save.
+    """
+    instance._scheduled_expiry_time = instance.expiry_time
+
+
+@receiver(post_save, sender=ChatSession)
+def schedule_expiry(sender, instance, created, **kwargs):
+    """
+    Schedule a chat session's expiry when it is created with an expiry time, and whenever
+    its expiry time is set or changed later. Scheduling waits for the transaction to commit
+    so that the task sees the saved room.
+    """
+    if instance.expiry_time is None or (not created and instance.expiry_time == instance._scheduled_expiry_time):
+        return
+    instance._scheduled_expiry_time = instance.expiry_time
+
+    chat_session_id, expiry_time = instance.pk, instance.expiry_time
+    transaction.on_commit(lambda: schedule_room_expiry(chat_session_id, expiry_time))
+
+
+@receiver(post_save, sender=ChatSession)
+def create_room_stats(sender, instance, created, **kwargs):
+    """
+    Give every new chat session its statistics row.
+    """
+    if created:
+        stats.create_room_stats(instance.pk)
+
+
+@receiver(m2m_changed, sender=ChatSession.participants.through)
+def update_participant_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Recount the participants of the chat sessions whose participants changed.
+    Handles changes made from either side of the relation.
+    """
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            stats.refresh_participant_count(instance.pk)
+        return
+
+    # The relation was changed from the user's side; pk_set holds chat session ids
+    if action == 'pre_clear':
+        instance._cleared_chat_session_ids = set(instance.chat_sessions.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_chat_session_ids', ())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    for chat_session_id in pk_set or ():
+        stats.refresh_participant_count(chat_session_id)
+
+
+@receiver(m2m_changed, sender=ChatSession.participants.through)
+def update_read_cursors(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Give new participants a read cursor and drop the cursors of participants who were removed.
+    Handles changes made from either side of the relation.
+    """
+    if action not in ('post_add', 'post_remove'):
+        return
+    update = unread.create_cursors if action == 'post_add' else unread.delete_cursors
+    if not reverse:
+        update(instance.pk, pk_set)
+        return
+
+    # The relation was changed from the user's side; pk_set holds chat session ids
+    for chat_session_id in pk_set:
+        update(chat_session_id, [instance.pk])
+
+
+@receiver(pre_delete, sender=User)
+def remember_deleted_user_rooms(sender, instance, **kwargs):
+    """
+    Remember the rooms a user participates in before the user is deleted,
+    since deleting the user does not send m2m_changed.
+    """
+    instance._participant_chat_session_ids = list(instance.chat_sessions.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=User)
+def update_deleted_user_rooms(sender, instance, **kwargs):
+    """
+    Recount the participants of the rooms a deleted user participated in.
+    """
+    for chat_session_id in getattr(instance, '_participant_chat_session_ids', ()):
+        stats.refresh_participant_count(chat_session_id)
+
+
+@receiver(post_save, sender=Message)
+def record_saved_message(sender, instance, created, **kwargs):
+    """
+    Update the last message time and unread counts of a room when a single message is saved.
+    Messages written in batches by the chat consumer are recorded by the buffer instead,
+    since bulk_create sends no signals.
+    """
+    if created:
+        stats.record_messages(instance.chat_session_id, instance.timestamp, last_seq=instance.seq)
+        unread.record_messages(instance.chat_session_id, Counter([instance.user_id]))
+
+
+@receiver(post_delete, sender=MessageSegment)
+def delete_segment_file(sender, instance, **kwargs):
+    """
+    Remove the file of a deleted segment, e.g. when its room is deleted, once the deletion is committed.
+    """
+    transaction.on_commit(lambda: segments.delete_segment_file(instance))
+
+
+@receiver(post_save, sender=ModeratedTerm)
+@receiver(post_delete, sender=ModeratedTerm)
+def invalidate_moderated_terms(sender, instance, **kwargs):
+    """
+    Rebuild the moderation automaton once a term change is committed, so that
+    no process compiles the old list under the new version.
+    """
+    transaction.on_commit(moderation.invalidate)
@@ -0,0 +1,39 @@
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import ChatSession, RoomStats
+
+
+def create_room_stats(chat_session_id):
+    """
+    Create the statistics row of a new chat session.
+    """
+    RoomStats.objects.get_or_create(chat_session_id=chat_session_id)
+
+
+def record_messages(chat_session_id, last_timestamp, last_seq=None):
+    """
+    Record that messages up to `last_timestamp`, and up to sequence number `last_seq`
+    if given, were written to a chat session. Uses a single UPDATE; neither value ever
+    moves backwards, so batches written out of order leave the newest in place.
+    """
+    updates = {
+        'last_message_at': Greatest(Coalesce(F('last_message_at'), Value(last_timestamp)), Value(last_timestamp)),
+    }
+    if last_seq:
+        updates['last_seq'] = Greatest(F('last_seq'), Value(last_seq))
+    RoomStats.objects.filter(chat_session_id=chat_session_id).update(**updates)
+
+
+def refresh_participant_count(chat_session_id):
+    """
+    Recount the participants of a chat session after its participants changed.
+    """
+    count = ChatSession.participants.through.objects.filter(chatsession_id=chat_session_id).count()
+    RoomStats.objects.filter(chat_session_id=chat_session_id).update(participant_count=count)
+
+
+def set_online_count(chat_session_id, online_count):
+    """
+    Store the number of users currently connected to a chat session.
+    """
+    RoomStats.objects.filter(chat_session_id=chat_session_id).update(online_count=online_count)
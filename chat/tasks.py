@@ -1,9 +1,20 @@
 # chat/tasks.py
 
+from asgiref.sync import async_to_sync
 from celery import shared_task
+from channels.layers import get_channel_layer
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import TruncHour
 from django.utils import timezone
-from .models import ChatSession
+from . import lobby
+from .archive import archive_room
+from .fanout import group_send, room_groups
+from .segments import tier_room
+from .models import ChatSession, ChatAccessAttempt, ChatAccessRollup, Message
 import logging
+import time
 
 # Set up logging for this module
 logger = logging.getLogger(__name__)
@@ -13,29 +24,224 @@ def delete_expired_rooms():
     """
     Task to delete chat rooms that have expired.
     Runs as a scheduled task using Celery and checks for rooms where the expiry time has passed.
+    Rooms are normally removed at their exact expiry time by expire_room, so this scan is a
+    safety net for rooms whose expiry was never scheduled or whose scheduled task was lost.
+    Rooms are deleted in bounded batches, and each room's messages are deleted in chunks before
+    the room itself, so no single transaction holds long write locks. When CHAT_EXPIRY_ARCHIVE
+    is enabled, each room's messages are first archived to a compressed NDJSON file.
     """
     try:
         now = timezone.now()
         logger.info(f"Running delete_expired_rooms task at {now}.")  # Log the current time when the task runs
 
-        # Query for chat sessions that have expired
-        expired_rooms = ChatSession.objects.filter(expiry_time__lt=now)
-        expired_rooms_count = expired_rooms.count()
+        room_batch_size = getattr(settings, 'CHAT_EXPIRY_ROOM_BATCH_SIZE', 50)
+        message_batch_size = getattr(settings, 'CHAT_EXPIRY_MESSAGE_BATCH_SIZE', 1000)
+        archive = getattr(settings, 'CHAT_EXPIRY_ARCHIVE', False)
 
-        # Log the number of expired rooms before deletion
-        if expired_rooms_count > 0:
-            logger.info(f"Deleting {expired_rooms_count} expired rooms.")
+        started = time.monotonic()
+        expired_rooms_count = 0
+        deleted_messages_count = 0
+        while True:
+            # Query for the next batch of chat sessions that have expired
+            expired_rooms = list(
+                ChatSession.objects.filter(expiry_time__lt=now).order_by('expiry_time')[:room_batch_size]
+            )
+            if not expired_rooms:
+                break
+
+            for chat_session in expired_rooms:
+                deleted_messages_count += remove_expired_room(chat_session, message_batch_size, archive)
+                expired_rooms_count += 1
 
-        # Delete the expired chat sessions
-        expired_rooms.delete()
+        elapsed = time.monotonic() - started
+        rows_per_second = (expired_rooms_count + deleted_messages_count) / elapsed if elapsed > 0 else 0.0
 
         # Log confirmation after deletion
         if expired_rooms_count > 0:
-            logger.info(f"Deleted {expired_rooms_count} expired rooms successfully.")
+            logger.info(
+                f"Deleted {expired_rooms_count} expired rooms and {deleted_messages_count} messages "
+                f"in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)."
+            )
+
+        return (
+            f"Deleted {expired_rooms_count} expired rooms and {deleted_messages_count} messages "
+            f"({rows_per_second:.0f} rows/s)."
+        )
 
-        return f"Deleted {expired_rooms_count} expired rooms."
-    
     except Exception as e:
         # Log any errors that occur during the task
         logger.error(f"Error deleting expired rooms: {str(e)}")
         return f"Error occurred: {str(e)}"
+
+
+@shared_task
+def expire_room(chat_session_id, expiry_time):
+    """
+    Task to remove a single chat room at its expiry time.
+    Scheduled with an ETA when the room's expiry time is set. If the room is gone or its
+    expiry time has changed since the task was scheduled, the task does nothing; the
+    rescheduled expiry takes care of the room instead.
+    """
+    try:
+        chat_session = ChatSession.objects.filter(id=chat_session_id).first()
+        if chat_session is None or chat_session.expiry_time != datetime.fromisoformat(expiry_time):
+            return f"Chat session {chat_session_id} was deleted or rescheduled."
+
+        if chat_session.expiry_time > timezone.now():
+            # Timers may fire slightly early; try again at the exact time
+            from .expiry import schedule_room_expiry
+            schedule_room_expiry(chat_session.id, chat_session.expiry_time)
+            return f"Chat session {chat_session_id} has not expired yet."
+
+        deleted_messages_count = remove_expired_room(
+            chat_session,
+            getattr(settings, 'CHAT_EXPIRY_MESSAGE_BATCH_SIZE', 1000),
+            getattr(settings, 'CHAT_EXPIRY_ARCHIVE', False),
+        )
+        logger.info(f"Expired room '{chat_session.name}' with {deleted_messages_count} messages.")
+        return f"Expired room '{chat_session.name}' with {deleted_messages_count} messages."
+
+    except Exception as e:
+        # Log any errors that occur during the task
+        logger.error(f"Error expiring chat session {chat_session_id}: {str(e)}")
+        return f"Error occurred: {str(e)}"
+
+
+def remove_expired_room(chat_session, message_batch_size, archive):
+    """
+    Remove an expired chat room: optionally archive its messages, delete them in chunks,
+    delete the room, and tell connected clients and open lobby pages that the room has expired.
+    Returns the number of messages deleted.
+    """
+    if archive:
+        path = archive_room(chat_session, chunk_size=message_batch_size)
+        logger.info(f"Archived messages of room '{chat_session.name}' to {path}.")
+
+    chat_session_id = chat_session.id
+    deleted_messages_count = delete_messages_in_batches(chat_session_id, message_batch_size)
+    chat_session.delete()
+
+    try:
+        async_to_sync(group_send)(
+            get_channel_layer(), room_groups(chat_session_id, chat_session.name), {'type': 'room_expired'}
+        )
+    except Exception as e:
+        logger.error(f"Error notifying clients of expired chat session {chat_session_id}: {str(e)}")
+    lobby.room_removed(chat_session_id, lobby.ROOM_EXPIRED)
+    return deleted_messages_count
+
+
+def delete_messages_in_batches(chat_session_id, batch_size):
+    """
+    Delete the messages of a chat session in chunks of at most `batch_size` rows.
+    Returns the number of messages deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            Message.objects.filter(chat_session_id=chat_session_id).values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += Message.objects.filter(id__in=ids).delete()[0]
+
+
+@shared_task
+def rollup_access_attempts():
+    """
+    Task to roll raw chat access attempts up into per-hour, per-room, per-user counts
+    and to prune raw attempts that are older than the retention window.
+    Counts are recomputed from the raw rows, so re-running the task is safe. Attempts are
+    buffered for up to CHAT_AUDIT_FLUSH_INTERVAL seconds before they are written, so every
+    hour that late attempts may still belong to, from that long before the last rolled-up
+    hour onwards, is recomputed as well.
+    """
+    try:
+        now = timezone.now()
+        end = now.replace(minute=0, second=0, microsecond=0)  # Only complete hours are rolled up
+        retention = timedelta(days=getattr(settings, 'CHAT_AUDIT_RETENTION_DAYS', 30))
+
+        latest_hour = ChatAccessRollup.objects.aggregate(latest=Max('hour'))['latest']
+        if latest_hour is not None:
+            lookback = timedelta(seconds=getattr(settings, 'CHAT_AUDIT_FLUSH_INTERVAL', 5))
+            start = (latest_hour - lookback).replace(minute=0, second=0, microsecond=0)
+            if start < now - retention:
+                start = latest_hour  # Earlier raw attempts may have been pruned; keep their rollups as they are
+        else:
+            start = ChatAccessAttempt.objects.aggregate(earliest=Min('timestamp'))['earliest']
+
+        rollups = []
+        if start is not None and start < end:
+            counts = (
+                ChatAccessAttempt.objects
+                .filter(timestamp__gte=start, timestamp__lt=end)
+                .annotate(hour=TruncHour('timestamp'))
+                .values('hour', 'room_name', 'user_id')
+                .annotate(
+                    success_count=Count('id', filter=Q(success=True)),
+                    denied_count=Count('id', filter=Q(success=False)),
+                )
+                .order_by()
+            )
+            rollups = [ChatAccessRollup(**row) for row in counts]
+            ChatAccessRollup.objects.bulk_create(
+                rollups,
+                update_conflicts=True,
+                unique_fields=['hour', 'room_name', 'user'],
+                update_fields=['success_count', 'denied_count'],
+            )
+        logger.info(f"Rolled up chat access attempts into {len(rollups)} hourly rows.")
+
+        # Prune raw attempts past the retention window, in bounded batches
+        cutoff = min(now - retention, end)
+        batch_size = getattr(settings, 'CHAT_AUDIT_PRUNE_BATCH_SIZE', 1000)
+        pruned = 0
+        while True:
+            ids = list(
+                ChatAccessAttempt.objects.filter(timestamp__lt=cutoff).values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            pruned += ChatAccessAttempt.objects.filter(id__in=ids).delete()[0]
+
+        if pruned > 0:
+            logger.info(f"Pruned {pruned} chat access attempts older than {cutoff}.")
+
+        return f"Rolled up {len(rollups)} hourly rows and pruned {pruned} access attempts."
+
+    except Exception as e:
+        # Log any errors that occur during the task
+        logger.error(f"Error rolling up access attempts: {str(e)}")
+        return f"Error occurred: {str(e)}"
+
+
+@shared_task
+def tier_old_messages():
+    """
+    Task to move the old messages of rooms that never expire (the predefined rooms) out of
+    the Message table into compressed monthly segment files, indexed by MessageSegment.
+    Only messages older than CHAT_TIERING_AGE_DAYS are moved, so recent history stays in
+    the database; history and export read the segments when a client pages back that far.
+    Tiering is opt-in through CHAT_TIERING_ENABLED, since the REST message list and
+    full-text search only read the database.
+    """
+    if not getattr(settings, 'CHAT_TIERING_ENABLED', False):
+        return "Tiering is disabled."
+
+    try:
+        cutoff = timezone.now() - timedelta(days=getattr(settings, 'CHAT_TIERING_AGE_DAYS', 90))
+        chunk_size = getattr(settings, 'CHAT_EXPIRY_MESSAGE_BATCH_SIZE', 1000)
+
+        rooms = ChatSession.objects.filter(expiry_time__isnull=True, messages__timestamp__lt=cutoff).distinct()
+        moved = 0
+        for chat_session in rooms.iterator():
+            moved += tier_room(chat_session, cutoff, chunk_size=chunk_size)
+
+        if moved > 0:
+            logger.info(f"Moved {moved} chat messages older than {cutoff} to segments.")
+        return f"Moved {moved} messages to segments."
+
+    except Exception as e:
+        # Log any errors that occur during the task
+        logger.error(f"Error tiering old chat messages: {str(e)}")
+        return f"Error occurred: {str(e)}"
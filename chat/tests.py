@@ -1,12 +1,71 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import msgpack
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
 from channels.layers import get_channel_layer
-from .models import ChatSession, Message, ChatAccessAttempt
+from . import buffers, expiry, fanout, metrics, moderation, recent, sequence
+from .acl import check_room_access
+from .audit import AccessAttemptBuffer
+from .expiry import TimerWheel, schedule_pending_expiries
+from .tasks import delete_expired_rooms, expire_room, rollup_access_attempts, tier_old_messages
+from .buffers import MessageBuffer
+from .export import export_records
+from .history import fetch_after, fetch_page
+from .moderation import TermAutomaton
+from .presence import get_presence_backend
+from .queues import SendQueue, DISCONNECT, OVERFLOW_CLOSE_CODE, RESYNC_FRAME
+from .ratelimit import InMemoryRateLimitBackend, get_rate_limit_backend
+from .recent import InMemoryRecentBackend
+from .routing import websocket_urlpatterns
+from .models import ChatSession, Message, ChatAccessAttempt, ChatAccessRollup, FlaggedMessage, MessageSegment, ModeratedTerm, ReadCursor
 from accounts.models import User
+from django.contrib.auth.models import AnonymousUser, Group
+from django.core.cache import cache
 from EduConnect.asgi import application
 from django.core.exceptions import PermissionDenied
 
+# Channel layer used by tests that should not depend on a running Redis server
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def chat_communicator(room_name, user, subprotocols=None, query=''):
+    """Return a WebSocket communicator for a chat room, connected as the given user."""
+    communicator = WebsocketCommunicator(
+        URLRouter(websocket_urlpatterns), f"/ws/chat/{room_name}/{query}", subprotocols=subprotocols
+    )
+    communicator.scope['user'] = user
+    return communicator
+
+
+async def join_room(communicator):
+    """
+    Connect a communicator and consume the frames every new connection receives:
+    the latest history page, then the join event of its own user.
+    Returns the connection status and the history frame.
+    """
+    connected, _ = await communicator.connect()
+    if not connected:
+        return connected, None
+    history = await communicator.receive_json_from()
+    await communicator.receive_json_from()  # Own join event
+    return connected, history
+
 
 class ChatModelTests(TestCase):
     """Tests for the ChatSession and Message models."""
@@ -37,17 +96,22 @@ class ChatModelTests(TestCase):
 class ChatWebSocketTests(TestCase):
     """Tests for WebSocket communication in chat sessions."""
 
+    def setUp(self):
+        """Set up a user and the chat session they connect to."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        ChatSession.objects.create(name='TestRoom', created_by=self.user)
+
     async def test_chat_websocket(self):
         """Test WebSocket connection for chat."""
-        communicator = WebsocketCommunicator(application, "/ws/chat/TestRoom/")
+        communicator = chat_communicator('TestRoom', self.user)
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
         await communicator.disconnect()
 
     async def test_websocket_message_sending(self):
         """Test WebSocket message sending and receiving."""
-        communicator = WebsocketCommunicator(application, "/ws/chat/TestRoom/")
-        connected, _ = await communicator.connect()
+        communicator = chat_communicator('TestRoom', self.user)
+        connected, _ = await join_room(communicator)
         self.assertTrue(connected)
 
         # Send a message through the WebSocket
@@ -176,3 +240,1610 @@ class ChatAccessTests(TestCase):
         # The form should return an error message and not redirect
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Room name cannot be empty.")
+
+
+class MessageBufferTests(TestCase):
+    """Tests for the write-behind buffer that persists chat messages in batches."""
+
+    def setUp(self):
+        """Set up a user and a chat session to write messages to."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        sequence._backend = None
+        metrics.reset()
+
+    def make_buffer(self, **kwargs):
+        """Return a buffer for the test chat session."""
+        return MessageBuffer(self.chat_session.id, **kwargs)
+
+    async def test_flush_when_batch_is_full(self):
+        """Test that messages are written in one batch once the batch size is reached."""
+        buffer = self.make_buffer(max_batch_size=3, flush_interval=60)
+        await buffer.add(self.user, 'one')
+        await buffer.add(self.user, 'two')
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+
+        await buffer.add(self.user, 'three')
+        messages = await database_sync_to_async(list)(Message.objects.values_list('message', flat=True))
+        self.assertEqual(messages, ['one', 'two', 'three'])
+        self.assertEqual(metrics.snapshot()['observations']['chat.buffer.batch_size']['max'], 3)
+
+    async def test_flush_after_interval(self):
+        """Test that a partial batch is written once the flush interval elapses."""
+        buffer = self.make_buffer(max_batch_size=100, flush_interval=0.01)
+        await buffer.add(self.user, 'Hello')
+        await asyncio.sleep(0.05)
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+        self.assertIn('chat.buffer.flush_latency_ms', metrics.snapshot()['observations'])
+
+    async def test_failed_batch_is_kept_and_retried(self):
+        """Test that a batch whose write fails stays pending and is written by the next flush."""
+        class FlakyBuffer(MessageBuffer):
+            attempts = 0
+
+            def write(self, batch):
+                self.attempts += 1
+                if self.attempts == 1:
+                    raise RuntimeError('database is locked')
+                super().write(batch)
+
+        buffer = FlakyBuffer(self.chat_session.id, max_batch_size=2, flush_interval=60)
+        buffer.retry_delay = 0.01
+        await buffer.add(self.user, 'one')
+        await buffer.add(self.user, 'two')
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+        self.assertEqual([message.message for message in buffer.pending], ['one', 'two'])
+
+        await buffer.add(self.user, 'three')  # Waits for the retry instead of writing right away
+        await asyncio.sleep(0.05)
+        messages = await database_sync_to_async(list)(Message.objects.values_list('message', flat=True))
+        self.assertEqual(messages, ['one', 'two', 'three'])
+        self.assertEqual(metrics.snapshot()['counters']['chat.buffer.flush_errors'], 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTests(TestCase):
+    """Tests for connection handling and message persistence in the chat consumer."""
+
+    def setUp(self):
+        """Set up a user and the chat session they connect to."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        sequence._backend = None
+        recent._backend = None
+        metrics.reset()
+
+    async def test_pending_messages_flushed_on_disconnect(self):
+        """Test that buffered messages are written when the socket disconnects."""
+        communicator = chat_communicator('TestRoom', self.user)
+        connected, _ = await join_room(communicator)
+        self.assertTrue(connected)
+        await communicator.send_json_to({'message': 'Hello!', 'room': 'TestRoom'})
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(message='Hello!').exists)())
+
+    async def test_anonymous_connection_rejected(self):
+        """Test that unauthenticated users cannot connect."""
+        communicator = chat_communicator('TestRoom', AnonymousUser())
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_unknown_room_rejected(self):
+        """Test that connections to rooms that do not exist are rejected."""
+        communicator = chat_communicator('NoSuchRoom', self.user)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_sender_comes_from_connection(self):
+        """Test that the username in the payload cannot be used to impersonate someone else."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await communicator.send_json_to({'message': 'Hi', 'username': 'someone_else'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['username'], 'user1')
+        await communicator.disconnect()
+
+    async def test_room_mismatch_rejected(self):
+        """Test that frames declaring another room get an error frame and are not broadcast."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await communicator.send_json_to({'message': 'Hi', 'room': 'OtherRoom'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        self.assertEqual(response['error'], 'room_mismatch')
+        await communicator.disconnect()
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+
+    async def test_typing_is_relayed_without_database_access(self):
+        """Test that typing events reach other connections, are throttled, and are never stored."""
+        other = await database_sync_to_async(User.objects.create_user)(username='user2', password='pass123')
+        typist = chat_communicator('TestRoom', self.user)
+        watcher = chat_communicator('TestRoom', other)
+        await join_room(typist)
+        await join_room(watcher)
+        await typist.receive_json_from()  # Join event of the watcher
+
+        await typist.send_json_to({'type': 'typing'})
+        await typist.send_json_to({'type': 'typing'})  # Within the interval, so throttled
+        self.assertEqual(await watcher.receive_json_from(), {'type': 'typing', 'username': 'user1'})
+        self.assertTrue(await watcher.receive_nothing())
+        self.assertTrue(await typist.receive_nothing())  # The sender gets no echo
+        self.assertEqual(metrics.snapshot()['counters']['chat.ephemeral.throttled'], 1)
+
+        await typist.disconnect()
+        await watcher.disconnect()
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+
+    async def test_unknown_frame_type(self):
+        """Test that frames of an unknown type get an error frame."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await communicator.send_json_to({'type': 'dance'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['error'], 'unknown_type')
+        await communicator.disconnect()
+
+    async def test_non_object_frames_rejected(self):
+        """Test that frames decoding to an array or a scalar get an error frame and keep the socket open."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        for frame in (['Hi'], 'Hi', 42):
+            await communicator.send_json_to(frame)
+            self.assertEqual((await communicator.receive_json_from())['error'], 'invalid_frame')
+        await communicator.send_json_to({'message': 'Still here'})
+        self.assertEqual((await communicator.receive_json_from())['message'], 'Still here')
+        await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        """Test that clients offering the msgpack subprotocol exchange binary MessagePack frames."""
+        communicator = chat_communicator('TestRoom', self.user, subprotocols=['msgpack'])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, 'msgpack')
+        self.assertEqual(msgpack.unpackb((await communicator.receive_output())['bytes'])['type'], 'history')
+        await communicator.receive_output()  # Own join event
+
+        await communicator.send_to(bytes_data=msgpack.packb({'message': 'Hi'}))
+        response = msgpack.unpackb((await communicator.receive_output())['bytes'])
+        self.assertEqual(response, {'message': 'Hi', 'username': 'user1', 'seq': 1})
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_HISTORY_PAGE_SIZE=2)
+class ChatHistoryTests(TestCase):
+    """Tests for keyset-paginated chat history."""
+
+    def setUp(self):
+        """Set up a chat session with five messages, two of which share a timestamp."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        recent._backend = None
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        now = timezone.now()
+        timestamps = [now, now + timedelta(seconds=1), now + timedelta(seconds=1),
+                      now + timedelta(seconds=2), now + timedelta(seconds=3)]
+        for index, timestamp in enumerate(timestamps):
+            Message.objects.create(chat_session=self.chat_session, user=self.user,
+                                   message=f'message {index}', timestamp=timestamp)
+
+    def test_pages_walk_back_without_gaps(self):
+        """Test that following the cursors returns every message exactly once."""
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = fetch_page(self.chat_session.id, before=cursor)
+            seen = [message['message'] for message in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f'message {index}' for index in range(5)])
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        with self.assertRaises(ValueError):
+            fetch_page(self.chat_session.id, before='not-a-cursor')
+
+    async def test_history_on_connect_and_load_older(self):
+        """Test that the latest page is sent on connect and older pages on request."""
+        communicator = chat_communicator('TestRoom', self.user)
+        _, response = await join_room(communicator)
+        self.assertEqual(response['type'], 'history')
+        self.assertEqual([m['message'] for m in response['messages']], ['message 3', 'message 4'])
+
+        await communicator.send_json_to({'type': 'history', 'before': response['next_cursor']})
+        response = await communicator.receive_json_from()
+        self.assertEqual([m['message'] for m in response['messages']], ['message 1', 'message 2'])
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatPresenceTests(TestCase):
+    """Tests for room presence tracking."""
+
+    def setUp(self):
+        """Set up two users and a chat session."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.other = User.objects.create_user(username='user2', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+
+    def test_room_view_does_not_write_participants(self):
+        """Test that viewing a room page no longer adds the user as a participant."""
+        self.client.login(username='user2', password='pass123')
+        self.client.get(reverse('chat:room', args=['TestRoom']))
+        self.assertFalse(self.chat_session.participants.filter(id=self.other.id).exists())
+
+    async def test_join_and_leave_events(self):
+        """Test that other connections see incremental join and leave events."""
+        first = chat_communicator('TestRoom', self.user)
+        await join_room(first)
+        second = chat_communicator('TestRoom', self.other)
+        await join_room(second)
+
+        event = await first.receive_json_from()
+        self.assertEqual((event['type'], event['event'], event['username'], event['online_count']),
+                         ('presence', 'join', 'user2', 2))
+        self.assertTrue(await database_sync_to_async(
+            self.chat_session.participants.filter(id=self.other.id).exists)())
+
+        await second.disconnect()
+        event = await first.receive_json_from()
+        self.assertEqual((event['event'], event['username'], event['online_count']), ('leave', 'user2', 1))
+        await first.disconnect()
+
+    async def test_second_tab_is_not_a_new_join(self):
+        """Test that a second connection of the same user does not announce a join."""
+        first = chat_communicator('TestRoom', self.user)
+        await join_room(first)
+        second = chat_communicator('TestRoom', self.user)
+        await second.connect()
+        await second.receive_json_from()  # History page
+        self.assertTrue(await first.receive_nothing())
+        await second.disconnect()
+        await first.disconnect()
+
+    def test_online_count_api(self):
+        """Test that the presence API reports the number of connected users."""
+        async_to_sync(get_presence_backend().join)(self.chat_session.id, self.other.id)
+        try:
+            self.client.login(username='user1', password='pass123')
+            response = self.client.get(reverse('chat:session_presence', args=[self.chat_session.id]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['online_count'], 1)
+        finally:
+            async_to_sync(get_presence_backend().leave)(self.chat_session.id, self.other.id)
+
+
+class SendQueueTests(TestCase):
+    """Tests for the bounded per-connection send queue."""
+
+    def setUp(self):
+        """Record what the queue sends and whether it closes the connection."""
+        self.sent = []
+        self.close_codes = []
+        metrics.reset()
+
+    async def send_batch(self, frames):
+        self.sent.append(frames)
+
+    async def close(self, code=None):
+        self.close_codes.append(code)
+
+    async def test_frames_within_a_tick_are_coalesced(self):
+        """Test that frames queued in the same tick are sent as one batch."""
+        queue = SendQueue(self.send_batch, self.close, max_size=10, tick=0.01)
+        for index in range(3):
+            queue.put({'message': index})
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [[{'message': 0}, {'message': 1}, {'message': 2}]])
+
+    async def test_drop_oldest_on_overflow(self):
+        """Test that a full queue drops its oldest frames under the drop_oldest policy."""
+        queue = SendQueue(self.send_batch, self.close, max_size=2, tick=0.01)
+        for index in range(4):
+            queue.put({'message': index})
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [[{'message': 2}, {'message': 3}]])
+        self.assertEqual(metrics.snapshot()['counters']['chat.send_queue.dropped'], 2)
+
+    async def test_disconnect_on_overflow(self):
+        """Test that a full queue sends a resync hint and closes under the disconnect policy."""
+        queue = SendQueue(self.send_batch, self.close, max_size=2, overflow_policy=DISCONNECT, tick=0.01)
+        for index in range(3):
+            queue.put({'message': index})
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [[RESYNC_FRAME]])
+        self.assertEqual(len(self.close_codes), 1)
+
+    async def test_ephemeral_frames_are_coalesced_and_shed_first(self):
+        """Test that ephemeral frames are coalesced per key and dropped once the queue is half full."""
+        queue = SendQueue(self.send_batch, self.close, max_size=4, tick=0.01)
+        queue.put_ephemeral({'type': 'typing', 'username': 'a', 'n': 1}, key=('typing', 'a'))
+        queue.put({'message': 0})
+        queue.put_ephemeral({'type': 'typing', 'username': 'a', 'n': 2}, key=('typing', 'a'))
+        queue.put({'message': 1})
+        queue.put_ephemeral({'type': 'typing', 'username': 'b'}, key=('typing', 'b'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [[{'message': 0}, {'message': 1}, {'type': 'typing', 'username': 'a', 'n': 2}]])
+        self.assertEqual(metrics.snapshot()['counters']['chat.send_queue.ephemeral_dropped'], 1)
+
+    async def test_frames_being_sent_count_against_the_limit(self):
+        """Test that a socket stuck in send overflows, counting the frames of the batch being sent."""
+        unblock = asyncio.Event()
+
+        async def blocking_send_batch(frames):
+            self.sent.append(frames)
+            if len(self.sent) == 1:
+                await unblock.wait()
+
+        queue = SendQueue(blocking_send_batch, self.close, max_size=3, overflow_policy=DISCONNECT, tick=0.01)
+        queue.put({'message': 0})
+        queue.put({'message': 1})
+        await asyncio.sleep(0.05)  # The first batch is stuck in send
+        queue.put({'message': 2})
+        self.assertEqual(self.close_codes, [])
+        queue.put({'message': 3})
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent[-1], [RESYNC_FRAME])
+        self.assertEqual(self.close_codes, [OVERFLOW_CLOSE_CODE])
+        unblock.set()
+
+    async def test_depth_gauge_per_connection(self):
+        """Test that a named queue reports its depth, including a stalled batch, until it is stopped."""
+        unblock = asyncio.Event()
+
+        async def blocking_send_batch(frames):
+            self.sent.append(frames)
+            await unblock.wait()
+
+        stalled = SendQueue(blocking_send_batch, self.close, max_size=10, tick=0.01, name='stalled')
+        idle = SendQueue(self.send_batch, self.close, max_size=10, tick=0.01, name='idle')
+        stalled.put({'message': 0})
+        stalled.put({'message': 1})
+        idle.put({'message': 0})
+        await asyncio.sleep(0.05)  # The first batch of the stalled queue is stuck in send
+        stalled.put({'message': 2})
+        gauges = metrics.snapshot()['gauges']
+        self.assertEqual((gauges['chat.send_queue.depth.stalled'], gauges['chat.send_queue.depth.idle']), (3, 0))
+
+        stalled.stop()
+        idle.stop()
+        self.assertNotIn('chat.send_queue.depth.stalled', metrics.snapshot()['gauges'])
+        unblock.set()
+
+
+class ChatBenchCommandTests(TestCase):
+    """Tests for the chatbench load-test command."""
+
+    def test_report(self):
+        """Test that a small run delivers every message to every room member and cleans up."""
+        out = StringIO()
+        call_command('chatbench', clients=2, rooms=1, messages=2, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['messages_sent'], 4)
+        self.assertEqual(report['deliveries'], 8)
+        self.assertEqual(report['db_rows'], 4)
+        self.assertIn('p99', report['fanout_latency_ms'])
+        self.assertGreater(report['bytes_received'], 0)
+        self.assertIn('cpu_per_message_us', report)
+        self.assertFalse(User.objects.filter(username__startswith='chatbench').exists())
+
+    def test_msgpack_report(self):
+        """Test that a run over the msgpack subprotocol delivers every message."""
+        out = StringIO()
+        call_command('chatbench', clients=2, rooms=1, messages=2, encoding='msgpack', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['encoding'], 'msgpack')
+        self.assertEqual(report['deliveries'], 8)
+
+    def test_shard_sweep(self):
+        """Test that a sweep reports each room size unsharded and sharded."""
+        out = StringIO()
+        call_command('chatbench', sweep='2,3', shards=2, messages=1, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual([(run['clients'], run['shards']) for run in report], [(2, 1), (2, 2), (3, 1), (3, 2)])
+        self.assertEqual([run['deliveries'] for run in report], [4, 4, 9, 9])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatAccessControlTests(TestCase):
+    """Tests for the cached room access resolver shared by the room view and the consumer."""
+
+    def setUp(self):
+        """Set up a private room and the Students group."""
+        cache.clear()
+        self.owner = User.objects.create_user(username='owner', password='pass123')
+        self.student = User.objects.create_user(username='student1', password='pass123')
+        self.private_room = ChatSession.objects.create(name='Private Room', created_by=self.owner, is_private=True)
+        self.private_room.allowed_users.add(self.owner)
+        self.students_room = ChatSession.objects.create(name='students', created_by=self.owner)
+        self.students_group = Group.objects.create(name='Students')
+
+    def test_decisions_are_cached(self):
+        """Test that repeated checks are answered without querying the database."""
+        check_room_access(self.owner, self.private_room)
+        with self.assertNumQueries(0):
+            self.assertEqual(check_room_access(self.owner, self.private_room), (True, None))
+            self.assertFalse(check_room_access(self.student, self.private_room)[0])
+
+    def test_allowed_users_change_invalidates_cache(self):
+        """Test that adding or removing an allowed user is seen by the next check."""
+        self.assertFalse(check_room_access(self.student, self.private_room)[0])
+        self.private_room.allowed_users.add(self.student)
+        self.assertTrue(check_room_access(self.student, self.private_room)[0])
+        self.student.allowed_chat_sessions.remove(self.private_room)
+        self.assertFalse(check_room_access(self.student, self.private_room)[0])
+
+    def test_group_change_invalidates_cache(self):
+        """Test that joining a group grants access to the group's predefined room."""
+        self.assertFalse(check_room_access(self.student, self.students_room)[0])
+        self.student.groups.add(self.students_group)
+        self.assertTrue(check_room_access(self.student, self.students_room)[0])
+
+    def test_sets_reloaded_once_too_old(self):
+        """Test that a change whose invalidation never reached this process is seen after CHAT_ACL_MAX_AGE."""
+        self.private_room.allowed_users.add(self.student)
+        self.assertTrue(check_room_access(self.student, self.private_room)[0])
+        # Removed without signals, as by another process whose invalidation went to its own cache
+        ChatSession.allowed_users.through.objects.filter(user=self.student).delete()
+        self.assertTrue(check_room_access(self.student, self.private_room)[0])
+        with override_settings(CHAT_ACL_MAX_AGE=0):
+            self.assertFalse(check_room_access(self.student, self.private_room)[0])
+
+    async def test_consumer_rejects_users_not_allowed(self):
+        """Test that the WebSocket consumer applies the same rules as the room view."""
+        communicator = chat_communicator('Private Room', self.student)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+        communicator = chat_communicator('Private Room', self.owner)
+        connected, _ = await join_room(communicator)
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+
+class ChatAccessAuditTests(TestCase):
+    """Tests for buffered access attempt auditing and hourly rollups."""
+
+    def setUp(self):
+        """Set up a user whose attempts are audited."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+
+    def test_attempts_are_not_written_by_requests(self):
+        """Test that recording attempts never writes them in the recording thread."""
+        buffer = AccessAttemptBuffer(batch_size=10, flush_interval=60)
+        buffer.record(self.user.id, 'Test Room', True)
+        buffer.record(self.user.id, 'Test Room', False)
+        self.assertFalse(ChatAccessAttempt.objects.exists())
+        self.assertEqual(buffer.flush(), 2)
+
+    def test_attempts_of_deleted_users_are_skipped(self):
+        """Test that a pending attempt of a user deleted before the flush is dropped."""
+        other = User.objects.create_user(username='user2', password='pass123')
+        buffer = AccessAttemptBuffer(batch_size=10, flush_interval=60)
+        buffer.record(other.id, 'Test Room', True)
+        buffer.record(self.user.id, 'Test Room', True)
+        other.delete()
+        self.assertEqual(buffer.flush(), 1)
+
+    @override_settings(CHAT_AUDIT_RETENTION_DAYS=1)
+    def test_rollup_and_prune(self):
+        """Test that complete hours are rolled up and raw rows past retention are pruned."""
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=2)
+        for minute, success in [(1, True), (2, False), (3, False)]:
+            ChatAccessAttempt.objects.create(user=self.user, room_name='students', success=success,
+                                             timestamp=hour + timedelta(minutes=minute))
+        recent = ChatAccessAttempt.objects.create(user=self.user, room_name='students', success=True,
+                                                  timestamp=timezone.now() - timedelta(hours=2))
+
+        rollup_access_attempts()
+
+        rollup = ChatAccessRollup.objects.get(hour=hour)
+        self.assertEqual((rollup.room_name, rollup.success_count, rollup.denied_count), ('students', 1, 2))
+        self.assertEqual(list(ChatAccessAttempt.objects.all()), [recent])
+
+        # Running the task again keeps the counts stable
+        rollup_access_attempts()
+        rollup.refresh_from_db()
+        self.assertEqual((rollup.success_count, rollup.denied_count), (1, 2))
+
+    def test_rollup_picks_up_attempts_written_late(self):
+        """Test that attempts written after their hour was rolled up are still counted."""
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        ChatAccessAttempt.objects.create(user=self.user, room_name='students', success=True,
+                                         timestamp=hour + timedelta(minutes=10))
+        ChatAccessAttempt.objects.create(user=self.user, room_name='students', success=True,
+                                         timestamp=hour + timedelta(hours=1, minutes=10))
+        rollup_access_attempts()
+
+        # An attempt from the end of the earlier hour, flushed after both hours were rolled up
+        ChatAccessAttempt.objects.create(user=self.user, room_name='students', success=False,
+                                         timestamp=hour + timedelta(minutes=59, seconds=59))
+        rollup_access_attempts()
+        self.assertEqual(ChatAccessRollup.objects.get(hour=hour).denied_count, 1)
+
+
+class AccessAttemptFlusherTests(TransactionTestCase):
+    """Tests for the background thread writing buffered access attempts."""
+
+    def test_quiet_process_flushes_on_time(self):
+        """Test that attempts are written once the flush interval elapses, without further attempts."""
+        user = User.objects.create_user(username='user1', password='pass123')
+        buffer = AccessAttemptBuffer(batch_size=100, flush_interval=0.05)
+        buffer.record(user.id, 'Test Room', True)
+        for _ in range(50):
+            if ChatAccessAttempt.objects.exists():
+                break
+            time.sleep(0.02)
+        self.assertEqual(ChatAccessAttempt.objects.count(), 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+                   CHAT_EXPIRY_ROOM_BATCH_SIZE=1, CHAT_EXPIRY_MESSAGE_BATCH_SIZE=2)
+class DeleteExpiredRoomsTests(TestCase):
+    """Tests for the chunked deletion of expired chat rooms."""
+
+    def setUp(self):
+        """Set up two expired rooms with messages and one live room."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        past = timezone.now() - timedelta(minutes=5)
+        self.expired = [
+            ChatSession.objects.create(name=f'Expired {index}', created_by=self.user, expiry_time=past)
+            for index in range(2)
+        ]
+        self.live = ChatSession.objects.create(name='Live', created_by=self.user,
+                                               expiry_time=timezone.now() + timedelta(hours=1))
+        for chat_session in self.expired + [self.live]:
+            for index in range(3):
+                Message.objects.create(chat_session=chat_session, user=self.user, message=f'message {index}')
+
+    def test_expired_rooms_and_messages_deleted(self):
+        """Test that only expired rooms and their messages are deleted."""
+        result = delete_expired_rooms()
+        self.assertTrue(result.startswith('Deleted 2 expired rooms and 6 messages'))
+        self.assertEqual(list(ChatSession.objects.all()), [self.live])
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_messages_archived_before_deletion(self):
+        """Test that each expired room's messages are archived as gzipped NDJSON when enabled."""
+        with tempfile.TemporaryDirectory() as media_root:
+            with self.settings(CHAT_EXPIRY_ARCHIVE=True, MEDIA_ROOT=media_root):
+                delete_expired_rooms()
+            archive_dir = os.path.join(media_root, 'chat_archives')
+            archives = sorted(os.listdir(archive_dir))
+            self.assertEqual(len(archives), 2)
+            with gzip.open(os.path.join(archive_dir, archives[0]), 'rt') as archive:
+                records = [json.loads(line) for line in archive]
+        self.assertEqual([record['message'] for record in records], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(records[0]['username'], 'user1')
+
+
+class IdleTimerWheel(TimerWheel):
+    """Timer wheel that never starts ticking, so tests can inspect the timers set on it."""
+
+    def start(self, on_start=None):
+        pass
+
+
+class TimerWheelTests(TestCase):
+    """Tests for the in-process timer wheel used for single-node room expiry."""
+
+    def test_timers_fire_at_their_tick(self):
+        """Test that timers fire after the right number of ticks, including after full turns."""
+        wheel = TimerWheel(tick=1.0, slots=4)
+        fired = []
+        wheel.schedule('soon', timezone.now() + timedelta(seconds=2), lambda: fired.append('soon'))
+        wheel.schedule('later', timezone.now() + timedelta(seconds=6), lambda: fired.append('later'))
+        for _ in range(2):
+            wheel.advance()
+        self.assertEqual(fired, ['soon'])
+        for _ in range(4):
+            wheel.advance()
+        self.assertEqual(fired, ['soon', 'later'])
+
+    def test_reschedule_replaces_timer(self):
+        """Test that scheduling a key again replaces its previous timer."""
+        wheel = TimerWheel(tick=1.0, slots=8)
+        fired = []
+        wheel.schedule(1, timezone.now() + timedelta(seconds=1), lambda: fired.append('old'))
+        wheel.schedule(1, timezone.now() + timedelta(seconds=3), lambda: fired.append('new'))
+        for _ in range(3):
+            wheel.advance()
+        self.assertEqual(fired, ['new'])
+
+    def test_pending_expiries_scheduled_on_start(self):
+        """Test that a started wheel sets a timer for every room saved with an expiry time."""
+        user = User.objects.create_user(username='user1', password='pass123')
+        expired = ChatSession.objects.create(name='Expired', created_by=user,
+                                             expiry_time=timezone.now() - timedelta(seconds=1))
+        pending = ChatSession.objects.create(name='Pending', created_by=user,
+                                             expiry_time=timezone.now() + timedelta(minutes=5))
+        ChatSession.objects.create(name='students', created_by=user)  # Predefined rooms never expire
+
+        wheel = TimerWheel(tick=1.0, slots=8)
+        self.assertEqual(schedule_pending_expiries(wheel), 2)
+        self.assertTrue(wheel.has(pending.id))
+        wheel.advance()  # Rooms that expired while the process was down go on the next tick
+        self.assertFalse(ChatSession.objects.filter(id=expired.id).exists())
+        self.assertTrue(ChatSession.objects.filter(id=pending.id).exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RoomExpiryTests(TestCase):
+    """Tests for exact-time room expiry."""
+
+    def setUp(self):
+        """Set up a room that has just expired."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user,
+                                                       expiry_time=timezone.now() - timedelta(seconds=1))
+
+    def test_expiry_scheduled_when_expiry_time_changes(self):
+        """Test that saving a room schedules its expiry only when the expiry time changes."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.chat_session.name = 'Renamed'
+            self.chat_session.save()
+        self.assertEqual(len(callbacks), 0)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.chat_session.expiry_time = timezone.now() + timedelta(minutes=5)
+            self.chat_session.save()
+        self.assertEqual(len(callbacks), 1)
+
+    @override_settings(CHAT_EXPIRY_SCHEDULER='timer')
+    def test_private_room_created_from_lobby_is_scheduled(self):
+        """Test that a private room created with its expiry time gets its timer."""
+        wheel = IdleTimerWheel()
+        process_wheel, expiry.timer_wheel = expiry.timer_wheel, wheel
+        self.addCleanup(setattr, expiry, 'timer_wheel', process_wheel)
+
+        self.client.login(username='user1', password='pass123')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('chat:chat_home'), {'name': 'Private', 'is_private': True})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(wheel.has(ChatSession.objects.get(name='Private').id))
+
+    def test_rescheduled_task_does_nothing(self):
+        """Test that a task scheduled for an outdated expiry time leaves the room alone."""
+        expire_room(self.chat_session.id, (self.chat_session.expiry_time - timedelta(minutes=1)).isoformat())
+        self.assertTrue(ChatSession.objects.filter(id=self.chat_session.id).exists())
+
+    async def test_connected_sockets_are_closed(self):
+        """Test that expiring a room tells connected clients and closes their sockets."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+
+        await database_sync_to_async(expire_room)(self.chat_session.id, self.chat_session.expiry_time.isoformat())
+
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'room_expired'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        self.assertFalse(await database_sync_to_async(ChatSession.objects.filter(name='TestRoom').exists)())
+        await communicator.disconnect()  # Let the consumer clean up its presence
+
+
+class MessageSearchTests(TestCase):
+    """Tests for full-text search over chat messages."""
+
+    def setUp(self):
+        """Set up a room the user participates in and one they do not."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.other = User.objects.create_user(username='user2', password='pass123')
+        self.joined = ChatSession.objects.create(name='Joined', created_by=self.user)
+        self.joined.participants.add(self.user)
+        self.foreign = ChatSession.objects.create(name='Foreign', created_by=self.other)
+        self.foreign.participants.add(self.other)
+
+        Message.objects.create(chat_session=self.joined, user=self.user, message='Homework is due on Friday')
+        Message.objects.create(chat_session=self.joined, user=self.other,
+                               message='Homework homework homework, so much homework')
+        Message.objects.create(chat_session=self.joined, user=self.other, message='See you at the lecture')
+        Message.objects.create(chat_session=self.foreign, user=self.other, message='Secret homework answers')
+        self.client.login(username='user1', password='pass123')
+
+    def search(self, query):
+        response = self.client.get(reverse('chat:message_search'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_results_are_ranked_and_scoped(self):
+        """Test that results only come from the user's rooms and the best match comes first."""
+        results = self.search('homework')
+        self.assertEqual([result['message'] for result in results], [
+            'Homework homework homework, so much homework',
+            'Homework is due on Friday',
+        ])
+        self.assertEqual(results[0]['room_name'], 'Joined')
+
+    def test_prefix_and_operator_characters(self):
+        """Test that the last word matches as a prefix and query syntax is treated as text."""
+        self.assertEqual(len(self.search('lect')), 1)
+        self.assertEqual(self.search('"OR lecture*'), self.search('or lecture'))
+
+    def test_index_follows_deletes(self):
+        """Test that deleted messages disappear from the index, including bulk inserts."""
+        Message.objects.filter(message__startswith='See you').delete()
+        self.assertEqual(self.search('lecture'), [])
+        Message.objects.bulk_create([Message(chat_session=self.joined, user=self.user, message='Lecture notes')])
+        self.assertEqual(len(self.search('lecture')), 1)
+
+    def test_admin_search_matches_text_and_username_prefix(self):
+        """Test that the message admin finds messages by text and by part of the sender's username."""
+        User.objects.create_superuser(username='admin', password='pass123')
+        self.client.login(username='admin', password='pass123')
+        url = reverse('admin:chat_message_changelist')
+        self.assertEqual(self.client.get(url, {'q': 'lecture'}).context['cl'].result_count, 1)
+        self.assertEqual(self.client.get(url, {'q': 'USER'}).context['cl'].result_count, 4)
+
+
+class RoomExportTests(TestCase):
+    """Tests for the streamed room transcript export."""
+
+    def setUp(self):
+        """Set up a room with messages spread over three days."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='Export Room', created_by=self.user)
+        now = timezone.now()
+        for days, text in [(2, 'first'), (1, 'second, with a comma'), (0, 'third')]:
+            Message.objects.create(chat_session=self.chat_session, user=self.user, message=text,
+                                   timestamp=now - timedelta(days=days))
+        self.url = reverse('chat:export_room', args=['Export Room'])
+        self.client.login(username='user1', password='pass123')
+
+    def test_ndjson_export_is_streamed(self):
+        """Test that the default export streams one JSON document per message, oldest first."""
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['message'] for line in lines],
+                         ['first', 'second, with a comma', 'third'])
+
+    def test_csv_export_with_time_range(self):
+        """Test that a CSV export only contains the messages inside the requested range."""
+        start = (timezone.now() - timedelta(days=1, hours=1)).isoformat()
+        end = (timezone.now() - timedelta(hours=1)).isoformat()
+        response = self.client.get(self.url, {'format': 'csv', 'start': start, 'end': end})
+        rows = list(csv.DictReader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual([row['message'] for row in rows], ['second, with a comma'])
+        self.assertEqual(rows[0]['username'], 'user1')
+
+    def test_invalid_parameters_and_access(self):
+        """Test that bad parameters are rejected and private rooms stay private."""
+        self.assertEqual(self.client.get(self.url, {'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'start': 'yesterday'}).status_code, 400)
+
+        other = User.objects.create_user(username='user2', password='pass123')
+        ChatSession.objects.create(name='Hidden', created_by=other, is_private=True)
+        response = self.client.get(reverse('chat:export_room', args=['Hidden']))
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_LOBBY_PAGE_SIZE=10)
+class ChatLobbyTests(TestCase):
+    """Tests for the paginated chat lobby and the room statistics it shows."""
+
+    def setUp(self):
+        """Set up a user, a public room and a private room they are not allowed in."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.other = User.objects.create_user(username='user2', password='pass123')
+        self.public = ChatSession.objects.create(name='Public', created_by=self.other)
+        self.hidden = ChatSession.objects.create(name='Hidden', created_by=self.other, is_private=True)
+        self.client.login(username='user1', password='pass123')
+
+    def test_lobby_lists_visible_rooms_only(self):
+        """Test that private rooms the user is not allowed in are not listed."""
+        response = self.client.get(reverse('chat:chat_home'))
+        self.assertEqual(list(response.context['chat_sessions']), [self.public])
+
+        self.hidden.allowed_users.add(self.user)
+        response = self.client.get(reverse('chat:chat_home'))
+        self.assertEqual(set(response.context['chat_sessions']), {self.public, self.hidden})
+
+    def test_lobby_query_count_does_not_grow_with_rooms(self):
+        """Test that a lobby page costs the same number of queries however many rooms exist."""
+        for i in range(3):
+            ChatSession.objects.create(name=f'Room {i}', created_by=self.other)
+        with CaptureQueriesContext(connection) as few_rooms:
+            self.client.get(reverse('chat:chat_home'))
+
+        for i in range(3, 30):
+            ChatSession.objects.create(name=f'Room {i}', created_by=self.other)
+        with CaptureQueriesContext(connection) as many_rooms:
+            response = self.client.get(reverse('chat:chat_home'))
+        self.assertEqual(len(many_rooms), len(few_rooms))
+        self.assertEqual(len(response.context['chat_sessions']), 10)
+
+    def test_stats_follow_participants_and_messages(self):
+        """Test that participant changes and buffered message writes update the room's stats."""
+        self.public.participants.add(self.user, self.other)
+        self.user.chat_sessions.remove(self.public)
+        buffer = MessageBuffer(self.public.id, max_batch_size=2, flush_interval=60)
+        async_to_sync(buffer.add)(self.user, 'one')
+        async_to_sync(buffer.add)(self.user, 'two')
+
+        self.public.stats.refresh_from_db()
+        self.assertEqual(self.public.stats.participant_count, 1)
+        self.assertEqual(self.public.stats.last_message_at, Message.objects.latest('timestamp').timestamp)
+
+    async def test_online_count_follows_presence(self):
+        """Test that joining and leaving a room updates its online count."""
+        communicator = chat_communicator('Public', self.user)
+        await join_room(communicator)
+        stats = await database_sync_to_async(lambda: ChatSession.objects.get(id=self.public.id).stats)()
+        self.assertEqual(stats.online_count, 1)
+
+        await communicator.disconnect()
+        await database_sync_to_async(stats.refresh_from_db)()
+        self.assertEqual(stats.online_count, 0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class UnreadCountTests(TestCase):
+    """Tests for per-user read cursors and unread counts."""
+
+    def setUp(self):
+        """Set up a room with two participants."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.other = User.objects.create_user(username='user2', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        self.chat_session.participants.add(self.user, self.other)
+
+    def unread(self, user):
+        return ReadCursor.objects.get(user=user, chat_session=self.chat_session).unread_count
+
+    def test_batched_writes_count_other_senders_only(self):
+        """Test that a buffered batch adds the messages of other users to each reader's count."""
+        buffer = MessageBuffer(self.chat_session.id, max_batch_size=3, flush_interval=60)
+        async_to_sync(buffer.add)(self.user, 'one')
+        async_to_sync(buffer.add)(self.other, 'two')
+        async_to_sync(buffer.add)(self.other, 'three')
+        Message.objects.create(chat_session=self.chat_session, user=self.user, message='four')
+
+        self.assertEqual(self.unread(self.user), 2)
+        self.assertEqual(self.unread(self.other), 2)
+
+    async def test_ack_resets_unread_count(self):
+        """Test that an ack over the WebSocket moves the read cursor to the newest message."""
+        await database_sync_to_async(Message.objects.create)(
+            chat_session=self.chat_session, user=self.other, message='Hello'
+        )
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await communicator.send_json_to({'type': 'ack'})
+        await communicator.disconnect()
+
+        cursor = await database_sync_to_async(ReadCursor.objects.get)(user=self.user, chat_session=self.chat_session)
+        self.assertEqual(cursor.unread_count, 0)
+        self.assertEqual(cursor.last_read_message_id,
+                         await database_sync_to_async(lambda: Message.objects.latest('id').id)())
+
+    def test_unread_badges_in_lobby_and_dashboard(self):
+        """Test that the lobby and the dashboard show unread counts."""
+        Message.objects.create(chat_session=self.chat_session, user=self.other, message='Hello')
+        self.client.login(username='user1', password='pass123')
+
+        response = self.client.get(reverse('chat:chat_home'))
+        self.assertEqual(response.context['chat_sessions'][0].unread_count, 1)
+        response = self.client.get(reverse('dashboard:dashboard'))
+        self.assertContains(response, '(1 unread)')
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+class MessageListAPITests(TestCase):
+    """Tests for the paginated message list API and its incremental sync."""
+
+    def setUp(self):
+        """Set up a room with three messages and a participant."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        self.chat_session.participants.add(self.user)
+        self.messages = [
+            Message.objects.create(chat_session=self.chat_session, user=self.user, message=text)
+            for text in ['one', 'two', 'three']
+        ]
+        self.url = reverse('chat:session_messages', args=[self.chat_session.id])
+        self.client.login(username='user1', password='pass123')
+
+    def test_cursor_pages_newest_first(self):
+        """Test that pages walk back from the newest message with a fixed number of queries."""
+        with self.assertNumQueries(4):  # Login session, user, participant check and the page; none per row
+            response = self.client.get(self.url)
+        self.assertEqual([m['message'] for m in response.json()['results']], ['three', 'two'])
+
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([m['message'] for m in response.json()['results']], ['one'])
+
+    def test_since_id_returns_only_new_messages(self):
+        """Test that since_id returns the messages after an id, oldest first."""
+        response = self.client.get(self.url, {'since_id': self.messages[0].id})
+        self.assertEqual([m['message'] for m in response.json()['results']], ['two', 'three'])
+        self.assertEqual(self.client.get(self.url, {'since_id': 'x'}).status_code, 400)
+
+    def test_unchanged_page_is_not_modified(self):
+        """Test that polling with the previous ETag gets 304 until a new message arrives."""
+        etag = self.client.get(self.url, {'since_id': self.messages[2].id})['ETag']
+        response = self.client.get(self.url, {'since_id': self.messages[2].id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Message.objects.create(chat_session=self.chat_session, user=self.user, message='four')
+        response = self.client.get(self.url, {'since_id': self.messages[2].id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['message'] for m in response.json()['results']], ['four'])
+
+    def test_participants_only(self):
+        """Test that non-participants are refused and participants can post."""
+        response = self.client.post(self.url, {'message': 'Hello'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['user'], self.user.id)
+
+        User.objects.create_user(username='user2', password='pass123')
+        self.client.login(username='user2', password='pass123')
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get(reverse('chat:session_messages', args=[0])).status_code, 404)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    CHAT_RATE_LIMITS={'user': {'rate': 0.01, 'burst': 2}, 'room': None},
+)
+class RateLimitTests(TestCase):
+    """Tests for token-bucket rate limiting of incoming frames."""
+
+    def setUp(self):
+        """Set up a user and a room, with empty rate limit buckets."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        get_rate_limit_backend().buckets.clear()
+        metrics.reset()
+
+    async def test_token_bucket_refills(self):
+        """Test that a bucket allows its burst, then refills at its rate."""
+        backend = InMemoryRateLimitBackend()
+        self.assertTrue(await backend.consume('key', rate=100, burst=1))
+        self.assertFalse(await backend.consume('key', rate=100, burst=1))
+        await asyncio.sleep(0.02)
+        self.assertTrue(await backend.consume('key', rate=100, burst=1))
+
+    async def test_over_limit_frames_get_an_error(self):
+        """Test that frames past the user's burst are answered with an error and not processed."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        for text in ['one', 'two', 'three']:
+            await communicator.send_json_to({'message': text})
+
+        # The error is sent straight away, ahead of the coalesced broadcasts waiting in the send queue
+        error = await communicator.receive_json_from()
+        broadcasts = await communicator.receive_json_from()
+        await communicator.disconnect()
+        self.assertEqual(error['error'], 'rate_limited')
+        self.assertEqual([frame['message'] for frame in broadcasts], ['one', 'two'])
+
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+        self.assertEqual(metrics.snapshot()['counters']['chat.ratelimit.throttled.user'], 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_FANOUT_SHARDS={'Big Room': 4})
+class ShardedFanoutTests(TestCase):
+    """Tests for spreading the members of large rooms over several channel layer groups."""
+
+    def setUp(self):
+        """Set up a sharded room."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='Big Room', created_by=self.user)
+
+    def test_groups(self):
+        """Test that sharded rooms have one group per shard and members hash to one of them."""
+        groups = fanout.room_groups(self.chat_session.id, 'Big Room')
+        self.assertEqual(len(groups), 4)
+        self.assertEqual(fanout.room_groups(self.chat_session.id, 'Small Room'),
+                         [fanout.room_group_name(self.chat_session.id)])
+        self.assertIn(fanout.member_group(self.chat_session.id, 'Big Room', 'specific..abc'), groups)
+
+    async def test_messages_reach_members_of_every_shard(self):
+        """Test that a message reaches members whose connections joined different shards."""
+        users = [self.user] + [
+            await database_sync_to_async(User.objects.create_user)(username=f'member{i}', password='pass123')
+            for i in range(7)
+        ]
+        communicators = [chat_communicator('Big Room', user) for user in users]
+        for communicator in communicators:
+            await communicator.connect()
+        for communicator in communicators:
+            await communicator.receive_json_from()  # History
+        layer = get_channel_layer()
+        self.assertGreater(len([group for group in layer.groups if group.startswith('chat_')]), 1)
+
+        await communicators[0].send_json_to({'message': 'Hello everyone'})
+        for communicator in communicators:
+            frames = []
+            while not any(frame.get('message') == 'Hello everyone' for frame in frames):
+                payload = await communicator.receive_json_from()
+                frames.extend(payload if isinstance(payload, list) else [payload])
+        for communicator in communicators:
+            await communicator.disconnect()
+
+
+class MessageSegmentTests(TestCase):
+    """Tests for moving the old messages of never-expiring rooms into segment files."""
+
+    def setUp(self):
+        """Set up a predefined room with old messages over two months and two recent ones."""
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=self.media_root.name, CHAT_HISTORY_PAGE_SIZE=2,
+                                        CHAT_TIERING_ENABLED=True))
+
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='students', created_by=self.user)
+        self.chat_session.participants.add(self.user)
+        now = timezone.now()
+        timestamps = [now - timedelta(days=days) for days in (150, 149, 120, 119)] + [now - timedelta(days=1), now]
+        for index, timestamp in enumerate(timestamps):
+            Message.objects.create(chat_session=self.chat_session, user=self.user,
+                                   message=f'message {index}', timestamp=timestamp)
+
+    def test_old_messages_moved_to_segments(self):
+        """Test that only old messages leave the database, written into one segment per month."""
+        self.assertEqual(tier_old_messages(), 'Moved 4 messages to segments.')
+        self.assertEqual(list(Message.objects.values_list('message', flat=True).order_by('id')),
+                         ['message 4', 'message 5'])
+        segments = list(MessageSegment.objects.filter(chat_session=self.chat_session))
+        self.assertEqual(sum(segment.message_count for segment in segments), 4)
+        self.assertEqual(len(segments), len({segment.month for segment in segments}))
+        for segment in segments:
+            self.assertTrue(os.path.exists(os.path.join(self.media_root.name, segment.path)))
+
+    def test_history_and_export_include_segments(self):
+        """Test that history pages and exports continue seamlessly from the database into the segments."""
+        tier_old_messages()
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = fetch_page(self.chat_session.id, before=cursor)
+            seen = [message['message'] for message in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f'message {index}' for index in range(6)])
+
+        records = list(export_records(self.chat_session))
+        self.assertEqual([record['message'] for record in records], [f'message {index}' for index in range(6)])
+        self.assertEqual(records[0]['username'], 'user1')
+
+    @override_settings(CHAT_TIERING_ENABLED=False)
+    def test_tiering_is_off_by_default(self):
+        """Test that, unless enabled, old messages stay where the REST list and full-text search read them."""
+        self.assertEqual(tier_old_messages(), 'Tiering is disabled.')
+        self.assertEqual(Message.objects.count(), 6)
+        self.client.login(username='user1', password='pass123')
+
+        url = reverse('chat:session_messages', args=[self.chat_session.id])
+        seen = []
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(message['message'] for message in page['results'])
+            url = page['next']
+        self.assertIn('message 0', seen)
+
+        results = self.client.get(reverse('chat:message_search'), {'q': 'message'}).json()
+        self.assertEqual(len(results), 6)
+
+    def test_segment_files_deleted_with_room(self):
+        """Test that deleting a room removes its segment files."""
+        tier_old_messages()
+        paths = [os.path.join(self.media_root.name, segment.path) for segment in MessageSegment.objects.all()]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat_session.delete()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+class FakeRedis:
+    """
+    Stand-in for a redis.asyncio client keeping values in memory, for testing Redis backends
+    without a server. Registered scripts run the Python function given for their source.
+    """
+
+    def __init__(self, scripts):
+        self.values = {}
+        self.scripts = scripts
+
+    async def get(self, key):
+        value = self.values.get(key)
+        return None if value is None else str(value).encode()
+
+    def register_script(self, source):
+        run = self.scripts[source]
+
+        async def script(keys, args):
+            return run(self.values, keys, args)
+        return script
+
+
+def run_sequence_script(values, keys, args):
+    """RedisSequenceBackend.script: seed a missing counter from ARGV[1] unless it is empty, then increment."""
+    if keys[0] not in values:
+        if args[0] == '':
+            return None
+        values[keys[0]] = int(args[0])
+    values[keys[0]] += 1
+    return values[keys[0]]
+
+
+def run_advance_script(values, keys, args):
+    """RedisSequenceBackend.advance_script: move the counter up to ARGV[1]."""
+    values[keys[0]] = max(values.get(keys[0], 0), int(args[0]))
+
+
+class FakeRedisSequenceBackend(sequence.RedisSequenceBackend):
+    """Redis sequence backend whose client is a FakeRedis shared by every event loop."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.redis = FakeRedis({self.script: run_sequence_script, self.advance_script: run_advance_script})
+
+    def _connect(self):
+        return self.redis
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessageSequenceTests(TestCase):
+    """Tests for per-room sequence numbers and resuming after a dropped connection."""
+
+    def setUp(self):
+        """Set up a room, with sequence counters and recent messages starting from the database."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        sequence._backend = None
+        recent._backend = None
+        buffers._buffers.clear()
+        metrics.reset()
+
+    async def send_messages(self, communicator, count):
+        """Send `count` chat messages and return the sequence numbers they were broadcast with."""
+        seqs = []
+        for index in range(count):
+            await communicator.send_json_to({'message': f'message {index}'})
+        while len(seqs) < count:
+            payload = await communicator.receive_json_from()
+            seqs.extend(frame['seq'] for frame in (payload if isinstance(payload, list) else [payload]))
+        return seqs
+
+    async def test_messages_numbered_per_room(self):
+        """Test that messages are broadcast and stored with consecutive sequence numbers."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        self.assertEqual(await self.send_messages(communicator, 3), [1, 2, 3])
+        await communicator.disconnect()
+
+        stored = await database_sync_to_async(list)(Message.objects.order_by('seq').values_list('seq', 'message'))
+        self.assertEqual(stored, [(1, 'message 0'), (2, 'message 1'), (3, 'message 2')])
+        self.assertEqual(await database_sync_to_async(sequence.stored_seq)(self.chat_session.id), 3)
+
+    async def test_counter_seeded_above_stored_and_buffered_numbers(self):
+        """Test that a counter seeded again starts above stored messages and the caller's buffered ones."""
+        await database_sync_to_async(Message.objects.create)(
+            chat_session=self.chat_session, user=self.user, message='stored', seq=5
+        )  # Written without moving RoomStats.last_seq forward
+        self.assertEqual(await sequence.next_seq(self.chat_session.id), 6)
+        sequence._backend = None
+        self.assertEqual(await sequence.next_seq(self.chat_session.id, floor=8), 9)
+
+    async def test_duplicate_numbers_are_renumbered(self):
+        """Test that a batch rejected for reused sequence numbers is numbered again and written."""
+        buffer = MessageBuffer(self.chat_session.id, max_batch_size=2, flush_interval=60)
+        buffer.retry_delay = 0.01
+        await buffer.add(self.user, 'one')
+        await buffer.add(self.user, 'two')
+        sequence.get_sequence_backend().counters[self.chat_session.id] = 0  # A counter seeded from a stale view
+
+        await buffer.add(self.user, 'three')
+        await buffer.add(self.user, 'four')
+        await asyncio.sleep(0.05)
+        stored = await database_sync_to_async(list)(Message.objects.order_by('seq').values_list('seq', 'message'))
+        self.assertEqual(stored, [(1, 'one'), (2, 'two'), (3, 'three'), (4, 'four')])
+        self.assertEqual(metrics.snapshot()['counters']['chat.buffer.integrity_errors'], 1)
+
+    @override_settings(CHAT_SEQUENCE_BACKEND={'BACKEND': 'chat.tests.FakeRedisSequenceBackend'})
+    async def test_redis_backend_seeds_advances_and_resumes(self):
+        """Test that the Redis backend seeds from the database, moves past stored numbers, and serves resumes."""
+        await database_sync_to_async(Message.objects.create)(
+            chat_session=self.chat_session, user=self.user, message='stored', seq=5
+        )
+        self.assertIsNone(await sequence.current_seq(self.chat_session.id))
+        self.assertEqual(await sequence.next_seq(self.chat_session.id), 6)
+        self.assertEqual(await sequence.current_seq(self.chat_session.id), 6)
+        await database_sync_to_async(Message.objects.create)(
+            chat_session=self.chat_session, user=self.user, message='written elsewhere', seq=9
+        )
+        await sequence.advance_past_stored(self.chat_session.id)
+        self.assertEqual(await sequence.next_seq(self.chat_session.id), 10)
+
+        communicator = chat_communicator('TestRoom', self.user, query='?after_seq=4')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'resume')
+        self.assertEqual([m['seq'] for m in response['messages']], [5])
+        await communicator.disconnect()
+
+    async def test_resume_on_reconnect_from_memory(self):
+        """Test that a reconnecting client only gets the messages after its last sequence number."""
+        sender = chat_communicator('TestRoom', self.user)
+        await join_room(sender)
+        await self.send_messages(sender, 3)
+
+        communicator = chat_communicator('TestRoom', self.user, query='?after_seq=1')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'resume')
+        self.assertEqual([m['seq'] for m in response['messages']], [2, 3])
+        self.assertEqual(response['last_seq'], 3)
+        self.assertEqual(metrics.snapshot()['counters']['chat.resume.recent'], 1)
+        await communicator.disconnect()
+        await sender.disconnect()
+
+    @override_settings(CHAT_RECENT_MESSAGES_SIZE=1)
+    async def test_resume_frame_from_database(self):
+        """Test that gaps older than the room's recent messages are read from the database."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await self.send_messages(communicator, 3)
+
+        await communicator.send_json_to({'type': 'resume', 'after_seq': 0})
+        response = await communicator.receive_json_from()
+        self.assertEqual([m['message'] for m in response['messages']], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(metrics.snapshot()['counters']['chat.resume.database'], 1)
+
+        await communicator.send_json_to({'type': 'resume', 'after_seq': 'latest'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['error'], 'invalid_seq')
+        await communicator.disconnect()
+
+    @override_settings(CHAT_RESUME_LIMIT=2)
+    async def test_large_gap_resyncs(self):
+        """Test that a gap larger than the resume limit tells the client to reload."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await self.send_messages(communicator, 3)
+
+        await communicator.send_json_to({'type': 'resume', 'after_seq': 0})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response, {'type': 'resync', 'reason': 'resume_gap_too_large'})
+        await communicator.disconnect()
+
+    def test_fetch_after_stops_at_missing_number(self):
+        """Test that a resume from the database never skips a number that is not written yet."""
+        for seq in (1, 2, 4):
+            Message.objects.create(chat_session=self.chat_session, user=self.user, message=f'seq {seq}', seq=seq)
+        self.assertEqual([entry['seq'] for entry in fetch_after(self.chat_session.id, 0)], [1, 2])
+        self.assertEqual([entry['seq'] for entry in fetch_after(self.chat_session.id, 2)], [])
+
+    @override_settings(CHAT_RECENT_MESSAGES_SIZE=1)
+    async def test_resume_skips_lost_numbers(self):
+        """Test that a resume skips the number of a message deleted long ago instead of stopping at it."""
+        sent_at = timezone.now() - timedelta(minutes=5)
+        for seq in (1, 2, 3, 4):
+            await database_sync_to_async(Message.objects.create)(
+                chat_session=self.chat_session, user=self.user, message=f'seq {seq}', seq=seq, timestamp=sent_at
+            )
+        await database_sync_to_async(Message.objects.filter(seq=2).delete)()
+
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        await communicator.send_json_to({'type': 'resume', 'after_seq': 1})
+        response = await communicator.receive_json_from()
+        self.assertEqual(([m['seq'] for m in response['messages']], response['last_seq']), ([3, 4], 4))
+        self.assertEqual(metrics.snapshot()['counters']['chat.resume.database'], 1)
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_HISTORY_PAGE_SIZE=2, CHAT_RECENT_MESSAGES_SIZE=3)
+class RecentMessagesTests(TestCase):
+    """Tests for serving joins from the ring buffer of each room's recent messages."""
+
+    def setUp(self):
+        """Set up a room with three older messages and empty recent message rings."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        for index in range(3):
+            Message.objects.create(chat_session=self.chat_session, user=self.user, message=f'old {index}')
+        sequence._backend = None
+        recent._backend = None
+        buffers._buffers.clear()
+        metrics.reset()
+
+    async def test_message_flushing_its_batch_gets_its_id_in_the_ring(self):
+        """Test that the message filling a batch is in the ring before the flush fills in the ids."""
+        buffer = MessageBuffer(self.chat_session.id, max_batch_size=1, flush_interval=60)
+        pending = await buffer.add(self.user, 'fills the batch')
+        entries, _, _ = await recent.get_recent_backend().get(self.chat_session.id)
+        self.assertEqual([(entry['message'], entry['id']) for entry in entries], [('fills the batch', pending.id)])
+        self.assertIsNotNone(pending.id)
+
+    async def test_join_served_without_message_queries(self):
+        """Test that once primed, joins get the latest page from the ring, including unwritten messages."""
+        first = chat_communicator('TestRoom', self.user)
+        _, response = await join_room(first)
+        self.assertEqual([m['message'] for m in response['messages']], ['old 1', 'old 2'])
+        await first.send_json_to({'message': 'new'})
+        await first.receive_json_from()
+
+        other = await database_sync_to_async(User.objects.create_user)(username='user2', password='pass123')
+        second = chat_communicator('TestRoom', other)
+        _, response = await join_room(second)
+        self.assertEqual([m['message'] for m in response['messages']], ['old 2', 'new'])
+        counters = metrics.snapshot()['counters']
+        self.assertEqual((counters['chat.history.database'], counters['chat.history.recent']), (1, 1))
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_paging_past_the_ring_reads_the_database(self):
+        """Test that ring pages get cursors once their messages are written, and older pages come from the database."""
+        sender = chat_communicator('TestRoom', self.user)
+        await join_room(sender)
+        for text in ('a', 'b', 'c'):
+            await sender.send_json_to({'message': text})
+            await sender.receive_json_from()
+        await sender.disconnect()  # Flushes the buffer, which fills in the ids of the ring's entries
+
+        communicator = chat_communicator('TestRoom', self.user)
+        _, response = await join_room(communicator)
+        self.assertEqual([m['message'] for m in response['messages']], ['b', 'c'])
+        self.assertEqual(metrics.snapshot()['counters']['chat.history.recent'], 1)
+        await communicator.send_json_to({'type': 'history', 'before': response['next_cursor']})
+        response = await communicator.receive_json_from()
+        self.assertEqual([m['message'] for m in response['messages']], ['old 2', 'a'])
+        self.assertEqual(metrics.snapshot()['counters']['chat.history.database'], 2)
+        await communicator.disconnect()
+
+    async def test_prime_keeps_newer_entries_and_eviction(self):
+        """Test that priming keeps messages appended meanwhile, and that evicting the first message is noticed."""
+        backend = InMemoryRecentBackend(size=3)
+        await backend.append(1, {'id': None, 'seq': 3, 'message': 'live'})
+        await backend.prime(1, [{'id': 1, 'seq': 1, 'message': 'one'}, {'id': 2, 'seq': 2, 'message': 'two'}], complete=True)
+        entries, primed, complete = await backend.get(1)
+        self.assertEqual([entry['seq'] for entry in entries], [1, 2, 3])
+        self.assertTrue(primed and complete)
+
+        await backend.assign_ids(1, {3: 30})
+        await backend.append(1, {'id': None, 'seq': 4, 'message': 'next'})
+        entries, _, complete = await backend.get(1)
+        self.assertEqual([entry['id'] for entry in entries], [2, 30, None])
+        self.assertFalse(complete)
+
+
+@override_settings(CHAT_USER_SEARCH_PAGE_SIZE=2)
+class UserSearchTests(TestCase):
+    """Tests for the user search API and the autocomplete widget of the room creation form."""
+
+    def setUp(self):
+        """Set up the searching user and a few users to find."""
+        self.user = User.objects.create_user(username='alice', password='pass123')
+        for username, email in [('Albert', 'albert@example.com'), ('alfred', 'fred@example.com'),
+                                ('bob', 'alex@example.com'), ('carol', 'carol@example.com')]:
+            User.objects.create_user(username=username, email=email, password='pass123')
+        User.objects.create_user(username='alan', password='pass123', is_active=False)
+        self.url = reverse('chat:user_search')
+        self.client.login(username='alice', password='pass123')
+
+    def test_prefix_search_over_username_and_email(self):
+        """Test that users are matched by username or email prefix, case-insensitively, and paginated."""
+        response = self.client.get(self.url, {'q': 'AL'})
+        self.assertEqual(response.data['results'], [
+            {'id': User.objects.get(username='Albert').id, 'username': 'Albert'},
+            {'id': User.objects.get(username='alfred').id, 'username': 'alfred'},
+        ])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([user['username'] for user in response.data['results']], ['bob'])
+        self.assertIsNone(response.data['next'])
+
+        self.assertEqual(self.client.get(self.url).data['results'], [])
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url, {'q': 'al'}).status_code, 403)
+
+    def test_form_renders_and_submits_selected_users_only(self):
+        """Test that the lobby does not list every user, and that the submitted ids become allowed users."""
+        response = self.client.get(reverse('chat:chat_home'))
+        self.assertNotContains(response, 'carol')
+        self.assertContains(response, self.url)
+
+        carol = User.objects.get(username='carol')
+        response = self.client.post(reverse('chat:chat_home'), {'name': 'Study Group', 'allowed_users': [carol.id]})
+        self.assertRedirects(response, reverse('chat:room', args=['Study Group']), fetch_redirect_response=False)
+        chat_session = ChatSession.objects.get(name='Study Group')
+        self.assertEqual(set(chat_session.allowed_users.values_list('username', flat=True)), {'alice', 'carol'})
+
+        response = self.client.post(reverse('chat:chat_home'), {'name': '', 'allowed_users': [carol.id]})
+        self.assertContains(response, f'<option value="{carol.id}" selected>carol</option>', html=True)
+        self.assertNotContains(response, 'Albert')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LiveLobbyTests(TestCase):
+    """Tests for the lobby channel pushing room changes to open lobby pages."""
+
+    def setUp(self):
+        """Set up a user with an open lobby page, and another user creating and deleting rooms."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.other = User.objects.create_user(username='user2', password='pass123')
+        self.client.login(username='user2', password='pass123')
+
+    def lobby_communicator(self, user):
+        """Return a WebSocket communicator for the lobby channel, connected as the given user."""
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/lobby/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def create_room(self, name, **data):
+        """Create a room through the lobby form, running the callbacks of its transaction."""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('chat:chat_home'), {'name': name, **data})
+        return ChatSession.objects.get(name=name)
+
+    async def test_created_and_deleted_rooms_are_pushed(self):
+        """Test that lobby pages receive new rooms and room deletions as they happen."""
+        lobby_page = self.lobby_communicator(self.user)
+        connected, _ = await lobby_page.connect()
+        self.assertTrue(connected)
+
+        chat_session = await database_sync_to_async(self.create_room)('Study Group')
+        event = await lobby_page.receive_json_from()
+        self.assertEqual(event, {'type': 'room_created', 'room': {
+            'id': chat_session.id, 'name': 'Study Group', 'url': reverse('chat:room', args=['Study Group']),
+            'is_private': False, 'participant_count': 1, 'online_count': 0,
+        }})
+
+        def delete_room():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('chat:delete_room', args=['Study Group']))
+        await database_sync_to_async(delete_room)()
+        self.assertEqual(await lobby_page.receive_json_from(), {'type': 'room_deleted', 'room': {'id': chat_session.id}})
+        await lobby_page.disconnect()
+
+    async def test_private_rooms_reach_allowed_users_only(self):
+        """Test that a private room is only announced to the lobbies of its allowed users."""
+        outsider = await database_sync_to_async(User.objects.create_user)(username='user3', password='pass123')
+        allowed_page, outsider_page = self.lobby_communicator(self.user), self.lobby_communicator(outsider)
+        await allowed_page.connect()
+        await outsider_page.connect()
+
+        await database_sync_to_async(self.create_room)('Secret', is_private=True, allowed_users=[self.user.id])
+        event = await allowed_page.receive_json_from()
+        self.assertEqual((event['type'], event['room']['name'], event['room']['is_private']), ('room_created', 'Secret', True))
+        self.assertTrue(await outsider_page.receive_nothing())
+        await allowed_page.disconnect()
+        await outsider_page.disconnect()
+
+    async def test_expired_rooms_are_pushed(self):
+        """Test that the expiry task removes an expired room from open lobby pages."""
+        chat_session = await database_sync_to_async(ChatSession.objects.create)(
+            name='Expiring', created_by=self.other, expiry_time=timezone.now() - timedelta(seconds=1)
+        )
+        lobby_page = self.lobby_communicator(self.user)
+        await lobby_page.connect()
+
+        await database_sync_to_async(expire_room)(chat_session.id, chat_session.expiry_time.isoformat())
+        self.assertEqual(await lobby_page.receive_json_from(), {'type': 'room_expired', 'room': {'id': chat_session.id}})
+        await lobby_page.disconnect()
+
+    async def test_online_counts_are_pushed(self):
+        """Test that joins and leaves of a public room update its online count on lobby pages."""
+        chat_session = await database_sync_to_async(ChatSession.objects.create)(name='Public', created_by=self.other)
+        lobby_page = self.lobby_communicator(self.user)
+        await lobby_page.connect()
+
+        communicator = chat_communicator('Public', self.other)
+        await join_room(communicator)
+        self.assertEqual(await lobby_page.receive_json_from(),
+                         {'type': 'room_updated', 'room': {'id': chat_session.id, 'online_count': 1}})
+        await communicator.disconnect()
+        self.assertEqual(await lobby_page.receive_json_from(),
+                         {'type': 'room_updated', 'room': {'id': chat_session.id, 'online_count': 0}})
+        await lobby_page.disconnect()
+
+    async def test_anonymous_users_are_rejected(self):
+        """Test that the lobby channel only accepts authenticated users."""
+        connected, _ = await self.lobby_communicator(AnonymousUser()).connect()
+        self.assertFalse(connected)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ModerationTests(TestCase):
+    """Tests for the moderation automaton and its use on chat messages."""
+
+    def setUp(self):
+        """Set up a user, a room and a term of each action."""
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.chat_session = ChatSession.objects.create(name='TestRoom', created_by=self.user)
+        self.chat_session.participants.add(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            ModeratedTerm.objects.create(term='Darn', action=ModeratedTerm.MASK)
+            ModeratedTerm.objects.create(term='heck', action=ModeratedTerm.FLAG)
+            ModeratedTerm.objects.create(term='forbidden word', action=ModeratedTerm.REJECT)
+        self.addCleanup(moderation.invalidate)  # Rolled back terms must not stay in the automaton
+        sequence._backend = None
+        recent._backend = None
+        metrics.reset()
+
+    def test_automaton_matches_overlapping_terms_in_one_pass(self):
+        """Test that the automaton finds every term, including terms inside or overlapping others."""
+        automaton = TermAutomaton({term: moderation.MASK for term in ['he', 'she', 'his', 'hers']})
+        self.assertEqual(sorted(automaton.find('ushers')), [(1, 4, 'mask'), (2, 4, 'mask'), (2, 6, 'mask')])
+
+    def test_verdicts(self):
+        """Test that terms match whole words case-insensitively, and the strongest action wins."""
+        automaton = moderation.build_automaton()
+        self.assertEqual(automaton.moderate('Oh DARN it, darnit'), ('mask', 'Oh **** it, darnit', ['darn']))
+        self.assertEqual(automaton.moderate('darn, what the heck'), ('flag', '****, what the heck', ['darn', 'heck']))
+        self.assertEqual(automaton.moderate('a Forbidden Word'), ('reject', 'a Forbidden Word', ['forbidden word']))
+        self.assertEqual(automaton.moderate('all fine'), (None, 'all fine', []))
+
+    def test_automaton_rebuilt_only_when_terms_change(self):
+        """Test that the term list is compiled once, and again only after a term changes."""
+        for _ in range(3):
+            async_to_sync(moderation.moderate)('darn')
+        self.assertEqual(metrics.snapshot()['observations']['chat.moderation.build_ms']['count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ModeratedTerm.objects.filter(term='darn').delete()
+        self.assertEqual(async_to_sync(moderation.moderate)('darn').action, None)
+        self.assertEqual(metrics.snapshot()['observations']['chat.moderation.build_ms']['count'], 2)
+
+    def test_automaton_rebuilt_once_too_old(self):
+        """Test that a term change whose invalidation never reached this process is seen after CHAT_MODERATION_MAX_AGE."""
+        self.assertEqual(async_to_sync(moderation.moderate)('darn').action, moderation.MASK)
+        # The invalidation waits for a commit that never comes, as if it went to another process's cache
+        ModeratedTerm.objects.filter(term='darn').delete()
+        with override_settings(CHAT_MODERATION_REFRESH_INTERVAL=0):
+            self.assertEqual(async_to_sync(moderation.moderate)('darn').action, moderation.MASK)
+            with override_settings(CHAT_MODERATION_MAX_AGE=0):
+                self.assertIsNone(async_to_sync(moderation.moderate)('darn').action)
+
+    async def test_consumer_masks_rejects_and_flags(self):
+        """Test that chat messages are masked, rejected with an error, or delivered and flagged."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+
+        await communicator.send_json_to({'message': 'darn it'})
+        self.assertEqual((await communicator.receive_json_from())['message'], '**** it')
+
+        await communicator.send_json_to({'message': 'that forbidden word'})
+        self.assertEqual((await communicator.receive_json_from())['error'], 'message_rejected')
+
+        await communicator.send_json_to({'message': 'what the heck'})
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['message'], 'what the heck')
+        await communicator.disconnect()
+
+        flagged = await database_sync_to_async(FlaggedMessage.objects.get)()
+        self.assertEqual((flagged.message, flagged.terms, flagged.seq), ('what the heck', 'heck', event['seq']))
+        self.assertEqual(await database_sync_to_async(
+            lambda: list(Message.objects.values_list('message', flat=True)))(), ['**** it', 'what the heck'])
+
+    async def test_consumer_rejects_messages_that_are_not_strings(self):
+        """Test that a list or object sent as a message is refused instead of bypassing moderation."""
+        communicator = chat_communicator('TestRoom', self.user)
+        await join_room(communicator)
+        for message in (['forbidden word'], {'x': 'forbidden word'}, 42):
+            await communicator.send_json_to({'message': message})
+            self.assertEqual((await communicator.receive_json_from())['error'], 'invalid_frame')
+        await communicator.disconnect()
+
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+        with self.assertRaises(TypeError):
+            await moderation.moderate(['forbidden word'])
+
+    def test_api_moderates_messages(self):
+        """Test that messages posted through the REST API are moderated too."""
+        self.client.login(username='user1', password='pass123')
+        url = reverse('chat:session_messages', args=[self.chat_session.id])
+        self.assertEqual(self.client.post(url, {'message': 'darn'}).json()['message'], '****')
+        self.assertEqual(self.client.post(url, {'message': 'forbidden word'}).status_code, 400)
+
+    def test_benchmark_command(self):
+        """Test that the benchmark reports the per-message cost of the automaton and of a regex per term."""
+        out = StringIO()
+        call_command('moderationbench', terms=200, messages=20, regex_messages=5, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['terms'], report['messages']), (200, 20))
+        self.assertIn('p95', report['per_message_us'])
+        self.assertEqual(report['regex_per_term']['messages'], 5)
@@ -0,0 +1,80 @@
+from django.db.models import Case, F, IntegerField, Max, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from .models import Message, ReadCursor
+
+
+def create_cursors(chat_session_id, user_ids):
+    """
+    Give users who just joined a chat session a read cursor starting at its newest message.
+    Users who already have a cursor keep it.
+    """
+    last_message_id = (
+        Message.objects.filter(chat_session_id=chat_session_id).aggregate(last=Max('id'))['last']
+    )
+    ReadCursor.objects.bulk_create(
+        [ReadCursor(user_id=user_id, chat_session_id=chat_session_id, last_read_message_id=last_message_id)
+         for user_id in user_ids],
+        ignore_conflicts=True
+    )
+
+
+def delete_cursors(chat_session_id, user_ids):
+    """
+    Drop the read cursors of users who left a chat session.
+    """
+    ReadCursor.objects.filter(chat_session_id=chat_session_id, user_id__in=user_ids).delete()
+
+
+def record_messages(chat_session_id, sender_counts):
+    """
+    Add newly written messages to the unread counts of a chat session's readers in a single
+    UPDATE. `sender_counts` maps each sender's user id to the number of messages they wrote;
+    nobody's own messages count as unread.
+    """
+    total = sum(sender_counts.values())
+    if not total:
+        return
+    own = Case(
+        *[When(user_id=user_id, then=Value(count)) for user_id, count in sender_counts.items()],
+        default=Value(0),
+        output_field=IntegerField()
+    )
+    ReadCursor.objects.filter(chat_session_id=chat_session_id).update(
+        unread_count=F('unread_count') + total - own
+    )
+
+
+def mark_read(user_id, chat_session_id):
+    """
+    Move a user's read cursor to the newest written message of a chat session and reset
+    their unread count. Returns the number of cursors updated (0 if the user has none).
+    """
+    last_message_id = Subquery(
+        Message.objects.filter(chat_session_id=chat_session_id).order_by('-id').values('id')[:1]
+    )
+    return ReadCursor.objects.filter(user_id=user_id, chat_session_id=chat_session_id).update(
+        last_read_message_id=Coalesce(last_message_id, F('last_read_message_id')),
+        unread_count=0
+    )
+
+
+def unread_count_subquery(user, chat_session_ref):
+    """
+    Return a subquery selecting a user's unread count in the chat session referenced
+    by `chat_session_ref` (an OuterRef), for annotating a list of rooms in one query.
+    """
+    return Subquery(
+        ReadCursor.objects.filter(user_id=user.id, chat_session_id=chat_session_ref).values('unread_count')[:1]
+    )
+
+
+def unread_rooms(user):
+    """
+    Return the read cursors of the rooms where a user has unread messages, most unread first.
+    """
+    return (
+        ReadCursor.objects.filter(user_id=user.id, unread_count__gt=0)
+        .select_related('chat_session')
+        .only('unread_count', 'chat_session__id', 'chat_session__name')
+        .order_by('-unread_count')
+    )
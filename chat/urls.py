@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api_views, views
 
 # Define the namespace for the chat app
 app_name = 'chat'
@@ -8,5 +8,10 @@ app_name = 'chat'
 urlpatterns = [
     path('', views.chat_home, name='chat_home'),  # Home page for chat, displays available rooms
     path('<str:room_name>/', views.room, name='room'),  # View for a specific chat room
+    path('<str:room_name>/export/', views.export_room, name='export_room'),  # Streamed transcript download, as NDJSON or CSV
     path('<str:room_name>/delete/', views.delete_room, name='delete_room'),  # View to delete a room, accessible only to the room creator
+    path('api/messages/search/', api_views.MessageSearchAPIView.as_view(), name='message_search'),  # Full-text search over the user's rooms
+    path('api/users/search/', api_views.UserSearchAPIView.as_view(), name='user_search'),  # Prefix search over users, for picking a room's allowed users
+    path('api/sessions/<int:chat_session_id>/messages/', api_views.MessageListCreateAPIView.as_view(), name='session_messages'),  # Paginated messages of a room, with incremental sync
+    path('api/sessions/<int:chat_session_id>/presence/', api_views.ChatSessionPresenceAPIView.as_view(), name='session_presence'),  # Number of users connected to a room
 ]
@@ -1,16 +1,48 @@
 import logging
 from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import OuterRef, Q
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
 from datetime import timedelta
-from .models import ChatSession, ChatAccessAttempt
+from . import lobby
+from .models import ChatSession
 from .forms import CreateRoomForm
+from .acl import check_room_access
+from .audit import record_access_attempt
+from .export import EXPORT_FORMATS, export_lines, export_records
+from .unread import unread_count_subquery
 
 # Get an instance of a logger
 logger = logging.getLogger('chat_access')
 
+# Rooms that always exist; the lobby links to them separately
+PREDEFINED_ROOMS = ['students', 'teachers', 'teacher_student']
+
+
+def visible_chat_sessions(user):
+    """
+    Return the user-created chat sessions listed in a user's lobby: public rooms,
+    and private rooms the user is allowed in. Statistics and the user's unread count
+    are joined in, so listing a page of rooms costs a single query.
+    """
+    allowed_ids = ChatSession.allowed_users.through.objects.filter(user_id=user.id).values('chatsession_id')
+    return (
+        ChatSession.objects.filter(Q(is_private=False) | Q(id__in=allowed_ids))
+        .exclude(name__in=PREDEFINED_ROOMS + ['general'])
+        .select_related('stats')
+        .only('id', 'name', 'is_private', 'created_at', 'expiry_time',
+              'stats__participant_count', 'stats__online_count', 'stats__last_message_at')
+        .annotate(unread_count=unread_count_subquery(user, OuterRef('pk')))
+    )
+
 
 @login_required
 def chat_home(request):
@@ -42,6 +74,9 @@ def chat_home(request):
             chat_session.allowed_users.add(*allowed_users)
             chat_session.save()
 
+            # Open lobby pages add the room without reloading
+            transaction.on_commit(lambda: lobby.room_created(chat_session))
+
             messages.success(request, f"Chat room '{room_name}' created successfully.")
             return redirect('chat:room', room_name=chat_session.name)
         else:
@@ -49,10 +84,12 @@ def chat_home(request):
     else:
         form = CreateRoomForm()
 
-    # Display all chat sessions
-    chat_sessions = ChatSession.objects.all()
+    # Display one page of the rooms the user can enter, with their statistics
+    paginator = Paginator(visible_chat_sessions(request.user), getattr(settings, 'CHAT_LOBBY_PAGE_SIZE', 20))
+    page = paginator.get_page(request.GET.get('page'))
     return render(request, 'chat/chat_home.html', {
-        'chat_sessions': chat_sessions,
+        'chat_sessions': page.object_list,
+        'page': page,
         'form': form
     })
 
@@ -65,10 +102,7 @@ def room(request, room_name):
     View for handling chat room access.
     Provides access control for predefined and user-created chat rooms.
     """
-    # Define predefined rooms
-    predefined_rooms = ['students', 'teachers', 'teacher_student']
-
-    if room_name in predefined_rooms:
+    if room_name in PREDEFINED_ROOMS:
         chat_session, created = ChatSession.objects.get_or_create(
             name=room_name,
             defaults={'created_by': request.user, 'is_private': False}
@@ -76,51 +110,74 @@ def room(request, room_name):
     else:
         chat_session = get_object_or_404(ChatSession, name=room_name)
 
-    # Log access attempt
-    access_attempt = ChatAccessAttempt(
-        user=request.user,
-        room_name=room_name,
-        success=False  # Set to false initially, updated if access is granted
-    )
-
-    # Access control for predefined rooms
-    if room_name == 'students' and not request.user.groups.filter(name='Students').exists():
-        logger.info(f"Access denied to {request.user.username} for room '{room_name}'")
-        access_attempt.save()
-        return HttpResponseForbidden(render(request, 'chat/access_denied.html', {
-            'room_name': room_name,
-            'message': "You do not have permission to enter the Students Only Room."
-        }))
-
-    if room_name == 'teachers' and not request.user.groups.filter(name='Teachers').exists():
+    # Access control for predefined and private rooms, shared with the chat consumer
+    allowed, denied_message = check_room_access(request.user, chat_session)
+    if not allowed:
         logger.info(f"Access denied to {request.user.username} for room '{room_name}'")
-        access_attempt.save()
+        record_access_attempt(request.user, room_name, success=False)
         return HttpResponseForbidden(render(request, 'chat/access_denied.html', {
             'room_name': room_name,
-            'message': "You do not have permission to enter the Teachers Only Room."
+            'message': denied_message
         }))
 
-    # Access control for private rooms
-    if chat_session.is_private and request.user not in chat_session.allowed_users.all():
-        logger.info(f"Access denied to {request.user.username} for room '{room_name}'")
-        access_attempt.save()
-        return HttpResponseForbidden(render(request, 'chat/access_denied.html', {
-            'room_name': room_name,
-            'message': "You do not have permission to enter this private chat room."
-        }))
+    # Log successful access; attempts are buffered and written in batches
+    record_access_attempt(request.user, room_name, success=True)
 
-    # Log successful access
-    access_attempt.success = True
-    access_attempt.save()
-
-    # Ensure user is added as a participant
-    chat_session.participants.add(request.user)
+    # Participation is recorded by the chat consumer when the user's WebSocket first joins the room
 
     return render(request, 'chat/room.html', {
         'room_name': room_name,
         'chat_session': chat_session
     })
 
+def parse_time_bound(value):
+    """
+    Parse an ISO 8601 date or datetime given as an export bound.
+    Naive values are interpreted in the current time zone. Returns None for an empty value
+    and raises ValueError for an invalid one.
+    """
+    if not value:
+        return None
+    parsed = parse_datetime(value) or parse_datetime(f'{value}T00:00:00')
+    if parsed is None:
+        raise ValueError(value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+@login_required
+def export_room(request, room_name):
+    """
+    View to download the transcript of a chat room as NDJSON (default) or CSV.
+    Optional `start` and `end` query parameters restrict the export to a time range.
+    The response is streamed, so exporting a large room does not load it into memory.
+    """
+    chat_session = get_object_or_404(ChatSession, name=room_name)
+
+    # Same access rules as entering the room
+    allowed, denied_message = check_room_access(request.user, chat_session)
+    if not allowed:
+        logger.info(f"Export denied to {request.user.username} for room '{room_name}'")
+        raise PermissionDenied(denied_message)
+
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest(f"Unsupported export format '{export_format}'.")
+    try:
+        start = parse_time_bound(request.GET.get('start'))
+        end = parse_time_bound(request.GET.get('end'))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid 'start' or 'end'; use an ISO 8601 date or datetime.")
+
+    logger.info(f"{request.user.username} exported chat room '{room_name}' as {export_format}")
+    content_type, extension = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(
+        export_lines(export_format, export_records(chat_session, start=start, end=end)),
+        content_type=content_type
+    )
+    response['Content-Disposition'] = f'attachment; filename="{chat_session.id}_{slugify(room_name)}.{extension}"'
+    return response
+
 @login_required
 def delete_room(request, room_name):
     """
@@ -135,6 +192,8 @@ def delete_room(request, room_name):
         raise PermissionDenied("You do not have permission to delete this chat room.")
 
     logger.info(f"{request.user.username} deleted chat room '{room_name}'")
+    chat_session_id = chat_session.id
     chat_session.delete()
+    transaction.on_commit(lambda: lobby.room_removed(chat_session_id, lobby.ROOM_DELETED))
     messages.success(request, f"Chat room '{room_name}' has been deleted successfully.")
     return redirect('chat:chat_home')
@@ -1,6 +1,7 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from chat.unread import unread_rooms
 from courses.models import Course, Enrollment, CourseMaterial
 from feedback.models import Feedback
 from notifications.models import Notification
@@ -25,6 +26,9 @@ def dashboard(request):
 
     context['unread_notifications'] = unread_notifications
     context['read_notifications'] = read_notifications
+
+    # Chat rooms with messages the user has not read yet, fetched in a single query
+    context['unread_chats'] = unread_rooms(request.user)
     
     if request.user.is_teacher:
         # Fetch the courses created by the teacher